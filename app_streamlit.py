@@ -5,61 +5,66 @@ Frontend Streamlit para Chat Multi-Usuario
 
 import streamlit as st
 import os
-from typing import Dict, List
-from chat_multi_usuario import ChatMultiUsuario
+import uuid
+from typing import List
+from chat_multi_usuario import ChatMultiUsuario, RespuestaChat
+from pasarela_llm import LLMSaturado
+from trazas import ETAPAS
 from dotenv import load_dotenv
 
 # Cargar variables de entorno
 load_dotenv()
 
-# Configuración de la página
-st.set_page_config(
-    page_title="🎤 Chat Multi-Usuario",
-    page_icon="🎤",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
-
-# CSS personalizado
-st.markdown("""
-<style>
-    .main-header {
-        text-align: center;
-        padding: 1rem;
-        background: linear-gradient(90deg, #667eea 0%, #764ba2 100%);
-        color: white;
-        border-radius: 10px;
-        margin-bottom: 2rem;
-    }
+def configurar_pagina():
+    """Configuración y estilos de la página (en cada ejecución: cada sesión nueva los necesita)"""
+    # Configuración de la página
+    st.set_page_config(
+        page_title="🎤 Chat Multi-Usuario",
+        page_icon="🎤",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
+
+    # CSS personalizado
+    st.markdown("""
+    <style>
+        .main-header {
+            text-align: center;
+            padding: 1rem;
+            background: linear-gradient(90deg, #667eea 0%, #764ba2 100%);
+            color: white;
+            border-radius: 10px;
+            margin-bottom: 2rem;
+        }
     
-    .user-badge {
-        background-color: #e1f5fe;
-        padding: 0.5rem 1rem;
-        border-radius: 20px;
-        border: 2px solid #0277bd;
-        display: inline-block;
-        margin: 0.5rem 0;
-    }
+        .user-badge {
+            background-color: #e1f5fe;
+            padding: 0.5rem 1rem;
+            border-radius: 20px;
+            border: 2px solid #0277bd;
+            display: inline-block;
+            margin: 0.5rem 0;
+        }
     
-    .chat-container {
-        background-color: #f8f9fa;
-        padding: 1rem;
-        border-radius: 10px;
-        margin: 1rem 0;
-        border-left: 4px solid #667eea;
-    }
+        .chat-container {
+            background-color: #f8f9fa;
+            padding: 1rem;
+            border-radius: 10px;
+            margin: 1rem 0;
+            border-left: 4px solid #667eea;
+        }
     
-    .stButton > button {
-        width: 100%;
-        background-color: #667eea;
-        color: white;
-        border: none;
-        padding: 0.5rem;
-        border-radius: 5px;
-        font-weight: bold;
-    }
-</style>
-""", unsafe_allow_html=True)
+        .stButton > button {
+            width: 100%;
+            background-color: #667eea;
+            color: white;
+            border: none;
+            padding: 0.5rem;
+            border-radius: 5px;
+            font-weight: bold;
+        }
+    </style>
+    """, unsafe_allow_html=True)
 
 # Función para inicializar sistema de chat
 @st.cache_resource
@@ -80,15 +85,106 @@ def inicializar_chat():
         st.error("🌐 Para Streamlit Cloud: configura secrets en la interfaz web")
         st.stop()
     
-    return ChatMultiUsuario(redis_url, openai_api_key)
+    # Arranque rápido: modelos y cadenas se construyen en segundo plano
+    # mientras se dibuja la página; el primer mensaje espera si aún no terminó
+    # Con varias réplicas, BLOQUEO_POR_USUARIO=1 serializa los turnos de cada usuario
+    bloqueo = os.getenv("BLOQUEO_POR_USUARIO", "").lower() in ("1", "true", "si", "sí")
+    chat_system = ChatMultiUsuario(
+        redis_url, openai_api_key, inicializacion_perezosa=True, bloqueo_por_usuario=bloqueo
+    )
+    chat_system.precalentar()
+    return chat_system
+
+@st.cache_data(ttl=10, show_spinner=False)
+def usuarios_con_historial(_chat_system) -> List[str]:
+    """Usuarios para el selector de historial (compartido entre sesiones, se refresca cada 10 s)"""
+    return _chat_system.listar_usuarios_con_historial()
+
+def id_sesion_actual() -> str:
+    """Identificador de la sesión de Streamlit (una por pestaña del navegador)"""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        if ctx is not None:
+            return ctx.session_id
+    except ImportError:
+        pass
+    return uuid.uuid4().hex
+
+def cargar_pagina_historial(tamano: int = 20):
+    """Agrega a la vista la siguiente página del historial (o de resultados de búsqueda)"""
+    vista = st.session_state.vista_historial
+    chat_system = st.session_state.chat_system
+    if vista["busqueda"]:
+        pagina = chat_system.buscar_en_historial(
+            vista["usuario"], vista["busqueda"], limite=tamano, cursor=vista["cursor"]
+        )
+        mensajes = [r["mensaje"] for r in pagina["resultados"]]
+    else:
+        pagina = chat_system.obtener_historial_pagina(vista["usuario"], vista["cursor"], tamano)
+        mensajes = pagina["mensajes"]
+    # Solo texto: la vista vive en session_state mientras la pestaña esté abierta
+    vista["mensajes"] += [(m.type, m.content) for m in mensajes]
+    vista["cursor"] = pagina["cursor"]
+    vista["total"] = pagina["total"]
+
+def mostrar_vista_historial():
+    """Mensajes cargados del historial, del más nuevo al más antiguo, con carga bajo demanda"""
+    vista = st.session_state.vista_historial
+    titulo = f"Historial de {vista['usuario']}"
+    if vista["busqueda"]:
+        titulo += f" · \"{vista['busqueda']}\""
+    with st.expander(titulo, expanded=True):
+        if not vista["mensajes"] and vista["cursor"] is None:
+            st.info("No hay coincidencias" if vista["busqueda"] else "No hay historial para este usuario")
+        else:
+            st.caption(f"{len(vista['mensajes'])} de {vista['total']} mensajes" if not vista["busqueda"]
+                       else f"{len(vista['mensajes'])} coincidencias")
+        for tipo, contenido in vista["mensajes"]:
+            autor = "👤 Usuario" if tipo == "human" else "🤖 Asistente"
+            st.text(f"{autor}: {contenido}")
+        if vista["cursor"] is not None and st.button("⬇️ Cargar más", key="cargar_mas_historial_btn"):
+            cargar_pagina_historial()
+            st.rerun()
+
+def mostrar_panel_depuracion(cantidad: int = 10):
+    """Tiempos por etapa, tokens y cachés de los últimos turnos de la sesión"""
+    trazas = st.session_state.chat_system.ultimas_trazas(cantidad, sesion=st.session_state.sesion_chat)
+    with st.expander("🐞 Depuración: últimos turnos", expanded=True):
+        if not trazas:
+            st.info("Aún no hay turnos en esta sesión")
+            return
+        filas = []
+        for traza in trazas:
+            fila = {"usuario": traza["usuario"], "total (ms)": traza["ms_total"]}
+            for nombre in ETAPAS:
+                fila[f"{nombre} (ms)"] = traza["ms_por_etapa"].get(nombre, 0.0)
+            fila.update({
+                "tokens entrada": traza["tokens_entrada"],
+                "tokens en caché": traza["tokens_entrada_cache"],
+                "tokens salida": traza["tokens_salida"],
+                "mensajes historial": traza["mensajes_historial"],
+                "caché": ", ".join(f"{c}: {r}" for c, r in traza["cache"].items()),
+                "error": traza["error"] or "",
+            })
+            filas.append(fila)
+        st.dataframe(filas, use_container_width=True)
+        st.bar_chart(
+            {nombre: [t["ms_por_etapa"].get(nombre, 0.0) for t in reversed(trazas)] for nombre in ETAPAS}
+        )
 
 def main():
     """Función principal de la aplicación"""
-    
+    configurar_pagina()
+
     # Inicializar estado de sesión
     if "chat_system" not in st.session_state:
         st.session_state.chat_system = inicializar_chat()
 
+    # El motor es compartido entre pestañas; el usuario actual es de cada sesión
+    if "sesion_chat" not in st.session_state:
+        st.session_state.sesion_chat = st.session_state.chat_system.obtener_sesion(id_sesion_actual())
+
     if "messages" not in st.session_state:
         st.session_state.messages = []
 
@@ -123,7 +219,9 @@ def main():
         st.subheader("🔑 Identificación Manual")
         nuevo_usuario = st.text_input("Cambiar usuario:", placeholder="Ingresa tu nombre", key="cambiar_usuario_input")
         if st.button("🔄 Cambiar Usuario", key="cambiar_usuario_btn") and nuevo_usuario:
-            st.session_state.chat_system.cambiar_usuario(nuevo_usuario)
+            st.session_state.chat_system.cambiar_usuario(
+                nuevo_usuario, sesion=st.session_state.sesion_chat
+            )
             st.session_state.current_user = nuevo_usuario
             st.success(f"✅ Usuario cambiado a: {nuevo_usuario}")
             st.rerun()
@@ -133,11 +231,11 @@ def main():
         # Gestión de usuarios
         st.subheader("👥 Usuarios Registrados")
         if st.button("📝 Listar Usuarios", key="listar_usuarios_btn"):
-            usuarios = st.session_state.chat_system.listar_usuarios_con_historial()
+            usuarios = st.session_state.chat_system.listar_usuarios_detalle()
             if usuarios:
-                st.write("**Usuarios con historial:**")
+                st.write("**Usuarios con historial (más recientes primero):**")
                 for usuario in usuarios:
-                    st.write(f"• {usuario}")
+                    st.write(f"• {usuario['usuario']} ({usuario['mensajes']} mensajes)")
             else:
                 st.info("No hay usuarios registrados")
         
@@ -147,20 +245,26 @@ def main():
         st.subheader("📋 Ver Historial")
         usuario_historial = st.selectbox(
             "Usuario:", 
-            ["Selecciona..."] + st.session_state.chat_system.listar_usuarios_con_historial(),
+            ["Selecciona..."] + usuarios_con_historial(st.session_state.chat_system),
             key="select_usuario_historial"
         )
         
+        busqueda_historial = st.text_input(
+            "Buscar en el historial:", placeholder="Opcional", key="buscar_historial_input"
+        )
+
         if st.button("📖 Ver Historial", key="ver_historial_btn") and usuario_historial != "Selecciona...":
-            with st.expander(f"Historial de {usuario_historial}", expanded=True):
-                historial = st.session_state.chat_system.obtener_historial(usuario_historial)
-                if historial:
-                    for msg in historial:
-                        if hasattr(msg, 'content'):
-                            tipo = "👤 Usuario" if msg.type == "human" else "🤖 Asistente"
-                            st.text(f"{tipo}: {msg.content}")
-                else:
-                    st.info("No hay historial para este usuario")
+            st.session_state.vista_historial = {
+                "usuario": usuario_historial,
+                "busqueda": busqueda_historial.strip(),
+                "mensajes": [],
+                "cursor": None,
+                "total": 0,
+            }
+            cargar_pagina_historial()
+
+        if st.session_state.get("vista_historial"):
+            mostrar_vista_historial()
         
         st.markdown("---")
         
@@ -168,6 +272,11 @@ def main():
         if st.button("🗑️ Limpiar Chat", key="limpiar_chat_btn"):
             st.session_state.messages = []
             st.rerun()
+
+        st.markdown("---")
+
+        # Panel de depuración (opcional)
+        st.checkbox("🐞 Panel de depuración", key="mostrar_depuracion")
     
     # Área principal - Chat
     st.header("💬 Chat")
@@ -186,33 +295,49 @@ def main():
         with st.chat_message("user"):
             st.markdown(prompt)
         
-        # Procesar mensaje
+        # Procesar mensaje mostrando la respuesta a medida que se genera
         with st.chat_message("assistant"):
-            with st.spinner("Procesando..."):
-                try:
-                    respuesta = st.session_state.chat_system.procesar_mensaje(prompt)
-                    
-                    # Actualizar usuario actual si cambió
-                    if respuesta.usuario_actual != st.session_state.current_user:
-                        st.session_state.current_user = respuesta.usuario_actual
-                    
-                    # Mostrar respuesta
-                    st.markdown(respuesta.mensaje)
-                    
-                    # Agregar respuesta al historial
-                    st.session_state.messages.append({
-                        "role": "assistant", 
-                        "content": respuesta.mensaje
-                    })
-                    
-                except Exception as e:
-                    error_msg = f"❌ Error: {str(e)}"
-                    st.error(error_msg)
-                    st.session_state.messages.append({
-                        "role": "assistant", 
-                        "content": error_msg
-                    })
+            try:
+                final = {}
+
+                def fragmentos():
+                    for parte in st.session_state.chat_system.procesar_mensaje_stream(
+                        prompt, sesion=st.session_state.sesion_chat
+                    ):
+                        if isinstance(parte, RespuestaChat):
+                            final["respuesta"] = parte
+                        else:
+                            yield parte
+
+                st.write_stream(fragmentos())
+                respuesta = final["respuesta"]
+
+                # Actualizar usuario actual si cambió
+                if respuesta.usuario_actual != st.session_state.current_user:
+                    st.session_state.current_user = respuesta.usuario_actual
+
+                # Agregar respuesta al historial
+                st.session_state.messages.append({
+                    "role": "assistant", 
+                    "content": respuesta.mensaje
+                })
+
+            except LLMSaturado as e:
+                # Sobrecarga o límite del proveedor: aviso temporal, no un error del chat
+                espera = f" (unos {e.reintentar_en:.0f} s)" if e.reintentar_en else ""
+                st.warning(f"⏳ {e}{espera}")
+            except Exception as e:
+                error_msg = f"❌ Error: {str(e)}"
+                st.error(error_msg)
+                st.session_state.messages.append({
+                    "role": "assistant", 
+                    "content": error_msg
+                })
     
+    # Desglose por etapa de los últimos turnos de esta sesión
+    if st.session_state.get("mostrar_depuracion"):
+        mostrar_panel_depuracion()
+
     # Información adicional
     with st.expander("ℹ️ Información y Ayuda"):
         st.markdown("""
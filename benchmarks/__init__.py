@@ -0,0 +1,6 @@
+"""
+Benchmarks del chat multi-usuario
+
+Se ejecutan desde la raíz del proyecto, por ejemplo:
+    python -m benchmarks.bench_escritura_historial
+"""
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Benchmark de arranque y de cada ejecución de la interfaz web
+
+Mide, cada uno en un proceso nuevo, el import de `chat_multi_usuario` y la
+construcción de `ChatMultiUsuario` con inicialización inmediata y perezosa
+(clientes OpenAI con una API key ficticia; no se hacen llamadas). Luego
+ejecuta `streamlit_app.py` con el `AppTest` de Streamlit: la primera
+ejecución (arranque en frío, hasta dibujar la página) y las siguientes
+(lo que cuesta cada interacción), con y sin modo depuración.
+
+Con `--presupuesto-arranque-ms` y `--presupuesto-rerun-ms` el proceso
+termina con código 1 si se superan.
+
+Uso:
+    python -m benchmarks.bench_arranque [--repeticiones 5] [--reruns 20]
+        [--presupuesto-arranque-ms 2500] [--presupuesto-rerun-ms 100]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.entorno import imprimir_resultados, redis_local
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEDIR_CONSTRUCCION = """
+import time
+inicio = time.perf_counter()
+import chat_multi_usuario
+importado = time.perf_counter()
+chat = chat_multi_usuario.ChatMultiUsuario("{redis_url}", "sk-benchmark", inicializacion_perezosa={perezosa})
+print(importado - inicio, time.perf_counter() - importado)
+"""
+
+
+def medir_en_proceso_nuevo(redis_url: str, perezosa: bool, repeticiones: int) -> dict:
+    """Mediana de import y construcción, cada repetición en un intérprete nuevo"""
+    imports, construcciones = [], []
+    codigo = MEDIR_CONSTRUCCION.format(redis_url=redis_url, perezosa=perezosa)
+    for _ in range(repeticiones):
+        salida = subprocess.run(
+            [sys.executable, "-W", "ignore", "-c", codigo],
+            cwd=RAIZ, capture_output=True, text=True, check=True,
+        ).stdout.strip().splitlines()[-1]
+        importar, construir = (float(x) for x in salida.split())
+        imports.append(importar)
+        construcciones.append(construir)
+    return {
+        "import_ms": round(statistics.median(imports) * 1000, 1),
+        "construccion_ms": round(statistics.median(construcciones) * 1000, 1),
+    }
+
+
+def medir_streamlit(reruns: int) -> dict:
+    """Primera ejecución y reruns de `streamlit_app.py` (debe correr antes de importar el chat)"""
+    from streamlit.testing.v1 import AppTest
+
+    inicio = time.perf_counter()
+    app = AppTest.from_file(os.path.join(RAIZ, "streamlit_app.py"), default_timeout=60).run()
+    primera = time.perf_counter() - inicio
+    if app.exception:
+        raise RuntimeError(f"streamlit_app.py falló: {app.exception[0].value}")
+
+    def medir_reruns() -> float:
+        tiempos = []
+        for _ in range(reruns):
+            inicio = time.perf_counter()
+            app.run()
+            tiempos.append(time.perf_counter() - inicio)
+        return round(statistics.median(tiempos) * 1000, 1)
+
+    normal = medir_reruns()
+    app.query_params["debug"] = "1"
+    depuracion = medir_reruns()
+    return {"primera_ejecucion_ms": round(primera * 1000, 1), "rerun_p50_ms": normal, "rerun_debug_p50_ms": depuracion}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeticiones", type=int, default=5, help="procesos nuevos por medición de construcción")
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--presupuesto-arranque-ms", type=float, default=2500.0)
+    parser.add_argument("--presupuesto-rerun-ms", type=float, default=100.0)
+    parser.add_argument("--redis-url", default=None)
+    args = parser.parse_args()
+
+    with redis_local(args.redis_url) as redis_url:
+        os.environ["REDIS_URL"] = redis_url
+        os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+        sys.path.insert(0, RAIZ)
+        resultados = {"streamlit": medir_streamlit(args.reruns)}
+        resultados["inmediata"] = medir_en_proceso_nuevo(redis_url, False, args.repeticiones)
+        resultados["perezosa"] = medir_en_proceso_nuevo(redis_url, True, args.repeticiones)
+
+    imprimir_resultados("Arranque", resultados)
+
+    excedidos = []
+    if resultados["streamlit"]["primera_ejecucion_ms"] > args.presupuesto_arranque_ms:
+        excedidos.append(f"arranque > {args.presupuesto_arranque_ms:.0f} ms")
+    if resultados["streamlit"]["rerun_p50_ms"] > args.presupuesto_rerun_ms:
+        excedidos.append(f"rerun > {args.presupuesto_rerun_ms:.0f} ms")
+    if excedidos:
+        print(f"❌ Presupuesto excedido: {', '.join(excedidos)}")
+        sys.exit(1)
+    print("✅ Dentro del presupuesto")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Prueba de estrés multiproceso del bloqueo por usuario
+
+Simula varias réplicas de la app: cada proceso crea su propio
+`ChatMultiUsuario(bloqueo_por_usuario=True)` con `LLMFalso`, y todos usan el
+mismo Redis. Hay dos escenarios:
+
+- Escalado: cada proceso atiende a sus propios usuarios (`--usuarios` a la
+  vez, `--turnos` cada uno) con 1, 2, 4... procesos. Como los usuarios no
+  comparten bloqueo, los turnos por segundo deberían crecer linealmente; se
+  reporta la eficiencia frente a un proceso.
+- Contención: todos los procesos envían turnos a los mismos pocos usuarios.
+  Se comprueba que no se intercala nada: cada pregunta va seguida de su
+  respuesta, no se pierde ningún turno y cada turno de un usuario vio un
+  historial distinto (0, 2, 4... mensajes). Sin bloqueo (`--sin-bloqueo`)
+  dos turnos leen el mismo historial y la comprobación falla.
+
+El proceso termina con código 1 si hay intercalado. El Redis local de prueba
+vive en el proceso principal y se satura antes que Redis real; para medir
+el escalado con más procesos usa `--redis-url`.
+
+Uso:
+    python -m benchmarks.bench_bloqueo_usuarios [--procesos 1,2,4] [--usuarios 10]
+        [--turnos 5] [--compartidos 3] [--latencia-ms 200] [--sin-bloqueo]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import sys
+import time
+
+from benchmarks.entorno import imprimir_resultados, redis_local
+
+
+def trabajador(redis_url: str, opciones: dict, usuarios: list, barrera, resultados):
+    """Una réplica: todas sus conversaciones a la vez, turnos secuenciales por conversación"""
+    from chat_multi_usuario import ChatMultiUsuario
+    from modelos import fabrica_falsa
+
+    chat = ChatMultiUsuario(
+        redis_url,
+        fabrica_modelos=fabrica_falsa(latencia_ms=opciones["latencia_ms"], tokens_respuesta=8),
+        bloqueo_por_usuario=opciones["bloqueo"],
+    )
+    historiales_vistos = []
+    chat.trazador.agregar_hook(lambda t: historiales_vistos.append((t.usuario, t.mensajes_historial)))
+    id_proceso = multiprocessing.current_process().name
+
+    async def conversacion(usuario: str):
+        sesion = chat.obtener_sesion(f"{id_proceso}-{usuario}")
+        sesion.usuario_actual = usuario
+        for turno in range(opciones["turnos"]):
+            await chat.aprocesar_mensaje(f"{id_proceso} turno {turno}", sesion)
+
+    async def ejecutar():
+        # Calienta la conexión y los modelos antes de la barrera
+        await chat.historiales.cliente().ping()
+        barrera.wait()
+        inicio = time.time()
+        await asyncio.gather(*(conversacion(u) for u in usuarios))
+        return inicio, time.time()
+
+    inicio, fin = chat._ejecutar(ejecutar())
+    resultados.put({"inicio": inicio, "fin": fin, "vistos": historiales_vistos, **chat.estadisticas_bloqueo()})
+
+
+def correr(redis_url: str, procesos: int, usuarios_por_proceso, opciones: dict) -> dict:
+    """Lanza `procesos` réplicas; `usuarios_por_proceso(i)` da los usuarios de la i-ésima"""
+    contexto = multiprocessing.get_context("spawn")
+    barrera = contexto.Barrier(procesos)
+    resultados = contexto.Queue()
+    hijos = [
+        contexto.Process(
+            target=trabajador,
+            name=f"replica{i}",
+            args=(redis_url, opciones, usuarios_por_proceso(i), barrera, resultados),
+        )
+        for i in range(procesos)
+    ]
+    for hijo in hijos:
+        hijo.start()
+    salidas = [resultados.get() for _ in hijos]
+    for hijo in hijos:
+        hijo.join()
+    duracion = max(s["fin"] for s in salidas) - min(s["inicio"] for s in salidas)
+    return {
+        "segundos": duracion,
+        "vistos": [v for s in salidas for v in s["vistos"]],
+        "esperas_bloqueo": sum(s.get("esperas", 0) for s in salidas),
+    }
+
+
+def borrar_historiales(redis_url: str, usuarios: list):
+    from historial_redis import HistorialRedis, clave_historial
+
+    historiales = HistorialRedis(redis_url)
+
+    async def borrar():
+        try:
+            await historiales.cliente().delete(*(clave_historial(u) for u in usuarios))
+        finally:
+            await historiales.acerrar()
+
+    asyncio.run(borrar())
+
+
+def verificar_intercalado(redis_url: str, vistos: list, esperados: dict) -> list:
+    """Problemas de consistencia en los historiales de los usuarios compartidos"""
+    from historial_redis import HistorialRedis
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    historiales = HistorialRedis(redis_url)
+
+    async def leer():
+        try:
+            return {u: await historiales.aobtener(u) for u in esperados}
+        finally:
+            await historiales.acerrar()
+
+    problemas = []
+    for usuario, mensajes in asyncio.run(leer()).items():
+        if len(mensajes) != 2 * esperados[usuario]:
+            problemas.append(f"{usuario}: {len(mensajes) // 2} turnos guardados de {esperados[usuario]}")
+        for pregunta, respuesta in zip(mensajes[::2], mensajes[1::2]):
+            if not (
+                isinstance(pregunta, HumanMessage)
+                and isinstance(respuesta, AIMessage)
+                and respuesta.content.startswith(f"Respuesta simulada a: {pregunta.content}")
+            ):
+                problemas.append(f"{usuario}: respuesta fuera de lugar tras {pregunta.content!r}")
+                break
+        largos = sorted(n for u, n in vistos if u == usuario)
+        if largos != list(range(0, 2 * esperados[usuario], 2)):
+            repetidos = len(largos) - len(set(largos))
+            problemas.append(f"{usuario}: {repetidos} turnos generados sin ver el turno anterior")
+    return problemas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--procesos", default="1,2,4", help="niveles separados por coma")
+    parser.add_argument("--usuarios", type=int, default=10, help="usuarios propios por proceso (escalado)")
+    parser.add_argument("--turnos", type=int, default=5, help="turnos por conversación")
+    parser.add_argument("--compartidos", type=int, default=3, help="usuarios compartidos (contención)")
+    parser.add_argument("--latencia-ms", type=float, default=200.0, help="latencia del LLM falso")
+    parser.add_argument("--sin-bloqueo", action="store_true", help="desactiva el bloqueo (muestra el intercalado)")
+    parser.add_argument("--redis-url", default=None)
+    args = parser.parse_args()
+
+    niveles = [int(n) for n in args.procesos.split(",")]
+    opciones = {"latencia_ms": args.latencia_ms, "turnos": args.turnos, "bloqueo": not args.sin_bloqueo}
+    resultados = {"escalado": {}, "contencion": {}}
+
+    with redis_local(args.redis_url) as redis_url:
+        base = None
+        for nivel in niveles:
+            borrar_historiales(redis_url, [f"escala{nivel}p{i}u{j}" for i in range(nivel) for j in range(args.usuarios)])
+            corrida = correr(
+                redis_url, nivel,
+                lambda i, nivel=nivel: [f"escala{nivel}p{i}u{j}" for j in range(args.usuarios)],
+                opciones,
+            )
+            turnos_por_segundo = nivel * args.usuarios * args.turnos / corrida["segundos"]
+            base = base or turnos_por_segundo / nivel
+            resultados["escalado"][f"procesos_{nivel}"] = {
+                "turnos_por_segundo": round(turnos_por_segundo, 1),
+                "eficiencia": f"{turnos_por_segundo / (base * nivel):.0%}",
+            }
+
+        nivel = max(niveles)
+        compartidos = [f"compartidou{j}" for j in range(args.compartidos)]
+        borrar_historiales(redis_url, compartidos)
+        corrida = correr(redis_url, nivel, lambda i: compartidos, opciones)
+        problemas = verificar_intercalado(
+            redis_url, corrida["vistos"], {u: nivel * args.turnos for u in compartidos}
+        )
+        resultados["contencion"] = {
+            "procesos": nivel,
+            "turnos": nivel * args.turnos * len(compartidos),
+            "segundos": round(corrida["segundos"], 3),
+            "esperas_bloqueo": corrida["esperas_bloqueo"],
+            "problemas": problemas,
+        }
+
+    imprimir_resultados("Bloqueo por usuario", resultados)
+    if problemas:
+        print("❌ Turnos intercalados")
+        sys.exit(1)
+    print("✅ Sin intercalado")
+
+
+if __name__ == "__main__":
+    main()
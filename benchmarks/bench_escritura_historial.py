@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Benchmark de escritura de historiales
+
+Compara el camino anterior (un cliente Redis nuevo por turno y un LPUSH por
+mensaje, como hacía `RedisChatMessageHistory`) con la escritura pipelined
+MULTI/EXEC de `HistorialRedis`, y la importación masiva contra la carga
+mensaje a mensaje. El camino anterior se reproduce con `redis.from_url`
+porque `RedisChatMessageHistory` además envía un INFO por cliente que el
+servidor de prueba no soporta; la comparación es, por tanto, conservadora.
+
+Uso:
+    python -m benchmarks.bench_escritura_historial [--turnos 500] [--redis-url URL]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import redis
+from langchain_core.messages import AIMessage, HumanMessage, message_to_dict
+
+from benchmarks.entorno import imprimir_resultados, percentiles, redis_local
+from historial_redis import HistorialRedis
+
+
+def agregar_por_mensaje(redis_url: str, clave: str, mensajes: list):
+    """Camino anterior: cliente nuevo y un LPUSH por mensaje"""
+    cliente = redis.from_url(redis_url)
+    for mensaje in mensajes:
+        cliente.lpush(clave, json.dumps(message_to_dict(mensaje)))
+    cliente.close()
+
+
+def escribir_por_mensaje(redis_url: str, turnos: int) -> list:
+    """Camino anterior: cliente nuevo por turno y dos LPUSH separados"""
+    latencias = []
+    for i in range(turnos):
+        inicio = time.perf_counter()
+        agregar_por_mensaje(
+            redis_url,
+            "message_store:usuario_bench_a",
+            [HumanMessage(content=f"mensaje {i}"), AIMessage(content=f"respuesta {i}")],
+        )
+        latencias.append(time.perf_counter() - inicio)
+    return latencias
+
+
+async def escribir_pipeline(historiales: HistorialRedis, turnos: int) -> list:
+    """Camino nuevo: pregunta y respuesta en una transacción pipelined"""
+    latencias = []
+    for i in range(turnos):
+        inicio = time.perf_counter()
+        await historiales.aagregar(
+            "bench_b",
+            [HumanMessage(content=f"mensaje {i}"), AIMessage(content=f"respuesta {i}")],
+        )
+        latencias.append(time.perf_counter() - inicio)
+    return latencias
+
+
+def conversaciones_sinteticas(usuarios: int, mensajes: int) -> dict:
+    return {
+        f"import_{u}": [
+            HumanMessage(content=f"pregunta {i}") if i % 2 == 0 else AIMessage(content=f"respuesta {i}")
+            for i in range(mensajes)
+        ]
+        for u in range(usuarios)
+    }
+
+
+def ejecutar(redis_url: str, turnos: int, usuarios: int, mensajes: int) -> dict:
+    resultados = {}
+
+    por_mensaje = escribir_por_mensaje(redis_url, turnos)
+    resultados["turno_por_mensaje"] = {
+        **percentiles(por_mensaje),
+        "turnos_por_segundo": round(turnos / sum(por_mensaje), 1),
+    }
+
+    async def medir_async():
+        historiales = HistorialRedis(redis_url)
+        pipeline = await escribir_pipeline(historiales, turnos)
+
+        conversaciones = conversaciones_sinteticas(usuarios, mensajes)
+        inicio = time.perf_counter()
+        escritos = await historiales.aimportar(conversaciones)
+        duracion_import = time.perf_counter() - inicio
+        await historiales.acerrar()
+        return pipeline, escritos, duracion_import
+
+    pipeline, escritos, duracion_import = asyncio.run(medir_async())
+    resultados["turno_pipeline"] = {
+        **percentiles(pipeline),
+        "turnos_por_segundo": round(turnos / sum(pipeline), 1),
+    }
+    resultados["aceleracion_turno"] = round(sum(por_mensaje) / sum(pipeline), 2)
+
+    # Importación masiva frente a escribir cada mensaje con el camino anterior
+    inicio = time.perf_counter()
+    for nombre, lista in conversaciones_sinteticas(usuarios, mensajes).items():
+        agregar_por_mensaje(redis_url, f"message_store:usuario_lento_{nombre}", lista)
+    duracion_lenta = time.perf_counter() - inicio
+
+    resultados["importacion"] = {
+        "mensajes": escritos,
+        "segundos_masiva": round(duracion_import, 4),
+        "segundos_por_mensaje": round(duracion_lenta, 4),
+        "aceleracion": round(duracion_lenta / duracion_import, 2),
+    }
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turnos", type=int, default=500)
+    parser.add_argument("--usuarios", type=int, default=200)
+    parser.add_argument("--mensajes", type=int, default=20)
+    parser.add_argument("--redis-url", default=None)
+    args = parser.parse_args()
+
+    with redis_local(args.redis_url) as redis_url:
+        resultados = ejecutar(redis_url, args.turnos, args.usuarios, args.mensajes)
+    imprimir_resultados("Escritura de historiales", resultados)
+
+
+if __name__ == "__main__":
+    main()
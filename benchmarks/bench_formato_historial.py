@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Benchmark del formato de historiales en Redis
+
+Para varios largos de historial compara el formato de LangChain, el formato
+compacto y el compacto con los mensajes antiguos archivados en segmentos
+comprimidos. Mide los bytes guardados por usuario (suma de los elementos,
+sin el sobrecosto interno de Redis) y la latencia de leer el historial
+completo (`aobtener`, sin caché) y los últimos mensajes (`aobtener_recientes`).
+
+Uso:
+    python -m benchmarks.bench_formato_historial [--largos 100,1000,5000] [--lecturas 50]
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+import formato_historial
+from benchmarks.entorno import imprimir_resultados, percentiles, redis_local
+from historial_redis import HistorialRedis, clave_archivados, clave_archivo, clave_historial
+
+VARIANTES = ("langchain", "compacto", "compacto_archivado")
+
+
+# Vocabulario para texto sintético: repetir una frase fija comprimiría de forma irreal
+VOCABULARIO = (
+    "el la de que y en un una los las por para con sobre como pero más muy también "
+    "viaje trabajo proyecto reunión correo informe cliente precio fecha semana mañana "
+    "recordar preferencia comida música película libro ciudad hotel vuelo horario "
+    "puedes ayudarme necesito quiero saber explicar resumir calcular comparar revisar "
+    "gracias perfecto claro entiendo importante ejemplo opción paso primero después "
+    "datos tabla archivo versión error cambio nuevo anterior siguiente final"
+).split()
+
+
+def conversacion(largo: int) -> list:
+    """Mensajes con largo realista (~25 palabras por pregunta, ~60 por respuesta)"""
+    azar = random.Random(largo)
+
+    def texto(palabras: int) -> str:
+        return " ".join(azar.choice(VOCABULARIO) for _ in range(palabras)).capitalize() + "."
+
+    return [
+        HumanMessage(content=texto(25)) if i % 2 == 0 else AIMessage(content=texto(60))
+        for i in range(largo)
+    ]
+
+
+async def bytes_guardados(historiales: HistorialRedis, usuario: str) -> int:
+    cliente = historiales.cliente()
+    items = await cliente.lrange(clave_historial(usuario), 0, -1)
+    segmentos = await cliente.lrange(clave_archivo(usuario), 0, -1)
+    return sum(len(m) for m in items) + sum(len(s) for s in segmentos)
+
+
+async def medir(redis_url: str, variante: str, largo: int, lecturas: int, recientes: int) -> dict:
+    formato = "langchain" if variante == "langchain" else "compacto"
+    historiales = HistorialRedis(redis_url, formato=formato)
+    usuario = f"bench_formato_{variante}_{largo}"
+    await historiales.cliente().delete(clave_historial(usuario), clave_archivo(usuario), clave_archivados(usuario))
+    await historiales.aimportar({usuario: conversacion(largo)})
+    if variante == "compacto_archivado":
+        await historiales.aarchivar(usuario, recientes)
+
+    completo = []
+    for _ in range(lecturas):
+        inicio = time.perf_counter()
+        mensajes = await historiales.aobtener(usuario)
+        completo.append(time.perf_counter() - inicio)
+    assert len(mensajes) == largo
+
+    ultimos = []
+    for _ in range(lecturas):
+        inicio = time.perf_counter()
+        await historiales.aobtener_recientes(usuario, recientes)
+        ultimos.append(time.perf_counter() - inicio)
+
+    resultado = {
+        "bytes": await bytes_guardados(historiales, usuario),
+        "completo": {k: v for k, v in percentiles(completo).items() if k in ("p50_ms", "p99_ms")},
+        "recientes": {k: v for k, v in percentiles(ultimos).items() if k in ("p50_ms", "p99_ms")},
+    }
+    await historiales.acerrar()
+    return resultado
+
+
+async def ejecutar(redis_url: str, largos: list, lecturas: int, recientes: int) -> dict:
+    resultados = {
+        "bibliotecas": {
+            "msgpack": formato_historial.msgpack is not None,
+            "zstandard": formato_historial.zstandard is not None,
+        }
+    }
+    for largo in largos:
+        por_variante = {}
+        for variante in VARIANTES:
+            por_variante[variante] = await medir(redis_url, variante, largo, lecturas, recientes)
+        base = por_variante["langchain"]["bytes"]
+        for datos in por_variante.values():
+            datos["bytes_vs_langchain"] = f"{datos['bytes'] / base:.1%}"
+        resultados[f"mensajes_{largo}"] = por_variante
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--largos", default="100,1000,5000", help="largos de historial separados por coma")
+    parser.add_argument("--lecturas", type=int, default=50, help="lecturas por medición")
+    parser.add_argument("--recientes", type=int, default=20, help="mensajes sin archivar / leídos como recientes")
+    parser.add_argument("--redis-url", default=None)
+    args = parser.parse_args()
+
+    largos = [int(n) for n in args.largos.split(",")]
+    with redis_local(args.redis_url) as redis_url:
+        resultados = asyncio.run(ejecutar(redis_url, largos, args.lecturas, args.recientes))
+    imprimir_resultados("Formato de historiales", resultados)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Benchmark del modo fusionado (detección y respuesta en una sola llamada)
+
+Recorre las conversaciones etiquetadas de `fixtures/deteccion_usuarios.json`
+con el flujo de dos llamadas (detector + chat) y con `modo_fusionado=True`.
+Después de cada turno compara el usuario de la sesión con el esperado y
+reporta por modo: precisión de la detección, latencia por turno (p50/p95),
+llamadas al LLM y tokens por turno (de las trazas) y, en el modo fusionado,
+cuántas respuestas hubo que regenerar por cambio de usuario.
+
+La precisión se separa según quién resolvió el turno:
+
+- precision_reglas: turnos que resolvió `DetectorLocal`
+- precision_llm / precision: turnos que pasaron por el LLM, solo con un modelo
+  real (`--grabar`) o una grabación suya (`--grabaciones`). Con `LLMFalso`,
+  que detecta con las mismas reglas, quedan en null junto con los turnos
+  siguientes de la misma conversación: sirve para comparar latencia y
+  llamadas, no la precisión de un modelo.
+
+    # Graba las salidas y latencias reales de cada cadena (usa OPENAI_API_KEY)
+    python -m benchmarks.bench_fusionado --grabar benchmarks/fixtures/grabacion_fusionado.json
+    # Reproduce una grabación sin red, con las mismas latencias
+    python -m benchmarks.bench_fusionado --grabaciones grabacion.json
+
+Si existe `fixtures/grabacion_fusionado.json` se reproduce por defecto
+(`--sin-grabacion` fuerza `LLMFalso`); al cambiar los prompts o las
+conversaciones hay que volver a grabarla.
+
+Cada modo corre contra un Redis vacío (el local de prueba); con
+`--redis-url` los historiales de una corrida quedan para la siguiente.
+
+Uso:
+    python -m benchmarks.bench_fusionado [--latencia-ms 300] [--sin-deteccion-local]
+        [--grabar archivo.json | --grabaciones archivo.json | --sin-grabacion]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from langchain_core.runnables import Runnable, RunnableLambda
+
+from benchmarks.entorno import imprimir_resultados, percentiles, redis_local
+from chat_multi_usuario import ChatMultiUsuario, DeteccionUsuario, RespuestaChat, RespuestaFusionada
+from modelos import fabrica_falsa, fabrica_openai
+from trazas import traza_actual
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "deteccion_usuarios.json")
+GRABACION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "grabacion_fusionado.json")
+MODOS = ("dos_llamadas", "fusionado")
+CADENAS = {"cadena_detector": DeteccionUsuario, "cadena_chat": RespuestaChat, "cadena_fusionada": RespuestaFusionada}
+
+
+def clave_grabacion(cadena: str, entradas: dict) -> str:
+    return f"{cadena}:{entradas.get('usuario_actual') or ''}:{entradas.get('input') or entradas.get('mensaje')}"
+
+
+def grabadora(cadena: str, original: Runnable, grabaciones: dict) -> Runnable:
+    """Envuelve una cadena real y guarda su salida, latencia y tokens"""
+
+    async def invocar(entradas: dict):
+        traza = traza_actual()
+        tokens_antes = (traza.tokens_entrada, traza.tokens_salida) if traza else (0, 0)
+        inicio = time.perf_counter()
+        salida = await original.ainvoke(entradas)
+        grabaciones[clave_grabacion(cadena, entradas)] = {
+            "salida": salida.model_dump(),
+            "segundos": time.perf_counter() - inicio,
+            "tokens_entrada": traza.tokens_entrada - tokens_antes[0] if traza else 0,
+            "tokens_salida": traza.tokens_salida - tokens_antes[1] if traza else 0,
+        }
+        return salida
+
+    return RunnableLambda(invocar)
+
+
+def cadena_grabada(cadena: str, grabaciones: dict) -> Runnable:
+    """Reproduce una cadena grabada: misma salida, misma latencia y mismos tokens"""
+
+    async def invocar(entradas: dict):
+        clave = clave_grabacion(cadena, entradas)
+        if clave not in grabaciones:
+            raise KeyError(f"Sin grabación para {clave!r}: vuelve a grabar con --grabar")
+        grabada = grabaciones[clave]
+        await asyncio.sleep(grabada["segundos"])
+        traza = traza_actual()
+        if traza is not None:
+            traza.llamadas_llm += 1
+            traza.tokens_entrada += grabada["tokens_entrada"]
+            traza.tokens_salida += grabada["tokens_salida"]
+        return CADENAS[cadena].model_validate(grabada["salida"])
+
+    return RunnableLambda(invocar)
+
+
+def precision(aciertos: int, total: int):
+    return round(aciertos / total, 3) if total else None
+
+
+async def recorrer(chat: ChatMultiUsuario, conversaciones: list, puntuar_llm: bool) -> dict:
+    """Recorre las conversaciones; los turnos del LLM solo se puntúan con `puntuar_llm`"""
+    trazas = []
+    chat.trazador.agregar_hook(trazas.append)
+    latencias, errores = [], []
+    # origen -> [aciertos, turnos]
+    conteo = {"reglas": [0, 0], "llm": [0, 0]}
+
+    for conversacion in conversaciones:
+        sesion = chat.obtener_sesion(f"bench-fusion-{conversacion['nombre']}")
+        # Tras un turno del LLM el usuario de la sesión depende de su respuesta:
+        # sin modelo real, el resto de la conversación tampoco se puntúa
+        via_llm = False
+        for turno in conversacion["turnos"]:
+            locales = chat.estadisticas_deteccion().get("aciertos", 0)
+            inicio = time.perf_counter()
+            await chat.aprocesar_mensaje(turno["mensaje"], sesion)
+            latencias.append(time.perf_counter() - inicio)
+            origen = "reglas" if chat.estadisticas_deteccion().get("aciertos", 0) > locales else "llm"
+            via_llm = via_llm or origen == "llm"
+            if via_llm and not puntuar_llm:
+                continue
+            esperado, obtenido = turno["usuario"], sesion.usuario_actual
+            conteo[origen][1] += 1
+            if (esperado or "").lower() == (obtenido or "").lower():
+                conteo[origen][0] += 1
+            else:
+                errores.append(
+                    f"{conversacion['nombre']} ({origen}): {turno['mensaje']!r} -> {obtenido} (esperado {esperado})"
+                )
+
+    total = len(latencias)
+    lat = percentiles(latencias)
+    return {
+        "precision": precision(*map(sum, zip(*conteo.values()))) if puntuar_llm else None,
+        "precision_reglas": precision(*conteo["reglas"]),
+        "precision_llm": precision(*conteo["llm"]) if puntuar_llm else None,
+        "turnos_puntuados": conteo["reglas"][1] + conteo["llm"][1],
+        "turnos_sin_puntuar": total - conteo["reglas"][1] - conteo["llm"][1],
+        "p50_ms": lat["p50_ms"],
+        "p95_ms": lat["p95_ms"],
+        "llamadas_llm_por_turno": round(sum(t.llamadas_llm for t in trazas) / total, 2),
+        "tokens_por_turno": round(sum(t.tokens_entrada + t.tokens_salida for t in trazas) / total, 1),
+        "regeneradas": chat.estadisticas_fusion()["regeneradas"],
+        "errores": errores,
+    }
+
+
+def ejecutar_modo(args, modo: str, redis_url: str, conversaciones: list, grabaciones: dict) -> dict:
+    if args.grabar:
+        fabrica = fabrica_openai(os.getenv("OPENAI_API_KEY"))
+    else:
+        fabrica = fabrica_falsa(latencia_ms=args.latencia_ms, tokens_respuesta=args.tokens_respuesta)
+    chat = ChatMultiUsuario(
+        redis_url,
+        fabrica_modelos=fabrica,
+        deteccion_local=not args.sin_deteccion_local,
+        modo_fusionado=modo == "fusionado",
+        inicializacion_perezosa=True,
+    )
+    for cadena in CADENAS:
+        if args.grabar:
+            setattr(chat, cadena, grabadora(cadena, getattr(chat, cadena), grabaciones))
+        elif args.grabaciones:
+            setattr(chat, cadena, cadena_grabada(cadena, grabaciones))
+    return chat._ejecutar(recorrer(chat, conversaciones, puntuar_llm=bool(args.grabar or args.grabaciones)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", default=FIXTURES)
+    parser.add_argument("--latencia-ms", type=float, default=300.0, help="latencia del LLM falso")
+    parser.add_argument("--tokens-respuesta", type=int, default=60)
+    parser.add_argument("--sin-deteccion-local", action="store_true", help="todos los mensajes pasan por el LLM")
+    parser.add_argument("--grabar", default=None, help="archivo donde guardar las salidas reales")
+    parser.add_argument("--grabaciones", default=None, help="archivo grabado a reproducir")
+    parser.add_argument("--sin-grabacion", action="store_true", help="usar LLMFalso aunque exista la grabación")
+    parser.add_argument("--redis-url", default=None)
+    args = parser.parse_args()
+
+    with open(args.fixtures, encoding="utf-8") as f:
+        conversaciones = json.load(f)["conversaciones"]
+    if not (args.grabar or args.grabaciones or args.sin_grabacion) and os.path.exists(GRABACION):
+        args.grabaciones = GRABACION
+    if not (args.grabar or args.grabaciones):
+        print("⚠️ Sin grabación de un modelo real: solo se puntúan los turnos resueltos por reglas")
+    grabaciones = {}
+    if args.grabaciones:
+        with open(args.grabaciones, encoding="utf-8") as f:
+            grabaciones = json.load(f)
+
+    resultados = {}
+    for modo in MODOS:
+        with redis_local(args.redis_url) as redis_url:
+            resultados[modo] = ejecutar_modo(args, modo, redis_url, conversaciones, grabaciones)
+
+    if args.grabar:
+        with open(args.grabar, "w", encoding="utf-8") as f:
+            json.dump(grabaciones, f, ensure_ascii=False, indent=2)
+        print(f"💾 {len(grabaciones)} llamadas grabadas en {args.grabar}")
+
+    imprimir_resultados("Modo fusionado", resultados)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Benchmark de micro-lotes del detector
+
+Simula muchas sesiones concurrentes que consultan al detector y compara una
+llamada por mensaje con `AgrupadorLotes`. El LLM es un falso local que
+modela un backend con concurrencia limitada y un costo fijo por petición
+más un costo pequeño por entrada (como un servidor de inferencia que acepta
+lotes), de modo que corre sin red. Con la API de chat de OpenAI, `abatch`
+reparte las entradas en llamadas concurrentes, así que la ganancia depende
+de que el backend procese lotes.
+
+Uso:
+    python -m benchmarks.bench_lotes_detector [--sesiones 64] [--mensajes 20] [--ventana-ms 5]
+"""
+
+import argparse
+import asyncio
+import time
+
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable
+
+from benchmarks.entorno import imprimir_resultados, percentiles
+from chat_multi_usuario import DeteccionUsuario
+from lotes_detector import AgrupadorLotes
+
+
+class DetectorFalso(Runnable):
+    """LLM detector local: latencia fija por petición + por entrada, concurrencia limitada"""
+
+    def __init__(self, base_ms: float = 40.0, por_entrada_ms: float = 1.0, max_concurrencia: int = 8):
+        self.base_ms = base_ms
+        self.por_entrada_ms = por_entrada_ms
+        self.max_concurrencia = max_concurrencia
+        self._semaforo = None
+        self.peticiones = 0
+
+    def _resultado(self, entrada) -> DeteccionUsuario:
+        return DeteccionUsuario(usuario_identificado=False, nombre_usuario=None, tipo_identificacion="ninguna")
+
+    async def _apeticion(self, entradas: list) -> list:
+        if self._semaforo is None:
+            self._semaforo = asyncio.Semaphore(self.max_concurrencia)
+        async with self._semaforo:
+            self.peticiones += 1
+            await asyncio.sleep((self.base_ms + self.por_entrada_ms * len(entradas)) / 1000)
+        return [self._resultado(e) for e in entradas]
+
+    def invoke(self, entrada, config=None, **kwargs):
+        return asyncio.run(self.ainvoke(entrada, config))
+
+    async def ainvoke(self, entrada, config=None, **kwargs):
+        return (await self._apeticion([entrada]))[0]
+
+    async def abatch(self, entradas, config=None, *, return_exceptions=False, **kwargs):
+        return await self._apeticion(list(entradas))
+
+
+async def generar_carga(invocar, sesiones: int, mensajes: int) -> tuple:
+    """Cada sesión envía sus mensajes uno tras otro; devuelve (latencias, segundos)"""
+    latencias = []
+
+    async def sesion(i):
+        for j in range(mensajes):
+            inicio = time.perf_counter()
+            await invocar({"mensaje": f"sesión {i} mensaje {j}"})
+            latencias.append(time.perf_counter() - inicio)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(sesion(i) for i in range(sesiones)))
+    return latencias, time.perf_counter() - inicio
+
+
+async def ejecutar(sesiones: int, mensajes: int, ventana_ms: float, max_lote: int, base_ms: float) -> dict:
+    prompt = ChatPromptTemplate.from_template("Mensaje: {mensaje}")
+    resultados = {}
+
+    falso = DetectorFalso(base_ms=base_ms)
+    cadena = prompt | falso
+    latencias, segundos = await generar_carga(cadena.ainvoke, sesiones, mensajes)
+    resultados["sin_lotes"] = {
+        **percentiles(latencias),
+        "detecciones_por_segundo": round(len(latencias) / segundos, 1),
+        "peticiones_llm": falso.peticiones,
+    }
+
+    falso = DetectorFalso(base_ms=base_ms)
+    agrupador = AgrupadorLotes(prompt | falso, ventana_ms=ventana_ms, max_lote=max_lote)
+    latencias, segundos_lotes = await generar_carga(agrupador.ainvocar, sesiones, mensajes)
+    resultados["con_lotes"] = {
+        **percentiles(latencias),
+        "detecciones_por_segundo": round(len(latencias) / segundos_lotes, 1),
+        "peticiones_llm": falso.peticiones,
+        **agrupador.estadisticas(),
+    }
+    resultados["aceleracion"] = round(segundos / segundos_lotes, 2)
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sesiones", type=int, default=64)
+    parser.add_argument("--mensajes", type=int, default=20)
+    parser.add_argument("--ventana-ms", type=float, default=5.0)
+    parser.add_argument("--max-lote", type=int, default=16)
+    parser.add_argument("--latencia-ms", type=float, default=40.0, help="costo fijo por petición del LLM falso")
+    args = parser.parse_args()
+
+    resultados = asyncio.run(
+        ejecutar(args.sesiones, args.mensajes, args.ventana_ms, args.max_lote, args.latencia_ms)
+    )
+    imprimir_resultados("Micro-lotes del detector", resultados)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Benchmark de sobrecarga de la pasarela del LLM
+
+Un `ServidorFalso` acepta como mucho `--capacidad` llamadas a la vez y
+responde 429 al resto (más un porcentaje al azar con `--tasa-429`). N
+clientes envían turnos sin pausa durante `--segundos`, cada uno con su
+usuario, con tres configuraciones de `PasarelaLLM`:
+
+- sin_pasarela: sin límite, sin reintentos ni cortocircuito (el error llega al usuario)
+- solo_reintentos: reintentos con backoff pero sin límite de concurrencia
+- pasarela: límite de concurrencia igual a la capacidad, cola con plazo y reintentos
+
+Por nivel de carga reporta turnos exitosos por segundo, porcentaje de
+errores y de rechazos de la pasarela, latencia p50/p95 de los turnos
+exitosos, y cuántos segundos de la corrida tuvieron algún error (fallas en
+ráfaga frente a degradación suave).
+
+Uso:
+    python -m benchmarks.bench_pasarela_llm [--clientes 4,16,64] [--segundos 5]
+        [--capacidad 8] [--latencia-ms 200] [--tasa-429 0.0]
+"""
+
+import argparse
+import asyncio
+import time
+
+from benchmarks.entorno import imprimir_resultados, percentiles, redis_local
+from chat_multi_usuario import ChatMultiUsuario
+from modelos import ServidorFalso, fabrica_falsa
+from pasarela_llm import LLMSaturado, PasarelaLLM
+
+
+def configuraciones(capacidad: int) -> dict:
+    return {
+        "sin_pasarela": lambda: PasarelaLLM(max_concurrencia=None, max_reintentos=0, umbral_circuito=None),
+        "solo_reintentos": lambda: PasarelaLLM(max_concurrencia=None, espera_base=0.1, umbral_circuito=None),
+        "pasarela": lambda: PasarelaLLM(max_concurrencia=capacidad, plazo_segundos=5.0, espera_base=0.1),
+    }
+
+
+async def cargar(chat: ChatMultiUsuario, clientes: int, segundos: float, prefijo: str) -> dict:
+    latencias, eventos = [], []  # eventos: (segundo, "ok" | "error" | "rechazo")
+    inicio = time.perf_counter()
+    fin = inicio + segundos
+
+    async def cliente(i: int):
+        sesion = chat.obtener_sesion(f"{prefijo}-{i}")
+        sesion.usuario_actual = f"{prefijo}c{i}"
+        turno = 0
+        while time.perf_counter() < fin:
+            turno += 1
+            t0 = time.perf_counter()
+            try:
+                await chat.aprocesar_mensaje(f"pregunta número {turno}", sesion)
+                latencias.append(time.perf_counter() - t0)
+                resultado = "ok"
+            except LLMSaturado:
+                resultado = "rechazo"
+            except Exception:
+                resultado = "error"
+            eventos.append((int(time.perf_counter() - inicio), resultado))
+            if resultado != "ok":
+                # El usuario vuelve a intentar tras un momento
+                await asyncio.sleep(0.1)
+
+    await asyncio.gather(*(cliente(i) for i in range(clientes)))
+    duracion = time.perf_counter() - inicio
+    total = len(eventos)
+    conteo = {r: sum(1 for _, e in eventos if e == r) for r in ("ok", "error", "rechazo")}
+    lat = percentiles(latencias)
+    return {
+        "exitosos_por_segundo": round(conteo["ok"] / duracion, 1),
+        "errores": f"{conteo['error'] / total:.1%}" if total else "0%",
+        "rechazos": f"{conteo['rechazo'] / total:.1%}" if total else "0%",
+        "p50_ms": lat["p50_ms"],
+        "p95_ms": lat["p95_ms"],
+        "segundos_con_errores": len({s for s, e in eventos if e == "error"}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clientes", default="4,16,64", help="niveles de carga separados por coma")
+    parser.add_argument("--segundos", type=float, default=5.0, help="duración de cada corrida")
+    parser.add_argument("--capacidad", type=int, default=8, help="llamadas simultáneas que acepta el servidor")
+    parser.add_argument("--latencia-ms", type=float, default=200.0)
+    parser.add_argument("--tasa-429", type=float, default=0.0, help="fracción de 429 al azar")
+    parser.add_argument("--redis-url", default=None)
+    args = parser.parse_args()
+
+    resultados = {}
+    with redis_local(args.redis_url) as redis_url:
+        for nombre, crear in configuraciones(args.capacidad).items():
+            pasarela = crear()
+            servidor = ServidorFalso(max_concurrentes=args.capacidad, tasa_429=args.tasa_429)
+            chat = ChatMultiUsuario(
+                redis_url,
+                fabrica_modelos=fabrica_falsa(latencia_ms=args.latencia_ms, servidor=servidor),
+                pasarela_llm=pasarela,
+                max_mensajes_contexto=10,
+            )
+            por_nivel = {}
+            for clientes in (int(n) for n in args.clientes.split(",")):
+                por_nivel[f"clientes_{clientes}"] = chat._ejecutar(
+                    cargar(chat, clientes, args.segundos, f"{nombre}{clientes}")
+                )
+            estadisticas = pasarela.estadisticas()
+            por_nivel["pasarela"] = {
+                k: estadisticas[k] for k in ("max_en_cola", "reintentos", "rechazos", "aperturas_circuito")
+            }
+            por_nivel["servidor"] = servidor.estadisticas()
+            resultados[nombre] = por_nivel
+
+    imprimir_resultados("Pasarela del LLM bajo sobrecarga", resultados)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Benchmark y prueba de carga del pipeline de chat
+
+Ejecuta `aprocesar_mensaje` de punta a punta con N usuarios simulados, cada
+uno con su sesión e historial precargado, para varios niveles de concurrencia.
+Usa un Redis local de prueba y `LLMFalso`, así que mide el costo propio de la
+orquestación (detección, Redis, armado del prompt) y no el del proveedor.
+
+Por nivel reporta turnos por segundo, percentiles de latencia, round trips a
+Redis y bytes por turno (medidos en la conexión) y tokens de prompt por turno.
+Los resultados se guardan en JSON y, con `--base`, se comparan contra una
+corrida anterior: las métricas que empeoran más que `--tolerancia` se marcan
+como regresión y el proceso termina con código 1.
+
+Con `--cache-respuestas memoria|redis` se activa la caché de respuestas y
+`--repetidas` es la fracción de turnos que repiten una frase corriente
+("hola", "¿cómo estás?", ...) en medio de la conversación; por nivel se
+reporta la tasa de aciertos de la caché.
+
+Uso:
+    python -m benchmarks.bench_pipeline [--usuarios 50] [--turnos 10] [--historial 40]
+        [--concurrencia 1,8,32] [--salida resultados.json] [--base base.json]
+        [--cache-respuestas memoria --repetidas 0.3]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import string
+import sys
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage
+from redis.asyncio.connection import Connection
+
+from benchmarks.entorno import imprimir_resultados, percentiles, redis_local
+from chat_multi_usuario import ChatMultiUsuario
+from modelos import fabrica_falsa
+
+# Métricas donde subir es mejor; en el resto (latencias, costo por turno) subir es peor
+METRICAS_MAYOR_ES_MEJOR = {"turnos_por_segundo"}
+METRICAS_COMPARADAS = (
+    "turnos_por_segundo",
+    "p50_ms",
+    "p99_ms",
+    "round_trips_por_turno",
+    "bytes_por_turno",
+    "tokens_prompt_por_turno",
+)
+
+# Frases que se repiten en una conversación real (con variantes de escritura)
+FRASES_REPETIDAS = ("hola", "Hola!", "¿cómo estás?", "como estas", "gracias", "¿qué hora es?")
+
+
+class ConexionContada(Connection):
+    """Conexión Redis que cuenta round trips y bytes enviados/recibidos"""
+
+    contadores = {"round_trips": 0, "bytes_enviados": 0, "bytes_recibidos": 0}
+
+    async def send_packed_command(self, command, check_health: bool = True):
+        self.contadores["round_trips"] += 1
+        if isinstance(command, (bytes, str)):
+            self.contadores["bytes_enviados"] += len(command)
+        else:
+            command = list(command)
+            self.contadores["bytes_enviados"] += sum(len(parte) for parte in command)
+        await super().send_packed_command(command, check_health)
+
+    async def read_response(self, *args, **kwargs):
+        respuesta = await super().read_response(*args, **kwargs)
+        self.contadores["bytes_recibidos"] += _tamano(respuesta)
+        return respuesta
+
+
+def _tamano(respuesta) -> int:
+    """Bytes de payload de una respuesta RESP ya decodificada"""
+    if isinstance(respuesta, (bytes, str)):
+        return len(respuesta)
+    if isinstance(respuesta, (list, tuple)):
+        return sum(_tamano(r) for r in respuesta)
+    if isinstance(respuesta, dict):
+        return sum(_tamano(k) + _tamano(v) for k, v in respuesta.items())
+    return 8
+
+
+def nombre_sintetico(prefijo: str, indice: int) -> str:
+    """Nombre solo con letras (el detector local no acepta dígitos en nombres)"""
+    letras = ""
+    indice += 1
+    while indice:
+        indice, resto = divmod(indice - 1, 26)
+        letras = string.ascii_lowercase[resto] + letras
+    return f"{prefijo.capitalize()}{letras}"
+
+
+async def ejecutar_nivel(
+    chat: ChatMultiUsuario, nivel: int, usuarios: int, turnos: int, historial: int, repetidas: float = 0.0
+) -> dict:
+    """Corre `usuarios` conversaciones con `nivel` usuarios a la vez"""
+    prefijo = f"bench{string.ascii_lowercase[nivel % 26]}"
+    nombres = [nombre_sintetico(prefijo, i) for i in range(usuarios)]
+    if historial:
+        await chat.historiales.aimportar({
+            nombre: [
+                HumanMessage(content=f"mensaje previo {j} de {nombre}") if j % 2 == 0
+                else AIMessage(content=f"respuesta previa {j} para {nombre}")
+                for j in range(historial)
+            ]
+            for nombre in nombres
+        })
+
+    contexto_antes = chat.estadisticas_contexto()
+    cache_antes = chat.estadisticas_cache_respuestas()
+    redis_antes = dict(ConexionContada.contadores)
+    latencias = []
+    semaforo = asyncio.Semaphore(nivel)
+
+    async def conversacion(nombre: str):
+        async with semaforo:
+            sesion = chat.obtener_sesion(f"{prefijo}-{nombre}")
+            azar = random.Random(nombre)
+            for j in range(turnos):
+                if j == 0:
+                    mensaje = f"Soy {nombre}"
+                elif azar.random() < repetidas:
+                    mensaje = azar.choice(FRASES_REPETIDAS)
+                else:
+                    mensaje = f"cuéntame algo sobre el tema {j}"
+                inicio = time.perf_counter()
+                await chat.aprocesar_mensaje(mensaje, sesion)
+                latencias.append(time.perf_counter() - inicio)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(conversacion(n) for n in nombres))
+    duracion = time.perf_counter() - inicio
+
+    contexto = chat.estadisticas_contexto()
+    total = len(latencias)
+    redis = {k: ConexionContada.contadores[k] - redis_antes[k] for k in redis_antes}
+    turnos_con_prompt = contexto["turnos"] - contexto_antes["turnos"]
+    tokens = contexto["tokens_prompt"] - contexto_antes["tokens_prompt"]
+    resultado = {
+        "turnos": total,
+        "segundos": round(duracion, 3),
+        "turnos_por_segundo": round(total / duracion, 1),
+        **percentiles(latencias),
+        "round_trips_por_turno": round(redis["round_trips"] / total, 2),
+        "bytes_por_turno": round((redis["bytes_enviados"] + redis["bytes_recibidos"]) / total, 1),
+        "tokens_prompt_por_turno": round(tokens / turnos_con_prompt, 1) if turnos_con_prompt else 0.0,
+    }
+    if chat.cache_respuestas is not None:
+        cache = chat.estadisticas_cache_respuestas()
+        aciertos = sum(cache[k] - cache_antes[k] for k in ("aciertos_exactos", "aciertos_semanticos"))
+        consultas = aciertos + cache["fallos"] - cache_antes["fallos"]
+        resultado["aciertos_cache_respuestas"] = aciertos
+        resultado["tasa_aciertos_cache_respuestas"] = round(aciertos / consultas, 3) if consultas else 0.0
+    return resultado
+
+
+def comparar(resultados: dict, base: dict, tolerancia: float) -> dict:
+    """Diferencia relativa por métrica contra la base; marca las regresiones"""
+    comparacion = {}
+    for nivel, actual in resultados.items():
+        anterior = base.get(nivel)
+        if not anterior:
+            continue
+        for metrica in METRICAS_COMPARADAS:
+            if not anterior.get(metrica):
+                continue
+            cambio = (actual[metrica] - anterior[metrica]) / anterior[metrica]
+            empeora = -cambio if metrica in METRICAS_MAYOR_ES_MEJOR else cambio
+            comparacion[f"{nivel}.{metrica}"] = {
+                "base": anterior[metrica],
+                "actual": actual[metrica],
+                "cambio": f"{cambio:+.1%}",
+                "regresion": empeora > tolerancia,
+            }
+    return comparacion
+
+
+def ejecutar(args, redis_url: str) -> dict:
+    chat = ChatMultiUsuario(
+        redis_url,
+        fabrica_modelos=fabrica_falsa(latencia_ms=args.latencia_ms, tokens_respuesta=args.tokens_respuesta),
+        max_mensajes_contexto=args.max_mensajes_contexto,
+        cache_usuarios=args.cache_usuarios,
+        cache_respuestas=args.cache_respuestas,
+    )
+    chat.historiales.opciones_pool = {"connection_class": ConexionContada}
+
+    resultados = {}
+    for nivel in args.concurrencia:
+        resultados[f"concurrencia_{nivel}"] = chat._ejecutar(
+            ejecutar_nivel(chat, nivel, args.usuarios, args.turnos, args.historial, args.repetidas)
+        )
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--usuarios", type=int, default=50)
+    parser.add_argument("--turnos", type=int, default=10, help="turnos por usuario")
+    parser.add_argument("--historial", type=int, default=40, help="mensajes precargados por usuario")
+    parser.add_argument("--concurrencia", default="1,8,32", help="niveles separados por coma")
+    parser.add_argument("--latencia-ms", type=float, default=20.0, help="latencia del LLM falso")
+    parser.add_argument("--tokens-respuesta", type=int, default=40)
+    parser.add_argument("--max-mensajes-contexto", type=int, default=None)
+    parser.add_argument("--cache-usuarios", type=int, default=1000, help="0 desactiva la caché de historiales")
+    parser.add_argument("--cache-respuestas", choices=("memoria", "redis"), default=None)
+    parser.add_argument("--repetidas", type=float, default=0.0, help="fracción de turnos con frases repetidas")
+    parser.add_argument("--redis-url", default=None)
+    parser.add_argument("--salida", default=None, help="archivo JSON donde guardar los resultados")
+    parser.add_argument("--base", default=None, help="JSON de una corrida anterior para comparar")
+    parser.add_argument("--tolerancia", type=float, default=0.15, help="empeoramiento relativo tolerado")
+    args = parser.parse_args()
+    args.concurrencia = [int(n) for n in args.concurrencia.split(",")]
+
+    with redis_local(args.redis_url) as redis_url:
+        resultados = ejecutar(args, redis_url)
+
+    informe = {
+        "configuracion": {k: v for k, v in vars(args).items() if k not in ("salida", "base", "redis_url")},
+        "resultados": resultados,
+    }
+    imprimir_resultados("Pipeline de chat", informe)
+
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(informe, f, indent=2, ensure_ascii=False)
+        print(f"💾 Resultados guardados en {args.salida}")
+
+    if args.base:
+        with open(args.base, encoding="utf-8") as f:
+            base = json.load(f)["resultados"]
+        comparacion = comparar(resultados, base, args.tolerancia)
+        imprimir_resultados("Comparación con la base", comparacion)
+        regresiones = [m for m, c in comparacion.items() if c["regresion"]]
+        if regresiones:
+            print(f"❌ Regresiones: {', '.join(regresiones)}")
+            sys.exit(1)
+        print("✅ Sin regresiones")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga del servidor HTTP/WebSocket (`servidor_api.py`)
+
+Levanta `ServidorChat` en un puerto libre con `LLMFalso` y el Redis local de
+prueba, y lo carga con clientes aiohttp desde otro event loop. Cada cliente
+es un usuario que envía `--turnos` turnos seguidos por el protocolo de la
+corrida:
+
+- http: POST /v1/chat (respuesta completa)
+- sse: POST /v1/chat/stream (Server-Sent Events)
+- ws: una conexión WebSocket por cliente, turnos por la misma conexión
+
+Por protocolo y nivel de concurrencia reporta turnos por segundo, latencia
+p50/p95 del turno, tiempo hasta el primer fragmento (sse/ws) y respuestas
+con error. Después mide el listado de usuarios y las páginas de historial.
+Al final comprueba el cierre ordenado: con turnos en curso pide el cierre
+y verifica que todos terminan bien y que no se aceptan conexiones nuevas.
+
+El servidor y los clientes comparten la CPU de esta máquina: los números
+sirven para comparar protocolos y niveles, no como capacidad absoluta.
+
+Uso:
+    python -m benchmarks.bench_servidor_api [--clientes 10,50,200] [--turnos 5]
+        [--latencia-ms 200] [--protocolos http,sse,ws]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from benchmarks.entorno import imprimir_resultados, percentiles, redis_local
+from chat_multi_usuario import ChatMultiUsuario
+from modelos import fabrica_falsa
+from servidor_api import ServidorChat
+
+
+async def turno_http(cliente: aiohttp.ClientSession, base: str, datos: dict) -> tuple:
+    async with cliente.post(f"{base}/v1/chat", json=datos) as respuesta:
+        cuerpo = await respuesta.json()
+        return respuesta.status, cuerpo, None
+
+
+async def turno_sse(cliente: aiohttp.ClientSession, base: str, datos: dict) -> tuple:
+    inicio = time.perf_counter()
+    primer_fragmento, evento, final = None, None, None
+    async with cliente.post(f"{base}/v1/chat/stream", json=datos) as respuesta:
+        if respuesta.status != 200:
+            return respuesta.status, await respuesta.json(), None
+        async for linea in respuesta.content:
+            linea = linea.decode("utf-8").rstrip("\n")
+            if linea.startswith("event: "):
+                evento = linea[len("event: "):]
+            elif linea.startswith("data: "):
+                if evento == "fragmento" and primer_fragmento is None:
+                    primer_fragmento = time.perf_counter() - inicio
+                elif evento in ("respuesta", "error"):
+                    final = (evento, json.loads(linea[len("data: "):]))
+    if final is None or final[0] == "error":
+        return (final[1]["estado"] if final else 502), final and final[1], primer_fragmento
+    return 200, final[1], primer_fragmento
+
+
+async def turnos_ws(cliente: aiohttp.ClientSession, base: str, usuario: str, turnos: int, registrar):
+    async with cliente.ws_connect(f"{base}/v1/ws") as ws:
+        for turno in range(turnos):
+            inicio = time.perf_counter()
+            primer_fragmento = None
+            await ws.send_json({"mensaje": f"pregunta {turno}", "usuario": usuario})
+            while True:
+                datos = await ws.receive_json()
+                if datos["tipo"] == "fragmento" and primer_fragmento is None:
+                    primer_fragmento = time.perf_counter() - inicio
+                elif datos["tipo"] in ("respuesta", "error"):
+                    estado = 200 if datos["tipo"] == "respuesta" else datos["estado"]
+                    registrar(estado, time.perf_counter() - inicio, primer_fragmento)
+                    break
+
+
+async def cargar(base: str, protocolo: str, clientes: int, turnos: int, prefijo: str) -> dict:
+    latencias, primeros, estados = [], [], {}
+
+    def registrar(estado: int, segundos: float, primer_fragmento):
+        estados[estado] = estados.get(estado, 0) + 1
+        if estado == 200:
+            latencias.append(segundos)
+            if primer_fragmento is not None:
+                primeros.append(primer_fragmento)
+
+    async def usuario(cliente: aiohttp.ClientSession, i: int):
+        nombre = f"{prefijo}{i}"
+        if protocolo == "ws":
+            await turnos_ws(cliente, base, nombre, turnos, registrar)
+            return
+        sesion = None
+        enviar = turno_http if protocolo == "http" else turno_sse
+        for turno in range(turnos):
+            inicio = time.perf_counter()
+            estado, cuerpo, primer_fragmento = await enviar(
+                cliente, base, {"mensaje": f"pregunta {turno}", "usuario": nombre, "sesion": sesion}
+            )
+            sesion = (cuerpo or {}).get("sesion", sesion)
+            registrar(estado, time.perf_counter() - inicio, primer_fragmento)
+
+    inicio = time.perf_counter()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as cliente:
+        await asyncio.gather(*(usuario(cliente, i) for i in range(clientes)))
+    duracion = time.perf_counter() - inicio
+    lat, ttff = percentiles(latencias), percentiles(primeros)
+    resultado = {
+        "turnos_por_segundo": round(len(latencias) / duracion, 1),
+        "p50_ms": lat["p50_ms"],
+        "p95_ms": lat["p95_ms"],
+        "errores": {str(e): n for e, n in estados.items() if e != 200},
+    }
+    if primeros:
+        resultado["primer_fragmento_p50_ms"] = ttff["p50_ms"]
+        resultado["primer_fragmento_p95_ms"] = ttff["p95_ms"]
+    return resultado
+
+
+async def consultar_historial(base: str, usuarios: int) -> dict:
+    """Latencia del listado de usuarios y de la primera página de historial de cada uno"""
+    listados, paginas = [], []
+    async with aiohttp.ClientSession() as cliente:
+        inicio = time.perf_counter()
+        async with cliente.get(f"{base}/v1/usuarios", params={"limite": usuarios}) as respuesta:
+            nombres = [u["usuario"] for u in (await respuesta.json())["usuarios"]]
+        listados.append(time.perf_counter() - inicio)
+        for nombre in nombres:
+            inicio = time.perf_counter()
+            async with cliente.get(f"{base}/v1/usuarios/{nombre}/historial", params={"tamano": 10}) as respuesta:
+                await respuesta.json()
+            paginas.append(time.perf_counter() - inicio)
+    return {
+        "usuarios_listados": len(nombres),
+        "listado_ms": round(listados[0] * 1000, 3),
+        "pagina_historial_p50_ms": percentiles(paginas)["p50_ms"],
+        "pagina_historial_p95_ms": percentiles(paginas)["p95_ms"],
+    }
+
+
+async def probar_cierre(servidor: ServidorChat, base: str, en_vuelo: int) -> dict:
+    """Pide el cierre con turnos en curso: deben terminar todos y no aceptarse conexiones nuevas"""
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as cliente:
+        turnos = [
+            asyncio.ensure_future(turno_sse(cliente, base, {"mensaje": "última pregunta", "usuario": f"cierre{i}"}))
+            for i in range(en_vuelo)
+        ]
+        while servidor.en_curso < en_vuelo:
+            await asyncio.sleep(0.005)
+        inicio = time.perf_counter()
+        cierre = asyncio.get_running_loop().run_in_executor(None, servidor.detener)
+        resultados = await asyncio.gather(*turnos, return_exceptions=True)
+        try:
+            async with aiohttp.ClientSession() as nuevo:
+                async with nuevo.post(f"{base}/v1/chat", json={"mensaje": "hola"}) as respuesta:
+                    nueva_aceptada = respuesta.status == 200
+        except aiohttp.ClientError:
+            nueva_aceptada = False
+        await cierre
+    return {
+        "turnos_en_curso": en_vuelo,
+        "completados": sum(1 for r in resultados if not isinstance(r, BaseException) and r[0] == 200),
+        "segundos_cierre": round(time.perf_counter() - inicio, 3),
+        "conexion_nueva_aceptada": nueva_aceptada,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clientes", default="10,50,200", help="niveles de concurrencia separados por coma")
+    parser.add_argument("--turnos", type=int, default=5, help="turnos por cliente")
+    parser.add_argument("--protocolos", default="http,sse,ws")
+    parser.add_argument("--latencia-ms", type=float, default=200.0, help="latencia del LLM falso")
+    parser.add_argument("--ms-por-token", type=float, default=2.0)
+    parser.add_argument("--redis-url", default=None)
+    args = parser.parse_args()
+
+    resultados = {}
+    with redis_local(args.redis_url) as redis_url:
+        chat = ChatMultiUsuario(
+            redis_url,
+            fabrica_modelos=fabrica_falsa(latencia_ms=args.latencia_ms, ms_por_token=args.ms_por_token),
+            max_mensajes_contexto=10,
+        )
+        servidor = ServidorChat(chat, plazo_cierre=30.0)
+        base = f"http://127.0.0.1:{servidor.arrancar('127.0.0.1', 0)}"
+
+        clientes_max = 0
+        for protocolo in args.protocolos.split(","):
+            por_nivel = {}
+            for clientes in (int(n) for n in args.clientes.split(",")):
+                clientes_max = max(clientes_max, clientes)
+                por_nivel[f"clientes_{clientes}"] = asyncio.run(
+                    cargar(base, protocolo, clientes, args.turnos, f"{protocolo}{clientes}u")
+                )
+            resultados[protocolo] = por_nivel
+
+        resultados["historial"] = asyncio.run(consultar_historial(base, clientes_max))
+        resultados["servidor"] = servidor.estadisticas()
+        resultados["cierre"] = asyncio.run(probar_cierre(servidor, base, en_vuelo=20))
+
+    imprimir_resultados("Servidor HTTP/WebSocket", resultados)
+    cierre = resultados["cierre"]
+    if cierre["completados"] != cierre["turnos_en_curso"] or cierre["conexion_nueva_aceptada"]:
+        print("❌ El cierre no fue ordenado")
+    else:
+        print("✅ Cierre ordenado")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Utilidades compartidas por los benchmarks
+
+Si no se indica `--redis-url` se levanta un Redis local de prueba con
+`fakeredis.TcpFakeServer` (ver requirements-dev.txt), que habla el protocolo
+real por TCP y permite medir round trips sin servicios externos.
+"""
+
+import json
+import socket
+import statistics
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+
+@contextmanager
+def redis_local(redis_url: Optional[str] = None):
+    """Entrega una URL de Redis: la indicada o la de un servidor local temporal"""
+    if redis_url:
+        yield redis_url
+        return
+
+    from fakeredis import TcpFakeServer
+
+    class ServidorSinNagle(TcpFakeServer):
+        # El servidor de prueba responde MULTI/EXEC en varias escrituras pequeñas;
+        # sin TCP_NODELAY el algoritmo de Nagle añade ~40 ms que Redis real no tiene
+        def get_request(self):
+            conexion, direccion = super().get_request()
+            conexion.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return conexion, direccion
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        puerto = s.getsockname()[1]
+    servidor = ServidorSinNagle(("127.0.0.1", puerto), server_type="redis")
+    hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+    hilo.start()
+    try:
+        yield f"redis://127.0.0.1:{puerto}/0"
+    finally:
+        servidor.shutdown()
+        servidor.server_close()
+
+
+def percentiles(muestras: list) -> dict:
+    """p50/p95/p99 y media de una lista de latencias en segundos (en ms)"""
+    if not muestras:
+        return {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "media_ms": 0.0}
+    ordenadas = sorted(muestras)
+
+    def p(q):
+        return ordenadas[min(len(ordenadas) - 1, int(q * len(ordenadas)))] * 1000
+
+    return {
+        "p50_ms": round(p(0.50), 3),
+        "p95_ms": round(p(0.95), 3),
+        "p99_ms": round(p(0.99), 3),
+        "media_ms": round(statistics.fmean(ordenadas) * 1000, 3),
+    }
+
+
+def imprimir_resultados(titulo: str, resultados: dict):
+    """Muestra resultados de un benchmark en formato legible"""
+    print(f"\n📊 {titulo}")
+    print("-" * 50)
+    print(json.dumps(resultados, indent=2, ensure_ascii=False))
+    print("-" * 50)
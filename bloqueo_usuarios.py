@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Bloqueo distribuido por usuario para varias réplicas de la app
+
+Un turno lee el historial, genera y escribe; si dos réplicas atienden a la
+vez al mismo usuario, las escrituras se intercalan y una respuesta se genera
+sin ver la otra. `BloqueoUsuarios` serializa los turnos de cada usuario con
+un arrendamiento en Redis (`bloqueo_turno:usuario_<nombre>`), mientras que
+usuarios distintos siguen en paralelo en cualquier proceso o nodo.
+
+- El arrendamiento expira a los `ttl_segundos` si la réplica muere, y se
+  renueva en segundo plano mientras el turno sigue vivo.
+- Cada adquisición recibe un token de fencing creciente por usuario. La
+  escritura del turno (`HistorialRedis.aagregar(..., fencing=token)`) solo se
+  aplica si el bloqueo sigue teniendo ese token; si expiró y lo tomó otro
+  turno, falla con `BloqueoPerdido` en lugar de pisar el historial.
+- Los turnos en espera hacen BLPOP sobre una lista de aviso que el que libera
+  empuja, así que despiertan sin sondear Redis. El BLPOP usa un pool propio
+  y pequeño (`max_conexiones_espera`): los turnos en espera nunca ocupan las
+  conexiones del pool compartido que usan las lecturas y escrituras.
+- Dentro de un proceso, los turnos de un mismo usuario hacen cola en un lock
+  local (en orden de llegada) y solo el primero espera en Redis; pasados
+  `max_en_espera` por usuario se rechazan con `BloqueoSaturado`. Entre
+  réplicas no hay orden garantizado: al liberarse, gana la primera que
+  vuelve a intentar.
+"""
+
+import asyncio
+import time
+import weakref
+from typing import Dict, Optional
+
+from redis.asyncio import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from historial_redis import HistorialRedis, PoolConMetricas, clave_bloqueo
+
+# Toma el bloqueo si está libre: devuelve {token, 0} o {0, ms que le quedan al dueño}
+_ADQUIRIR = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return {0, redis.call('pttl', KEYS[1])}
+end
+local token = redis.call('incr', KEYS[2])
+redis.call('set', KEYS[1], token, 'px', ARGV[1])
+return {token, 0}
+"""
+
+# Renueva el arrendamiento solo si sigue siendo nuestro
+_RENOVAR = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Libera (si sigue siendo nuestro) y despierta al siguiente en espera
+_LIBERAR = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+    redis.call('del', KEYS[2])
+    redis.call('rpush', KEYS[2], 1)
+    redis.call('pexpire', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+class BloqueoSaturado(RuntimeError):
+    """Demasiados turnos esperando el bloqueo del mismo usuario en este proceso"""
+
+
+def clave_fencing(nombre_usuario: str) -> str:
+    return clave_bloqueo(nombre_usuario) + ":fencing"
+
+
+def clave_aviso(nombre_usuario: str) -> str:
+    return clave_bloqueo(nombre_usuario) + ":aviso"
+
+
+class ArrendamientoTurno:
+    """Bloqueo de un usuario durante un turno; usar con `async with`"""
+
+    def __init__(self, bloqueos: "BloqueoUsuarios", nombre_usuario: str):
+        self.bloqueos = bloqueos
+        self.usuario = nombre_usuario.lower()
+        self.token: Optional[int] = None
+        self.segundos_espera = 0.0
+        self.perdido = False
+        self._renovacion: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "ArrendamientoTurno":
+        await self.aadquirir()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aliberar()
+
+    async def aadquirir(self):
+        self.token, self.segundos_espera = await self.bloqueos.aadquirir(self.usuario)
+        self._renovacion = asyncio.ensure_future(self._arenovar_periodicamente())
+
+    async def _arenovar_periodicamente(self):
+        while True:
+            await asyncio.sleep(self.bloqueos.ttl_segundos / 3)
+            try:
+                vigente = await self.bloqueos.arenovar(self.usuario, self.token)
+            except Exception as e:
+                print(f"❌ Error al renovar bloqueo de {self.usuario}: {e}")
+                continue
+            if not vigente:
+                self.perdido = True
+                print(f"⚠️ Bloqueo de {self.usuario} perdido (arrendamiento expirado)")
+                return
+
+    async def aliberar(self):
+        if self._renovacion is not None:
+            self._renovacion.cancel()
+            self._renovacion = None
+        if self.token is not None:
+            token, self.token = self.token, None
+            await self.bloqueos.aliberar(self.usuario, token)
+
+
+class BloqueoUsuarios:
+    """Arrendamientos por usuario en Redis con token de fencing"""
+
+    def __init__(
+        self,
+        historiales: HistorialRedis,
+        ttl_segundos: float = 30.0,
+        espera_maxima: float = 60.0,
+        espera_aviso: float = 1.0,
+        max_en_espera: int = 32,
+        max_conexiones_espera: int = 4,
+    ):
+        """
+        `espera_aviso` acota cada BLPOP (debe ser menor que el timeout de
+        socket del pool): al vencer se reintenta, lo que cubre arrendamientos
+        que expiran sin liberarse. `max_conexiones_espera` es el tamaño del
+        pool dedicado a los BLPOP: con más usuarios en espera a la vez, los
+        que no consiguen conexión reintentan tras una pausa corta.
+        """
+        self.historiales = historiales
+        self.ttl_segundos = ttl_segundos
+        self.espera_maxima = espera_maxima
+        self.espera_aviso = espera_aviso
+        self.max_en_espera = max_en_espera
+        self.max_conexiones_espera = max_conexiones_espera
+        # usuario -> [lock local, turnos esperando]; se borra al quedar sin turnos
+        self._colas: Dict[str, list] = {}
+        self._clientes_espera = weakref.WeakKeyDictionary()
+        self.adquisiciones = 0
+        self.esperas = 0
+        self.segundos_espera = 0.0
+        self.rechazos = 0
+
+    def turno(self, nombre_usuario: str) -> ArrendamientoTurno:
+        """`async with bloqueos.turno(usuario) as arrendamiento: ...`"""
+        return ArrendamientoTurno(self, nombre_usuario)
+
+    def _cliente_espera(self) -> Redis:
+        """Cliente del event loop en ejecución sobre el pool dedicado a los BLPOP"""
+        bucle = asyncio.get_running_loop()
+        cliente = self._clientes_espera.get(bucle)
+        if cliente is None:
+            pool = PoolConMetricas.from_url(
+                self.historiales.redis_url,
+                max_connections=self.max_conexiones_espera,
+                timeout=self.espera_aviso,
+                socket_timeout=self.historiales.timeout_socket,
+                socket_connect_timeout=self.historiales.timeout_socket,
+                **self.historiales.opciones_pool,
+            )
+            cliente = Redis(connection_pool=pool)
+            self._clientes_espera[bucle] = cliente
+        return cliente
+
+    async def acerrar(self):
+        """Cierra el pool de espera del event loop en ejecución"""
+        cliente = self._clientes_espera.pop(asyncio.get_running_loop(), None)
+        if cliente is not None:
+            await cliente.aclose(close_connection_pool=True)
+
+    async def aadquirir(self, nombre_usuario: str) -> tuple:
+        """Espera el bloqueo del usuario; devuelve (token de fencing, segundos de espera)"""
+        usuario = nombre_usuario.lower()
+        cola = self._colas.get(usuario)
+        if cola is None:
+            cola = self._colas[usuario] = [asyncio.Lock(), 0]
+        if cola[1] >= self.max_en_espera:
+            self.rechazos += 1
+            raise BloqueoSaturado(f"Hay {cola[1]} turnos de {usuario} esperando su bloqueo")
+        en_cola = cola[1] > 0
+        cola[1] += 1
+        inicio = time.perf_counter()
+        try:
+            # Los turnos locales del mismo usuario esperan aquí y no en Redis
+            async with cola[0]:
+                token, intentos = await self._aadquirir_redis(usuario, inicio)
+        finally:
+            cola[1] -= 1
+            if not cola[1]:
+                self._colas.pop(usuario, None)
+        esperado = time.perf_counter() - inicio
+        self.adquisiciones += 1
+        if en_cola or intentos > 1:
+            self.esperas += 1
+            self.segundos_espera += esperado
+        return token, esperado
+
+    async def _aadquirir_redis(self, usuario: str, inicio: float) -> tuple:
+        cliente = self.historiales.cliente()
+        ttl_ms = int(self.ttl_segundos * 1000)
+        intentos = 0
+        while True:
+            token, restante_ms = await cliente.eval(
+                _ADQUIRIR, 2, clave_bloqueo(usuario), clave_fencing(usuario), ttl_ms
+            )
+            intentos += 1
+            if token:
+                return int(token), intentos
+            if time.perf_counter() - inicio > self.espera_maxima:
+                raise TimeoutError(f"Bloqueo de {usuario} ocupado por más de {self.espera_maxima:.0f} s")
+            espera = max(min(restante_ms / 1000, self.espera_aviso), 0.01)
+            try:
+                await self._cliente_espera().blpop([clave_aviso(usuario)], timeout=espera)
+            except RedisConnectionError:
+                # Pool de espera agotado: pausa corta y se vuelve a intentar
+                await asyncio.sleep(min(espera, 0.05))
+
+    async def arenovar(self, nombre_usuario: str, token: int) -> bool:
+        usuario = nombre_usuario.lower()
+        renovado = await self.historiales.cliente().eval(
+            _RENOVAR, 1, clave_bloqueo(usuario), token, int(self.ttl_segundos * 1000)
+        )
+        return bool(renovado)
+
+    async def aliberar(self, nombre_usuario: str, token: int) -> bool:
+        usuario = nombre_usuario.lower()
+        liberado = await self.historiales.cliente().eval(
+            _LIBERAR, 2, clave_bloqueo(usuario), clave_aviso(usuario), token, int(self.ttl_segundos * 1000)
+        )
+        return bool(liberado)
+
+    def estadisticas(self) -> dict:
+        return {
+            "adquisiciones": self.adquisiciones,
+            "esperas": self.esperas,
+            "segundos_espera": round(self.segundos_espera, 3),
+            "rechazos": self.rechazos,
+            "usuarios_en_espera": len(self._colas),
+        }
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Caché LRU en proceso de historiales deserializados
+
+Guarda por usuario los mensajes ya convertidos a objetos LangChain junto
+con la versión del historial en Redis (`chat_usuarios:versiones`) y su
+total de mensajes. Una entrada puede ser el historial completo o solo la
+ventana final que leyeron las lecturas acotadas (LRANGE de la cola): así
+un fallo nunca obliga a cargar la lista entera ni el archivo. Validar una
+entrada cuesta un HGET + LLEN en lugar de un LRANGE y su deserialización,
+y la versión permite que varias réplicas detecten que otra escribió el
+historial. Limita tanto el número de usuarios como los bytes retenidos
+(estimados por el tamaño del JSON de cada mensaje).
+"""
+
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from langchain_core.messages import BaseMessage
+
+
+class CacheHistoriales:
+    """LRU de historiales por usuario con límite de entradas y de bytes"""
+
+    def __init__(self, max_usuarios: int = 1000, max_bytes: int = 64 * 1024 * 1024):
+        self.max_usuarios = max_usuarios
+        self.max_bytes = max_bytes
+        # usuario -> (versión, mensajes finales en orden cronológico, bytes, total del historial)
+        self._entradas: "OrderedDict[str, Tuple[int, List[BaseMessage], int, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes_retenidos = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.obsoletos = 0
+        self.desalojos = 0
+
+    def obtener(self, nombre_usuario: str) -> Optional[Tuple[int, List[BaseMessage], int]]:
+        """
+        Devuelve (versión, mensajes, total) sin validar, o None si no está.
+        La entrada es el historial completo si `len(mensajes) == total`.
+        """
+        usuario = nombre_usuario.lower()
+        with self._lock:
+            entrada = self._entradas.get(usuario)
+            if entrada is None:
+                return None
+            self._entradas.move_to_end(usuario)
+            return entrada[0], entrada[1], entrada[3]
+
+    def guardar(
+        self,
+        nombre_usuario: str,
+        version: int,
+        mensajes: List[BaseMessage],
+        tamano: int,
+        total: Optional[int] = None,
+    ):
+        """
+        Guarda (o reemplaza) los mensajes de un usuario y desaloja lo necesario.
+        `total` es el largo del historial en Redis cuando `mensajes` es solo
+        la ventana final (None = historial completo).
+        """
+        usuario = nombre_usuario.lower()
+        total = len(mensajes) if total is None else total
+        with self._lock:
+            self._quitar(usuario)
+            if tamano > self.max_bytes:
+                # Un historial más grande que toda la caché no se retiene
+                return
+            self._entradas[usuario] = (version, mensajes, tamano, total)
+            self.bytes_retenidos += tamano
+            while len(self._entradas) > self.max_usuarios or self.bytes_retenidos > self.max_bytes:
+                _, (_, _, tamano_desalojado, _) = self._entradas.popitem(last=False)
+                self.bytes_retenidos -= tamano_desalojado
+                self.desalojos += 1
+
+    def agregar(
+        self,
+        nombre_usuario: str,
+        version: int,
+        mensajes: List[BaseMessage],
+        tamano: int,
+        max_mensajes: Optional[int] = None,
+    ):
+        """
+        Write-through: agrega mensajes recién escritos a la entrada del usuario.
+
+        Solo si la entrada estaba en la versión inmediatamente anterior; si otra
+        réplica escribió entre medio, se descarta y la próxima lectura recarga.
+        """
+        usuario = nombre_usuario.lower()
+        with self._lock:
+            entrada = self._entradas.get(usuario)
+        if entrada is None:
+            return
+        version_anterior, anteriores, tamano_anterior, total = entrada
+        if version_anterior != version - 1:
+            self.invalidar(usuario)
+            return
+        nuevos = anteriores + mensajes
+        total += len(mensajes)
+        if max_mensajes and total > max_mensajes:
+            # El LTRIM de Redis quitó los más antiguos: el tamaño es aproximado
+            total = max_mensajes
+            if len(nuevos) > max_mensajes:
+                recortados = len(nuevos) - max_mensajes
+                tamano_anterior = tamano_anterior * (len(anteriores) - recortados) // max(len(anteriores), 1)
+                nuevos = nuevos[recortados:]
+        self.guardar(usuario, version, nuevos, tamano_anterior + tamano, total)
+
+    def invalidar(self, nombre_usuario: str):
+        with self._lock:
+            self._quitar(nombre_usuario.lower())
+
+    def _quitar(self, usuario: str):
+        entrada = self._entradas.pop(usuario, None)
+        if entrada is not None:
+            self.bytes_retenidos -= entrada[2]
+
+    def contar(self, resultado: str):
+        """Cuenta un acierto, fallo (no estaba) u obsoleto (estaba pero cambió)"""
+        with self._lock:
+            setattr(self, resultado, getattr(self, resultado) + 1)
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            lecturas = self.aciertos + self.fallos + self.obsoletos
+            return {
+                "usuarios": len(self._entradas),
+                "max_usuarios": self.max_usuarios,
+                "bytes": self.bytes_retenidos,
+                "max_bytes": self.max_bytes,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "obsoletos": self.obsoletos,
+                "desalojos": self.desalojos,
+                "tasa_aciertos": self.aciertos / lecturas if lecturas else 0.0,
+            }
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Caché semántica de respuestas del chat
+
+Evita una llamada completa al LLM cuando un usuario repite casi la misma
+pregunta ("¿cómo estás?", saludos) dentro de su conversación. Cada entrada
+vive en un ámbito propio del usuario y de la versión de su resumen (digest
+del texto), de modo que la respuesta personalizada de un usuario nunca se
+sirve a otro y las entradas se renuevan cada vez que el resumen se compacta.
+La búsqueda es primero exacta (texto normalizado) y luego por similitud de
+embeddings dentro del mismo ámbito.
+
+Almacenamiento:
+- "memoria": LRU en proceso con TTL por entrada
+- "redis": un hash por ámbito (`respuesta_cache:usuario_<nombre>:<digest>`)
+  con EXPIRE; el desalojo por memoria lo hace Redis (`maxmemory-policy`)
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from historial_redis import HistorialRedis, normalizar_texto
+from memoria_semantica import EmbeddingsHashing
+
+PREFIJO_CACHE_RESPUESTAS = "respuesta_cache:usuario_"
+
+
+class CacheRespuestas:
+    """Caché de respuestas por usuario y contexto con búsqueda exacta y semántica"""
+
+    def __init__(
+        self,
+        historiales: HistorialRedis,
+        almacen: str = "memoria",
+        embeddings: Optional[Embeddings] = None,
+        umbral_similitud: float = 0.92,
+        ttl_segundos: int = 600,
+        max_entradas: int = 1000,
+        mensajes_en_clave: int = 0,
+    ):
+        """
+        `mensajes_en_clave` es cuántos mensajes recientes del historial entran
+        además en el digest del ámbito. Con 0 (por defecto) el ámbito es
+        usuario + resumen: una pregunta repetida acierta mientras el resumen
+        no cambie y la entrada no expire, aunque haya turnos en medio, así que
+        una respuesta que dependa de lo dicho justo antes puede quedar vieja
+        hasta `ttl_segundos`. Con N > 0 solo se reutiliza si los últimos N
+        mensajes son idénticos; como cada turno los cambia, en una
+        conversación en curso casi no hay aciertos (sirve para reintentos o
+        para conversaciones que se repiten desde el mismo punto).
+        """
+        if almacen not in ("memoria", "redis"):
+            raise ValueError(f"Almacén de caché desconocido: {almacen}")
+        self.historiales = historiales
+        self.almacen = almacen
+        self.embeddings = embeddings or EmbeddingsHashing()
+        self.umbral_similitud = umbral_similitud
+        self.ttl_segundos = ttl_segundos
+        self.max_entradas = max_entradas
+        self.mensajes_en_clave = mensajes_en_clave
+        # (ámbito, texto normalizado) -> (expira, vector, respuesta)
+        self._entradas: OrderedDict = OrderedDict()
+        self._por_ambito: dict = {}  # ámbito -> textos guardados (evita recorrer todo el LRU)
+        self._lock = threading.Lock()
+        self.aciertos_exactos = 0
+        self.aciertos_semanticos = 0
+        self.fallos = 0
+        self.guardadas = 0
+        self.desalojos = 0
+
+    # ----------------------------------------
+    # Claves
+    # ----------------------------------------
+
+    def ambito(self, nombre_usuario: str, entradas: dict) -> str:
+        """Ámbito de la entrada: usuario + digest del resumen (y de los últimos N mensajes)"""
+        historial = entradas.get("chat_history", [])
+        recientes = historial[-self.mensajes_en_clave:] if self.mensajes_en_clave else []
+        contexto = json.dumps(
+            [entradas.get("resumen", "")] + [f"{m.type}:{m.content}" for m in recientes],
+            ensure_ascii=False,
+        )
+        digest = hashlib.sha1(contexto.encode("utf-8")).hexdigest()[:16]
+        return f"{PREFIJO_CACHE_RESPUESTAS}{nombre_usuario.lower()}:{digest}"
+
+    # ----------------------------------------
+    # Búsqueda y guardado
+    # ----------------------------------------
+
+    async def abuscar(self, nombre_usuario: str, mensaje: str, entradas: dict) -> Optional[dict]:
+        """Devuelve la respuesta guardada (dict de `RespuestaChat`) o None"""
+        ambito = self.ambito(nombre_usuario, entradas)
+        texto = normalizar_texto(mensaje)
+        if not texto:
+            return None
+
+        candidatos = await self._acandidatos(ambito)
+        if texto in candidatos:
+            self._contar("aciertos_exactos")
+            return candidatos[texto][1]
+
+        if candidatos:
+            consulta = np.asarray(await self.embeddings.aembed_query(texto), dtype=np.float32)
+            textos = list(candidatos)
+            matriz = np.vstack([candidatos[t][0] for t in textos])
+            puntajes = matriz @ consulta
+            mejor = int(np.argmax(puntajes))
+            if puntajes[mejor] >= self.umbral_similitud:
+                self._contar("aciertos_semanticos")
+                return candidatos[textos[mejor]][1]
+
+        self._contar("fallos")
+        return None
+
+    async def aguardar(self, nombre_usuario: str, mensaje: str, entradas: dict, respuesta: dict):
+        """Guarda la respuesta generada para este usuario y contexto"""
+        ambito = self.ambito(nombre_usuario, entradas)
+        texto = normalizar_texto(mensaje)
+        if not texto:
+            return
+        vector = np.asarray(await self.embeddings.aembed_query(texto), dtype=np.float32)
+
+        if self.almacen == "redis":
+            valor = json.dumps({"vector": vector.tolist(), "respuesta": respuesta}, ensure_ascii=False)
+            async with self.historiales.cliente().pipeline(transaction=True) as pipe:
+                pipe.hset(ambito, texto, valor)
+                pipe.expire(ambito, self.ttl_segundos)
+                await pipe.execute()
+        else:
+            with self._lock:
+                self._entradas[(ambito, texto)] = (time.time() + self.ttl_segundos, vector, respuesta)
+                self._entradas.move_to_end((ambito, texto))
+                self._por_ambito.setdefault(ambito, set()).add(texto)
+                while len(self._entradas) > self.max_entradas:
+                    (ambito_viejo, texto_viejo), _ = self._entradas.popitem(last=False)
+                    self._quitar_de_ambito(ambito_viejo, texto_viejo)
+                    self.desalojos += 1
+        self._contar("guardadas")
+
+    async def _acandidatos(self, ambito: str) -> dict:
+        """Entradas vigentes del ámbito: texto normalizado -> (vector, respuesta)"""
+        if self.almacen == "redis":
+            campos = await self.historiales.cliente().hgetall(ambito)
+            candidatos = {}
+            for texto, valor in campos.items():
+                texto = texto.decode("utf-8") if isinstance(texto, bytes) else texto
+                datos = json.loads(valor)
+                candidatos[texto] = (np.asarray(datos["vector"], dtype=np.float32), datos["respuesta"])
+            return candidatos
+
+        ahora = time.time()
+        candidatos = {}
+        with self._lock:
+            for texto in list(self._por_ambito.get(ambito, ())):
+                expira, vector, respuesta = self._entradas[(ambito, texto)]
+                if expira < ahora:
+                    del self._entradas[(ambito, texto)]
+                    self._quitar_de_ambito(ambito, texto)
+                    continue
+                self._entradas.move_to_end((ambito, texto))
+                candidatos[texto] = (vector, respuesta)
+        return candidatos
+
+    def _quitar_de_ambito(self, ambito: str, texto: str):
+        textos = self._por_ambito.get(ambito)
+        if textos is not None:
+            textos.discard(texto)
+            if not textos:
+                del self._por_ambito[ambito]
+
+    def _contar(self, campo: str):
+        with self._lock:
+            setattr(self, campo, getattr(self, campo) + 1)
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            aciertos = self.aciertos_exactos + self.aciertos_semanticos
+            consultas = aciertos + self.fallos
+            return {
+                "almacen": self.almacen,
+                "entradas_en_memoria": len(self._entradas),
+                "aciertos_exactos": self.aciertos_exactos,
+                "aciertos_semanticos": self.aciertos_semanticos,
+                "fallos": self.fallos,
+                "guardadas": self.guardadas,
+                "desalojos": self.desalojos,
+                "tasa_aciertos": aciertos / consultas if consultas else 0.0,
+            }
@@ -7,16 +7,26 @@ Este sistema permite que múltiples usuarios conversen con un asistente AI
 que recuerda las conversaciones individuales de cada usuario usando Redis.
 """
 
+import asyncio
 import os
 import re
+import threading
+import time
+from contextlib import asynccontextmanager, suppress
 from typing import Optional, Literal
 from pydantic import BaseModel, Field
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_community.chat_message_histories import RedisChatMessageHistory
 from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.output_parsers import StrOutputParser
 from dotenv import load_dotenv
+from detector_local import DetectorLocal
+from cache_historial import CacheHistoriales
+from lotes_detector import AgrupadorLotes
+from modelos import FabricaModelos, fabrica_openai
+from pasarela_llm import LLMSaturado, PasarelaLLM
+from trazas import Trazador, activar, anotar, etapa
+from historial_redis import MIN_SEGMENTO_ARCHIVO, HistorialRedis, estimar_tokens_mensaje, nombre_usuario_valido
+from resumenes import CompactadorHistorial
 
 # Cargar variables de entorno desde .env
 load_dotenv()
@@ -45,31 +55,165 @@ class RespuestaChat(BaseModel):
         description="True si se necesita que el usuario se identifique"
     )
 
+class RespuestaFusionada(BaseModel):
+    """Detección de usuario y respuesta del chat producidas en una sola llamada"""
+    usuario_identificado: bool = Field(
+        description="True si en el último mensaje el usuario dice su nombre o se identifica"
+    )
+    nombre_usuario: Optional[str] = Field(
+        description="Nombre con el que se identifica en el último mensaje, si lo hace"
+    )
+    tipo_identificacion: Literal["presentacion", "referencia", "ninguna"] = Field(
+        description="Tipo de identificación: 'presentacion' (soy X), 'referencia' (mi nombre es X), 'ninguna'"
+    )
+    mensaje: str = Field(description="Respuesta del asistente")
+    usuario_actual: Optional[str] = Field(description="Usuario con el que se está conversando")
+    requiere_identificacion: bool = Field(
+        description="True si se necesita que el usuario se identifique"
+    )
+
+    def deteccion(self) -> DeteccionUsuario:
+        return DeteccionUsuario(
+            usuario_identificado=self.usuario_identificado,
+            nombre_usuario=self.nombre_usuario,
+            tipo_identificacion=self.tipo_identificacion,
+        )
+
 # ========================================
 # 2. CONFIGURACIÓN DE MODELOS Y REDIS
 # ========================================
 
+# 👤 ESTADO POR CONVERSACIÓN
+
+class SesionChat:
+    """Estado de una conversación (una pestaña del navegador, una terminal, una conexión)"""
+
+    def __init__(self, id_sesion: str):
+        self.id_sesion = id_sesion
+        self.usuario_actual: Optional[str] = None
+        self.ultimo_contexto: dict = {}
+        self.ultimo_uso = time.time()
+
 # 🤖 CLASE PRINCIPAL DEL SISTEMA DE CHAT
 
 class ChatMultiUsuario:
-    def __init__(self, redis_url: str, openai_api_key: str):
+    def __init__(
+        self,
+        redis_url: str,
+        openai_api_key: Optional[str] = None,
+        deteccion_local: bool = True,
+        modo_especulativo: bool = False,
+        modo_fusionado: bool = False,
+        max_conexiones_redis: int = 20,
+        timeout_redis: float = 5.0,
+        ttl_historial: Optional[int] = None,
+        max_mensajes_contexto: Optional[int] = None,
+        max_tokens_contexto: Optional[int] = None,
+        umbral_resumen: Optional[int] = None,
+        lote_resumen: int = 10,
+        k_memoria: Optional[int] = None,
+        embeddings=None,
+        cache_usuarios: int = 1000,
+        cache_mb: int = 64,
+        cache_respuestas: Optional[str] = None,
+        ttl_cache_respuestas: int = 600,
+        lote_detector_ms: Optional[float] = None,
+        max_lote_detector: int = 16,
+        fabrica_modelos: Optional[FabricaModelos] = None,
+        pasarela_llm: Optional[PasarelaLLM] = None,
+        formato_historial: str = "langchain",
+        archivar_mas_de: Optional[int] = None,
+        inicializacion_perezosa: bool = False,
+        bloqueo_por_usuario: bool = False,
+        ttl_bloqueo: float = 30.0,
+    ):
         """Inicializa el sistema de chat multi-usuario"""
         self.redis_url = redis_url
-        self.usuario_actual = None
 
-        # Configurar OpenAI API
-        os.environ["OPENAI_API_KEY"] = openai_api_key
+        # El motor (modelos, cadenas, pool Redis) es compartido y sin estado de
+        # conversación; cada conversación tiene su SesionChat
+        self.sesion_por_defecto = SesionChat("por_defecto")
+        self.sesiones: dict = {}
+        self._lock_sesiones = threading.Lock()
+        self._ultima_limpieza = time.time()
+
+        # Trazas por turno: tiempos por etapa, tokens y aciertos de caché
+        self.trazador = Trazador()
+
+        # Política de contexto: últimos N mensajes y/o presupuesto de tokens
+        # (None = historial completo, como antes)
+        self.max_mensajes_contexto = max_mensajes_contexto
+        self.max_tokens_contexto = max_tokens_contexto
+        self.metricas_contexto = {"turnos": 0, "tokens_prompt": 0, "mensajes_historial": 0}
+
+        # Un único pool de conexiones Redis para todas las lecturas, escrituras y listados
+        self.historiales = HistorialRedis(
+            redis_url,
+            max_conexiones=max_conexiones_redis,
+            timeout_espera=timeout_redis,
+            timeout_socket=timeout_redis,
+            ttl_segundos=ttl_historial,
+            # Caché LRU de historiales deserializados (cache_usuarios=0 la desactiva)
+            cache=CacheHistoriales(cache_usuarios, cache_mb * 1024 * 1024) if cache_usuarios else None,
+            # "compacto" guarda [rol, contenido, ts] en lugar del JSON de LangChain
+            formato=formato_historial,
+        )
+
+        # Archivo de mensajes antiguos en segmentos comprimidos: la lista conserva
+        # los `archivar_mas_de` más recientes (None = no archivar)
+        if archivar_mas_de is not None and formato_historial != "compacto":
+            raise ValueError("archivar_mas_de requiere formato_historial='compacto'")
+        self.archivar_mas_de = archivar_mas_de
+        self._archivando = set()
+        self._tareas_archivo = set()
+
+        # Event loop propio en segundo plano: los métodos síncronos son
+        # envoltorios que ejecutan aquí su versión async. `cerrar()` lo detiene
+        self._bucle = asyncio.new_event_loop()
+        self._hilo_bucle = threading.Thread(target=self._bucle.run_forever, name="chat-bucle", daemon=True)
+        self._hilo_bucle.start()
+
+        # Ejecución especulativa: generar la respuesta para el usuario actual
+        # mientras el LLM detector decide si hubo cambio de usuario
+        self.modo_especulativo = modo_especulativo
+        self._lock_metricas = threading.Lock()
+        self.metricas_especulacion = {
+            "lanzadas": 0,
+            "aprovechadas": 0,
+            "descartadas": 0,
+            "segundos_solapados": 0.0,
+        }
 
-        # Modelo para detección de usuarios
-        self.llm_detector = ChatOpenAI(model="gpt-4o-mini", temperature=0).with_structured_output(DeteccionUsuario)
+        # Modo fusionado: en los casos ambiguos con usuario actual, detección y
+        # respuesta salen de una sola llamada; solo si el modelo detecta otro
+        # usuario se regenera con su historial (tiene prioridad sobre el especulativo)
+        self.modo_fusionado = modo_fusionado
+        self.metricas_fusion = {"llamadas": 0, "regeneradas": 0}
 
-        # Modelo principal para el chat (usa output parser)
-        self.llm_chat = ChatOpenAI(model="gpt-4o-mini", temperature=0).with_structured_output(RespuestaChat)
+        # Detector por reglas que evita llamar al LLM en los casos obvios
+        self.detector_local = DetectorLocal() if deteccion_local else None
+        if self.detector_local is not None:
+            # Usuarios cuyo historial expiró dejan de ser conocidos
+            self.historiales.al_purgar = self.detector_local.olvidar_usuarios
+
+        # Modelos por rol ("detector", "chat", "resumen"): OpenAI por defecto, o
+        # cualquier fábrica (p. ej. modelos.fabrica_falsa() para pruebas sin red)
+        self.fabrica_modelos = fabrica_modelos or fabrica_openai(openai_api_key)
+
+        # Todas las llamadas al LLM pasan por la pasarela: límite de concurrencia,
+        # cubetas por minuto, cola con plazo, reintentos y cortocircuito
+        self.pasarela_llm = pasarela_llm or PasarelaLLM()
+
+        # Los prompts empiezan con un prefijo estático (instrucciones y ejemplos,
+        # sin variables) idéntico para todos los usuarios y turnos, de modo que
+        # la caché de prompts del proveedor lo reutilice. Después van las partes
+        # por usuario (usuario actual, resumen, historial) y al final las del
+        # turno (recuerdos, mensaje). Ver test_prefijo_prompts().
 
         # Prompt para detección de usuarios
-        self.prompt_detector = ChatPromptTemplate.from_template(
-            """
-            Analiza este mensaje y determina si el usuario se está identificando con su nombre.
+        self.prompt_detector = ChatPromptTemplate.from_messages([
+            ("system", """
+            Analiza el mensaje del usuario y determina si se está identificando con su nombre.
 
             Ejemplos de identificación:
             - "Soy Pablo" → usuario_identificado=True, nombre_usuario="Pablo", tipo="presentacion"
@@ -77,14 +221,12 @@ class ChatMultiUsuario:
             - "Soy María, quiero saber más" → usuario_identificado=True, nombre_usuario="María", tipo="presentacion"
             - "Hola, aquí Juan otra vez" → usuario_identificado=True, nombre_usuario="Juan", tipo="referencia"
             - "¿Cómo estás?" → usuario_identificado=False, nombre_usuario=None, tipo="ninguna"
-
-            Mensaje: "{mensaje}"
-            """
-        )
+            """),
+            ("human", 'Mensaje: "{mensaje}"'),
+        ])
 
         # Prompt principal del chat
-        self.prompt_chat = ChatPromptTemplate.from_messages([
-            ("system", """
+        instrucciones_chat = ("system", """
             Eres un asistente de IA tipo Alexa o Google Home que recuerda conversaciones con diferentes usuarios.
 
             Comportamiento:
@@ -92,43 +234,422 @@ class ChatMultiUsuario:
             - Si no conoces al usuario, pídele que se identifique de manera amigable
             - Sé conversacional, útil y recuerda el contexto de conversaciones anteriores
             - Cuando un usuario se identifique, confirma que lo reconoces y estás listo para continuar
-
+            """)
+        contexto_usuario = ("system", """
             Usuario actual: {usuario_actual}
-            """),
+
+            Resumen de conversaciones anteriores con este usuario:
+            {resumen}
+            """)
+        contexto_turno = [
             MessagesPlaceholder(variable_name="chat_history"),
-            ("human", "{input}")
-        ])
+            ("system", """
+            Recuerdos relevantes de conversaciones anteriores:
+            {recuerdos}
+            """),
+            ("human", "{input}"),
+        ]
+        self.prompt_chat = ChatPromptTemplate.from_messages(
+            [instrucciones_chat, contexto_usuario, *contexto_turno]
+        ).partial(resumen="Sin resumen previo", recuerdos="Ninguno")
+
+        # Prompt del modo fusionado: el del chat más las instrucciones del detector
+        # (también estáticas, antes del contexto del usuario)
+        self.prompt_fusionado = ChatPromptTemplate.from_messages([
+            instrucciones_chat,
+            ("system", """
+            Además de responder, indica si en su último mensaje el usuario se identifica con su nombre
+            (p. ej. "Soy Pablo", "Me llamo Ana", "Hola, aquí Juan otra vez"). Mencionar a otra persona
+            no es identificarse. Si se identifica como alguien distinto del usuario actual, responde
+            dirigiéndote a esa persona.
+            """),
+            contexto_usuario,
+            *contexto_turno,
+        ]).partial(resumen="Sin resumen previo", recuerdos="Ninguno")
+
+        # Modelos, cadenas y compactador: ahora, o en el primer uso / al
+        # precalentar con inicializacion_perezosa=True (arranque sin importar
+        # ni construir los clientes de los modelos)
+        self.lote_detector_ms = lote_detector_ms
+        self.max_lote_detector = max_lote_detector
+        self.umbral_resumen = umbral_resumen
+        self.lote_resumen = lote_resumen
+        self._lock_modelos = threading.RLock()
+        self._modelos_listos = False
+        if not inicializacion_perezosa:
+            self._construir_modelos()
+
+        # Memoria semántica: recuperar los k intercambios pasados más relevantes
+        # (embeddings intercambiables; por defecto hashing local sin red)
+        self.k_memoria = k_memoria
+        self.memoria = None
+        if k_memoria:
+            # Import diferido: NumPy solo se carga si se usa memoria o caché de respuestas
+            from memoria_semantica import MemoriaSemantica
+
+            self.memoria = MemoriaSemantica(self.historiales, embeddings)
+
+        # Caché de respuestas por usuario y contexto ("memoria" o "redis"; None = sin caché)
+        self.cache_respuestas = None
+        if cache_respuestas:
+            from cache_respuestas import CacheRespuestas
+
+            self.cache_respuestas = CacheRespuestas(
+                self.historiales,
+                almacen=cache_respuestas,
+                embeddings=embeddings,
+                ttl_segundos=ttl_cache_respuestas,
+            )
+
+        # Bloqueo distribuido por usuario: serializa los turnos de un mismo
+        # usuario entre réplicas (lectura del historial → generación → escritura)
+        self.bloqueos = None
+        if bloqueo_por_usuario:
+            from bloqueo_usuarios import BloqueoUsuarios
 
-        # Cadenas de procesamiento
-        self.cadena_detector = self.prompt_detector | self.llm_detector
-        self.cadena_chat = self.prompt_chat | self.llm_chat
+            self.bloqueos = BloqueoUsuarios(
+                self.historiales, ttl_segundos=ttl_bloqueo, espera_aviso=min(1.0, timeout_redis / 2)
+            )
 
         print("✅ Sistema de chat inicializado")
 
-    def detectar_usuario(self, mensaje: str) -> DeteccionUsuario:
+    # ----------------------------------------
+    # Construcción de modelos (inmediata o perezosa)
+    # ----------------------------------------
+
+    # Atributos creados por `_construir_modelos`
+    _ATRIBUTOS_MODELOS = frozenset({
+        "llm_detector", "modelo_chat", "llm_chat", "llm_chat_stream",
+        "cadena_detector", "cadena_chat", "cadena_chat_stream", "cadena_fusionada",
+        "agrupador_detector", "compactador",
+    })
+
+    def __getattr__(self, nombre):
+        # Solo se llama si el atributo no existe: con inicialización perezosa,
+        # el primer acceso a un modelo o cadena los construye. En el event loop
+        # del chat no: bloquearía a todas las sesiones (ver `_amodelos`)
+        if nombre in ChatMultiUsuario._ATRIBUTOS_MODELOS and "_lock_modelos" in self.__dict__:
+            if threading.current_thread() is self.__dict__.get("_hilo_bucle"):
+                raise RuntimeError(f"'{nombre}' no está construido: esperar `_amodelos()` en el event loop")
+            self._construir_modelos()
+            return self.__dict__[nombre]
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{nombre}'")
+
+    def _construir_modelos(self):
+        """Crea modelos, cadenas y compactador (una sola vez, seguro entre hilos)"""
+        with self._lock_modelos:
+            if self._modelos_listos:
+                return
+            inicio = time.perf_counter()
+            construidos = {}
+
+            # Modelo para detección de usuarios
+            pasarela = self.pasarela_llm
+            construidos["llm_detector"] = pasarela.envolver(
+                self.fabrica_modelos("detector").with_structured_output(DeteccionUsuario)
+            )
+
+            # Modelo principal para el chat (usa output parser)
+            modelo_chat = construidos["modelo_chat"] = self.fabrica_modelos("chat")
+            construidos["llm_chat"] = pasarela.envolver(modelo_chat.with_structured_output(RespuestaChat))
+
+            # Cadenas de procesamiento
+            callbacks = [self.trazador.manejador_tokens]
+            cadena_detector = construidos["cadena_detector"] = (
+                self.prompt_detector | construidos["llm_detector"]
+            ).with_config(callbacks=callbacks)
+
+            # Micro-lotes: las detecciones concurrentes de varias sesiones que llegan
+            # dentro de la ventana se envían juntas con abatch (None = una llamada cada una)
+            construidos["agrupador_detector"] = None
+            if self.lote_detector_ms:
+                construidos["agrupador_detector"] = AgrupadorLotes(
+                    self.__dict__.get("cadena_detector", cadena_detector),
+                    ventana_ms=self.lote_detector_ms,
+                    max_lote=self.max_lote_detector,
+                )
+            construidos["cadena_chat"] = (self.prompt_chat | construidos["llm_chat"]).with_config(callbacks=callbacks)
+            construidos["cadena_fusionada"] = (
+                self.prompt_fusionado | pasarela.envolver(modelo_chat.with_structured_output(RespuestaFusionada))
+            ).with_config(callbacks=callbacks)
+
+            # Cadena de streaming: texto plano fragmento a fragmento (la salida
+            # estructurada no entrega nada hasta completar el JSON)
+            construidos["llm_chat_stream"] = pasarela.envolver(modelo_chat)
+            construidos["cadena_chat_stream"] = (
+                self.prompt_chat | construidos["llm_chat_stream"] | StrOutputParser()
+            ).with_config(callbacks=callbacks)
+
+            # Compactación en segundo plano: los mensajes más antiguos que el umbral
+            # se resumen y el resumen reemplaza a esos mensajes en el prompt
+            construidos["compactador"] = None
+            if self.umbral_resumen:
+                construidos["compactador"] = CompactadorHistorial(
+                    self.historiales,
+                    pasarela.envolver(self.fabrica_modelos("resumen")),
+                    umbral=self.umbral_resumen,
+                    lote_minimo=self.lote_resumen,
+                )
+
+            # No pisar lo que se haya asignado antes (p. ej. cadenas de prueba)
+            for nombre, valor in construidos.items():
+                self.__dict__.setdefault(nombre, valor)
+            self._modelos_listos = True
+            self.segundos_construccion_modelos = time.perf_counter() - inicio
+
+    async def _amodelos(self):
+        """Espera a que los modelos estén construidos, construyéndolos en un hilo de trabajo"""
+        if not self._modelos_listos:
+            # Importar y crear los clientes es bloqueante: fuera del loop. Con
+            # varias llamadas a la vez, el lock deja construir a una sola
+            await asyncio.get_running_loop().run_in_executor(None, self._construir_modelos)
+
+    def precalentar(self):
+        """
+        Construye modelos y cadenas y abre el pool Redis en segundo plano.
+
+        Devuelve un `concurrent.futures.Future` con los segundos que tardó;
+        el primer turno espera la construcción si aún no terminó.
+        """
+        return asyncio.run_coroutine_threadsafe(self._aprecalentar(), self._bucle)
+
+    async def _aprecalentar(self) -> float:
+        inicio = time.perf_counter()
+        try:
+            await self._amodelos()
+            await self.historiales.cliente().ping()
+            if self.detector_local is not None and self.detector_local.requiere_carga:
+                self.detector_local.cargar_usuarios(await self.alistar_usuarios_con_historial())
+        except Exception as e:
+            print(f"⚠️ Precalentamiento incompleto: {e}")
+        segundos = time.perf_counter() - inicio
+        print(f"🔥 Sistema precalentado en {segundos:.2f}s")
+        return segundos
+
+    # ----------------------------------------
+    # API asíncrona
+    # ----------------------------------------
+
+    async def adetectar_usuario(self, mensaje: str) -> DeteccionUsuario:
         """Detecta si el usuario se está identificando en el mensaje"""
-        return self.cadena_detector.invoke({"mensaje": mensaje})
+        await self._amodelos()
+        deteccion = await self._adetectar_local(mensaje)
+        if deteccion is not None:
+            return deteccion
+        return await self._ainvocar_detector(mensaje)
 
-    def obtener_historial(self, nombre_usuario: str) -> list:
+    async def _ainvocar_detector(self, mensaje: str) -> DeteccionUsuario:
+        """Llama al LLM detector, agrupando en micro-lotes si está configurado"""
+        if self.agrupador_detector is not None:
+            return await self.agrupador_detector.ainvocar({"mensaje": mensaje})
+        return await self.cadena_detector.ainvoke({"mensaje": mensaje})
+
+    async def _adetectar_local(self, mensaje: str) -> Optional[DeteccionUsuario]:
+        """Camino rápido: reglas locales, devuelve None si el caso es ambiguo"""
+        if self.detector_local is None:
+            return None
+        if self.detector_local.requiere_carga:
+            self.detector_local.cargar_usuarios(await self.alistar_usuarios_con_historial())
+        return self.detector_local.detectar(mensaje)
+
+    async def aobtener_historial(self, nombre_usuario: str) -> list:
         """Obtiene el historial de conversación de un usuario"""
-        history = RedisChatMessageHistory(
-            session_id=f"usuario_{nombre_usuario.lower()}",
-            url=self.redis_url
-        )
-        return history.messages
+        return await self.historiales.aobtener(nombre_usuario)
 
-    def procesar_mensaje(self, mensaje: str) -> RespuestaChat:
+    async def aobtener_historial_pagina(
+        self, nombre_usuario: str, cursor: Optional[int] = None, tamano: int = 20
+    ) -> dict:
+        """Página del historial, del mensaje más nuevo al más antiguo (ver `HistorialRedis.aobtener_pagina`)"""
+        return await self.historiales.aobtener_pagina(nombre_usuario, cursor, tamano)
+
+    async def abuscar_en_historial(
+        self, nombre_usuario: str, texto: str, limite: int = 20, cursor: Optional[int] = None
+    ) -> dict:
+        """Mensajes del historial que contienen `texto`, sin cargarlo completo"""
+        return await self.historiales.abuscar(nombre_usuario, texto, limite, cursor)
+
+    async def aprocesar_mensaje(self, mensaje: str, sesion: Optional[SesionChat] = None) -> RespuestaChat:
         """Procesa un mensaje del usuario, detecta identificación y genera respuesta"""
-        # Detectar si hay identificación de usuario
-        deteccion = self.detectar_usuario(mensaje)
+        sesion = sesion or self.sesion_por_defecto
+        sesion.ultimo_uso = time.time()
+        await self._amodelos()
+        with self.trazador.turno(sesion.id_sesion) as traza:
+            respuesta_obj = await self._aprocesar_mensaje(mensaje, sesion)
+            traza.usuario = sesion.usuario_actual
+            return respuesta_obj
+
+    async def _aprocesar_mensaje(self, mensaje: str, sesion: SesionChat) -> RespuestaChat:
+        # Detectar si hay identificación de usuario (primero con reglas locales)
+        with etapa("detectar"):
+            deteccion = await self._adetectar_local(mensaje)
+        usuario_especulado = sesion.usuario_actual
+
+        if deteccion is None and self.modo_fusionado and sesion.usuario_actual:
+            # Caso ambiguo con usuario actual: detectar y responder en una sola llamada
+            usuario = sesion.usuario_actual
+            async with self._aturno_usuario(usuario) as fencing:
+                respuesta_obj = await self._agenerar_fusionado(mensaje, sesion)
+                if respuesta_obj is not None:
+                    await self._apersistir_turno(usuario, mensaje, respuesta_obj.mensaje, fencing)
+                    return respuesta_obj
+            # Cambió el usuario: se regenera con su historial (y bajo su bloqueo)
+            return await self._aresponder_y_persistir(mensaje, sesion)
+
+        if deteccion is None and self.modo_especulativo and usuario_especulado:
+            # Caso ambiguo: adelantar la respuesta del usuario actual mientras
+            # detecta el LLM (con su bloqueo tomado, porque ya lee su historial)
+            async with self._aturno_usuario(usuario_especulado) as fencing:
+                especulacion = asyncio.ensure_future(
+                    self._agenerar_respuesta(mensaje, usuario_especulado, sesion, especulativa=True)
+                )
+                self._contar_especulacion("lanzadas")
+                inicio_deteccion = time.perf_counter()
+                try:
+                    with etapa("detectar"):
+                        deteccion = await self._ainvocar_detector(mensaje)
+                except BaseException:
+                    await self._adescartar(especulacion)
+                    raise
+                duracion_deteccion = time.perf_counter() - inicio_deteccion
+                self._aplicar_deteccion(deteccion, sesion)
+
+                # Usar la respuesta especulativa solo si el usuario no cambió;
+                # recién entonces se registran su contexto y su entrada en la caché
+                if sesion.usuario_actual.lower() == usuario_especulado.lower():
+                    respuesta_obj, aceptar = await especulacion
+                    await aceptar()
+                    self._contar_especulacion("aprovechadas", duracion_deteccion)
+                    await self._apersistir_turno(usuario_especulado, mensaje, respuesta_obj.mensaje, fencing)
+                    return respuesta_obj
+                await self._adescartar(especulacion)
+                self._contar_especulacion("descartadas")
+                print("♻️ Especulación descartada por cambio de usuario")
+            return await self._aresponder_y_persistir(mensaje, sesion)
+
+        if deteccion is None:
+            with etapa("detectar"):
+                deteccion = await self._ainvocar_detector(mensaje)
+
+        # Si no hay usuario actual, pedir identificación
+        pedir_identificacion = self._aplicar_deteccion(deteccion, sesion)
+        if pedir_identificacion is not None:
+            return pedir_identificacion
+        return await self._aresponder_y_persistir(mensaje, sesion)
+
+    @staticmethod
+    async def _adescartar(tarea: asyncio.Task):
+        """Cancela una tarea y espera a que termine, sin propagar su resultado ni su error"""
+        tarea.cancel()
+        with suppress(asyncio.CancelledError, Exception):
+            await tarea
+
+    async def _aresponder_y_persistir(self, mensaje: str, sesion: SesionChat) -> RespuestaChat:
+        """Genera y guarda la respuesta para el usuario de la sesión bajo su bloqueo"""
+        usuario = sesion.usuario_actual
+        async with self._aturno_usuario(usuario) as fencing:
+            respuesta_obj = await self._agenerar_respuesta(mensaje, usuario, sesion)
+            await self._apersistir_turno(usuario, mensaje, respuesta_obj.mensaje, fencing)
+        return respuesta_obj
+
+    @asynccontextmanager
+    async def _aturno_usuario(self, usuario: str):
+        """
+        Bloqueo del usuario durante lectura del historial, generación y
+        escritura; entrega el token de fencing (None sin `bloqueo_por_usuario`)
+        """
+        if self.bloqueos is None:
+            yield None
+            return
+        arrendamiento = self.bloqueos.turno(usuario)
+        with etapa("bloqueo"):
+            await arrendamiento.aadquirir()
+        try:
+            yield arrendamiento.token
+        finally:
+            await arrendamiento.aliberar()
+
+    async def aprocesar_mensaje_stream(self, mensaje: str, sesion: Optional[SesionChat] = None):
+        """
+        Versión en streaming de `aprocesar_mensaje`.
+
+        Genera fragmentos de texto (`str`) a medida que llegan del modelo y,
+        al final, el `RespuestaChat` completo con los metadatos del turno.
+        """
+        sesion = sesion or self.sesion_por_defecto
+        sesion.ultimo_uso = time.time()
+        await self._amodelos()
+
+        # Cada fragmento puede reanudarse en otra tarea (envoltorio síncrono), por
+        # eso la traza se vuelve a activar tras cada yield en lugar de usar `turno`
+        traza = self.trazador.iniciar(sesion.id_sesion)
+        try:
+            with etapa("detectar"):
+                deteccion = await self.adetectar_usuario(mensaje)
+            pedir_identificacion = self._aplicar_deteccion(deteccion, sesion)
+            if pedir_identificacion is not None:
+                yield pedir_identificacion.mensaje
+                yield pedir_identificacion
+                return
+
+            usuario = traza.usuario = sesion.usuario_actual
+            async with self._aturno_usuario(usuario) as fencing:
+                async for parte in self._agenerar_stream(mensaje, usuario, sesion, traza, fencing):
+                    yield parte
+                    activar(traza)
+        except BaseException as e:
+            traza.error = type(e).__name__
+            raise
+        finally:
+            self.trazador.terminar(traza)
+
+    async def _agenerar_stream(
+        self, mensaje: str, usuario: str, sesion: SesionChat, traza, fencing: Optional[int]
+    ):
+        """Fragmentos de la respuesta y, al final, el `RespuestaChat` ya guardado"""
+        entradas = await self._apreparar_entradas(mensaje, usuario, sesion)
+        guardada = None
+        if self.cache_respuestas is not None:
+            guardada = await self._abuscar_respuesta_guardada(usuario, mensaje, entradas)
+
+        if guardada is not None:
+            respuesta_obj = RespuestaChat(**{**guardada, "usuario_actual": usuario})
+            yield respuesta_obj.mensaje
+        else:
+            fragmentos = []
+            inicio = time.perf_counter()
+            async for fragmento in self.cadena_chat_stream.astream(entradas):
+                if fragmento:
+                    fragmentos.append(fragmento)
+                    yield fragmento
+                    activar(traza)
+            traza.sumar_etapa("generar", time.perf_counter() - inicio)
+
+            respuesta_obj = RespuestaChat(
+                mensaje="".join(fragmentos),
+                usuario_actual=usuario,
+                requiere_identificacion=False,
+            )
+            if self.cache_respuestas is not None:
+                await self.cache_respuestas.aguardar(
+                    usuario, mensaje, entradas, respuesta_obj.model_dump()
+                )
+        await self._apersistir_turno(usuario, mensaje, respuesta_obj.mensaje, fencing)
+        yield respuesta_obj
 
+    def _aplicar_deteccion(
+        self, deteccion: DeteccionUsuario, sesion: SesionChat
+    ) -> Optional[RespuestaChat]:
+        """Actualiza el usuario de la sesión; devuelve la respuesta de identificación si falta"""
         # Si se detecta un usuario, cambiar el usuario actual
         if deteccion.usuario_identificado and deteccion.nombre_usuario:
-            self.usuario_actual = deteccion.nombre_usuario
-            print(f"🔄 Usuario identificado: {self.usuario_actual}")
+            if nombre_usuario_valido(deteccion.nombre_usuario):
+                sesion.usuario_actual = deteccion.nombre_usuario
+                print(f"🔄 Usuario identificado: {sesion.usuario_actual}")
+            else:
+                print(f"⚠️ Nombre detectado no válido, se ignora: {deteccion.nombre_usuario!r}")
 
         # Si no hay usuario actual, pedir identificación
-        if not self.usuario_actual:
+        if not sesion.usuario_actual:
             return RespuestaChat(
                 mensaje=(
                     "¡Hola! Soy tu asistente personal. Para poder recordar nuestras conversaciones, "
@@ -137,29 +658,475 @@ class ChatMultiUsuario:
                 usuario_actual=None,
                 requiere_identificacion=True
             )
+        return None
 
-        # Generar respuesta usando el historial del usuario actual
-        session_id = f"usuario_{self.usuario_actual.lower()}"
+    async def _apersistir_turno(
+        self, usuario: str, mensaje: str, respuesta: str, fencing: Optional[int] = None
+    ):
+        """
+        Guarda pregunta y respuesta en Redis en un solo round trip atómico
+        (con `fencing`, solo si el bloqueo del usuario sigue siendo de este turno)
+        """
+        with etapa("persistir"):
+            longitud = await self.historiales.aagregar(
+                usuario, [HumanMessage(content=mensaje), AIMessage(content=respuesta)], fencing
+            )
+        if self.archivar_mas_de is not None and longitud >= self.archivar_mas_de + MIN_SEGMENTO_ARCHIVO:
+            self._programar_archivo(usuario)
+        if self.detector_local is not None:
+            self.detector_local.registrar_usuario(usuario)
+        if self.memoria is not None:
+            self.memoria.programar_indexado(usuario, mensaje, respuesta)
+
+    def _programar_archivo(self, usuario: str):
+        """Archiva los mensajes antiguos del usuario en segundo plano"""
+        usuario = usuario.lower()
+        if usuario in self._archivando:
+            return
+        self._archivando.add(usuario)
+        tarea = asyncio.ensure_future(self._aarchivar(usuario))
+        self._tareas_archivo.add(tarea)
+        tarea.add_done_callback(self._tareas_archivo.discard)
+        tarea.add_done_callback(lambda _: self._archivando.discard(usuario))
+
+    async def _aarchivar(self, usuario: str):
+        # Con compactación solo se archiva lo ya resumido, para que el
+        # compactador lea el tramo pendiente de la lista
+        hasta = None
+        try:
+            await self._amodelos()
+            if self.compactador is not None:
+                _, hasta, _ = await self.compactador.aestado(usuario)
+            archivados = await self.historiales.aarchivar(
+                usuario, self.archivar_mas_de, hasta, minimo=MIN_SEGMENTO_ARCHIVO
+            )
+        except Exception as e:
+            print(f"❌ Error al archivar historial de {usuario}: {e}")
+            return
+        if archivados:
+            print(f"📦 Historial de {usuario}: {archivados} mensajes archivados")
+
+    async def aobtener_contexto(self, nombre_usuario: str, limite: Optional[int] = None) -> list:
+        """Historial que se envía al LLM según la política de contexto"""
+        limites = [n for n in (self.max_mensajes_contexto, limite) if n is not None]
+        max_mensajes = min(limites) if limites else None
+        if max_mensajes == 0:
+            return []
+
+        if self.max_tokens_contexto:
+            mensajes = await self.historiales.aobtener_por_presupuesto(
+                nombre_usuario, self.max_tokens_contexto, max_mensajes
+            )
+        elif max_mensajes is not None:
+            mensajes = await self.historiales.aobtener_recientes(nombre_usuario, max_mensajes)
+        else:
+            return await self.aobtener_historial(nombre_usuario)
+
+        # Al recortar, no empezar con una respuesta del asistente sin su pregunta
+        while mensajes and isinstance(mensajes[0], AIMessage):
+            mensajes = mensajes[1:]
+        return mensajes
+
+    async def _agenerar_respuesta(
+        self, mensaje: str, usuario: str, sesion: Optional[SesionChat] = None, especulativa: bool = False
+    ):
+        """
+        Genera la respuesta del chat usando el historial del usuario indicado.
 
-        # Obtener historial y generar respuesta
-        chat_history = self.obtener_historial(self.usuario_actual)
-        respuesta_obj = self.cadena_chat.invoke({
-            "input": mensaje,
-            "usuario_actual": self.usuario_actual,
-            "chat_history": chat_history
-        })
+        Con `especulativa` no deja rastro (contexto de la sesión, métricas ni
+        caché de respuestas) hasta que se acepta: devuelve (respuesta, aceptar)
+        y quien la usa debe esperar `aceptar()`.
+        """
+        entradas = await self._apreparar_entradas(mensaje, usuario, sesion, registrar=not especulativa)
+        guardada = None
+        with etapa("generar"):
+            if self.cache_respuestas is not None:
+                guardada = await self._abuscar_respuesta_guardada(usuario, mensaje, entradas)
+            if guardada is not None:
+                respuesta_obj = RespuestaChat(**{**guardada, "usuario_actual": usuario})
+            else:
+                respuesta_obj = await self.cadena_chat.ainvoke(entradas)
 
-        # Guardar manualmente los mensajes en Redis
-        historial = RedisChatMessageHistory(session_id=session_id, url=self.redis_url)
-        historial.add_user_message(mensaje)
-        historial.add_ai_message(respuesta_obj.mensaje)
+        async def aceptar():
+            if especulativa:
+                self._registrar_contexto(usuario, entradas["chat_history"], entradas, sesion)
+            if guardada is None and self.cache_respuestas is not None:
+                await self.cache_respuestas.aguardar(usuario, mensaje, entradas, respuesta_obj.model_dump())
 
+        if especulativa:
+            return respuesta_obj, aceptar
+        await aceptar()
         return respuesta_obj
 
-    def cambiar_usuario(self, nuevo_usuario: str):
+    async def _agenerar_fusionado(self, mensaje: str, sesion: SesionChat) -> Optional[RespuestaChat]:
+        """
+        Detección y respuesta en una sola llamada con el historial del usuario
+        actual. Si el modelo detecta otro usuario, cambia la sesión y devuelve
+        None: hay que regenerar con el historial correcto. No usa la caché de
+        respuestas: un acierto saltaría la detección.
+        """
+        usuario = sesion.usuario_actual
+        entradas = await self._apreparar_entradas(mensaje, usuario, sesion)
+        with etapa("generar"):
+            fusionada = await self.cadena_fusionada.ainvoke(entradas)
+        self._aplicar_deteccion(fusionada.deteccion(), sesion)
+        self._contar_fusion("llamadas")
+
+        if sesion.usuario_actual.lower() != usuario.lower():
+            self._contar_fusion("regeneradas")
+            print("♻️ Respuesta fusionada regenerada por cambio de usuario")
+            return None
+        return RespuestaChat(
+            mensaje=fusionada.mensaje,
+            usuario_actual=usuario,
+            requiere_identificacion=fusionada.requiere_identificacion,
+        )
+
+    async def _abuscar_respuesta_guardada(self, usuario: str, mensaje: str, entradas: dict):
+        """Consulta la caché de respuestas y anota el resultado en la traza del turno"""
+        guardada = await self.cache_respuestas.abuscar(usuario, mensaje, entradas)
+        anotar("cache_respuestas", "acierto" if guardada is not None else "fallo")
+        return guardada
+
+    async def _apreparar_entradas(
+        self, mensaje: str, usuario: str, sesion: Optional[SesionChat] = None, registrar: bool = True
+    ) -> dict:
+        """
+        Arma las variables del prompt del chat: historial, resumen y recuerdos.
+        Con `registrar=False` no anota el contexto en la sesión ni en las métricas.
+        """
+        entradas = {"input": mensaje, "usuario_actual": usuario}
+
+        # Con compactación, solo se envían los mensajes que el resumen aún no cubre
+        limite = None
+        if self.compactador is not None:
+            with etapa("prompt"):
+                resumen, cubiertos, total = await self.compactador.aestado(usuario)
+            limite = max(total - cubiertos, 0)
+            if resumen:
+                entradas["resumen"] = resumen
+            if self.compactador.necesita_compactar(cubiertos, total):
+                self.compactador.programar(usuario)
+
+        with etapa("historial"):
+            chat_history = await self.aobtener_contexto(usuario, limite)
+        entradas["chat_history"] = chat_history
+
+        with etapa("prompt"):
+            if self.memoria is not None:
+                recientes = {m.content for m in chat_history if isinstance(m, HumanMessage)}
+                recuerdos = await self.memoria.abuscar(usuario, mensaje, self.k_memoria, recientes)
+                if recuerdos:
+                    entradas["recuerdos"] = "\n".join(
+                        f"- {usuario}: {r['humano']} / Asistente: {r['asistente']}" for r in recuerdos
+                    )
+            if registrar:
+                self._registrar_contexto(usuario, chat_history, entradas, sesion)
+        return entradas
+
+    def _registrar_contexto(
+        self, usuario: str, chat_history: list, entradas: dict, sesion: Optional[SesionChat] = None
+    ):
+        """Registra los tokens (estimados) del prompt enviado en este turno"""
+        tokens_prompt = sum(
+            estimar_tokens_mensaje(m) for m in self.prompt_chat.format_messages(**entradas)
+        )
+        # El detalle del último turno vive en la sesión: el motor es compartido
+        (sesion or self.sesion_por_defecto).ultimo_contexto = {
+            "usuario": usuario,
+            "mensajes_historial": len(chat_history),
+            "tokens_historial": sum(estimar_tokens_mensaje(m) for m in chat_history),
+            "tokens_prompt": tokens_prompt,
+        }
+        anotar("mensajes_historial", len(chat_history))
+        anotar("tokens_prompt", tokens_prompt)
+        with self._lock_metricas:
+            self.metricas_contexto["turnos"] += 1
+            self.metricas_contexto["tokens_prompt"] += tokens_prompt
+            self.metricas_contexto["mensajes_historial"] += len(chat_history)
+
+    async def aimportar_conversaciones(self, conversaciones: dict, tamano_lote: int = 100) -> int:
+        """Importa historiales {usuario: [mensajes]} en lotes pipelined"""
+        escritos = await self.historiales.aimportar(conversaciones, tamano_lote)
+        if self.detector_local is not None:
+            for nombre_usuario in conversaciones:
+                self.detector_local.registrar_usuario(nombre_usuario)
+        return escritos
+
+    async def alistar_usuarios_con_historial(
+        self, offset: int = 0, limite: Optional[int] = None, orden: str = "reciente"
+    ) -> list:
+        """Lista los usuarios con conversaciones previas, los más activos primero"""
+        try:
+            return await self.historiales.alistar_usuarios(offset, limite, orden)
+        except Exception as e:
+            print(f"❌ Error al conectar con Redis: {e}")
+            return []
+
+    async def alistar_usuarios_detalle(
+        self, offset: int = 0, limite: Optional[int] = None, orden: str = "reciente"
+    ) -> list:
+        """Usuarios con última actividad y número de mensajes"""
+        return await self.historiales.alistar_usuarios_detalle(offset, limite, orden)
+
+    async def acerrar(self):
+        """Espera las tareas en segundo plano (resúmenes, memoria, archivo) y cierra las conexiones a Redis"""
+        compactador = self.__dict__.get("compactador")
+        if compactador is not None:
+            await compactador.aesperar()
+        if self.memoria is not None:
+            await self.memoria.aesperar()
+        if self._tareas_archivo:
+            await asyncio.gather(*list(self._tareas_archivo), return_exceptions=True)
+        if self.bloqueos is not None:
+            await self.bloqueos.acerrar()
+        await self.historiales.acerrar()
+
+    async def _acancelar_pendientes(self):
+        """Cancela las tareas que sigan en el event loop propio (renovaciones, precalentado)"""
+        actual = asyncio.current_task()
+        pendientes = [t for t in asyncio.all_tasks() if t is not actual]
+        for tarea in pendientes:
+            tarea.cancel()
+        await asyncio.gather(*pendientes, return_exceptions=True)
+
+    def cerrar(self):
+        """
+        Cierra las conexiones (`acerrar`), detiene el event loop propio y
+        espera a su hilo. Después de cerrar, el motor ya no se puede usar.
+        No debe llamarse desde el propio event loop.
+        """
+        if self._bucle.is_closed():
+            return
+        if threading.current_thread() is self._hilo_bucle:
+            raise RuntimeError("cerrar() no puede llamarse desde el event loop del chat; usar acerrar()")
+        try:
+            self._ejecutar(self.acerrar())
+            self._ejecutar(self._acancelar_pendientes())
+        except Exception as e:
+            print(f"❌ Error al cerrar el chat: {e}")
+        finally:
+            self._bucle.call_soon_threadsafe(self._bucle.stop)
+            self._hilo_bucle.join()
+            self._bucle.close()
+
+    # ----------------------------------------
+    # API síncrona (envoltorios de la API async)
+    # ----------------------------------------
+
+    def _ejecutar(self, corrutina):
+        """Ejecuta una corrutina en el event loop propio y espera su resultado"""
+        return asyncio.run_coroutine_threadsafe(corrutina, self._bucle).result()
+
+    def detectar_usuario(self, mensaje: str) -> DeteccionUsuario:
+        """Detecta si el usuario se está identificando en el mensaje"""
+        return self._ejecutar(self.adetectar_usuario(mensaje))
+
+    def obtener_historial(self, nombre_usuario: str) -> list:
+        """Obtiene el historial de conversación de un usuario"""
+        return self._ejecutar(self.aobtener_historial(nombre_usuario))
+
+    def obtener_historial_pagina(
+        self, nombre_usuario: str, cursor: Optional[int] = None, tamano: int = 20
+    ) -> dict:
+        """Página del historial, del mensaje más nuevo al más antiguo"""
+        return self._ejecutar(self.aobtener_historial_pagina(nombre_usuario, cursor, tamano))
+
+    def buscar_en_historial(
+        self, nombre_usuario: str, texto: str, limite: int = 20, cursor: Optional[int] = None
+    ) -> dict:
+        """Mensajes del historial que contienen `texto`, sin cargarlo completo"""
+        return self._ejecutar(self.abuscar_en_historial(nombre_usuario, texto, limite, cursor))
+
+    def procesar_mensaje(self, mensaje: str, sesion: Optional[SesionChat] = None) -> RespuestaChat:
+        """Procesa un mensaje del usuario, detecta identificación y genera respuesta"""
+        return self._ejecutar(self.aprocesar_mensaje(mensaje, sesion))
+
+    def procesar_mensaje_stream(self, mensaje: str, sesion: Optional[SesionChat] = None):
+        """Generador síncrono: fragmentos de texto y, al final, el `RespuestaChat`"""
+        generador = self.aprocesar_mensaje_stream(mensaje, sesion)
+        try:
+            while True:
+                try:
+                    yield self._ejecutar(generador.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self._ejecutar(generador.aclose())
+
+    def listar_usuarios_con_historial(
+        self, offset: int = 0, limite: Optional[int] = None, orden: str = "reciente"
+    ) -> list:
+        """Lista los usuarios con conversaciones previas, los más activos primero"""
+        return self._ejecutar(self.alistar_usuarios_con_historial(offset, limite, orden))
+
+    def listar_usuarios_detalle(
+        self, offset: int = 0, limite: Optional[int] = None, orden: str = "reciente"
+    ) -> list:
+        """Usuarios con última actividad y número de mensajes"""
+        return self._ejecutar(self.alistar_usuarios_detalle(offset, limite, orden))
+
+    def importar_conversaciones(self, conversaciones: dict, tamano_lote: int = 100) -> int:
+        """Importa historiales {usuario: [mensajes]} en lotes pipelined"""
+        return self._ejecutar(self.aimportar_conversaciones(conversaciones, tamano_lote))
+
+    # ----------------------------------------
+    # Sesiones
+    # ----------------------------------------
+
+    def obtener_sesion(self, id_sesion: str, max_inactividad: float = 3600) -> SesionChat:
+        """Devuelve (o crea) la sesión de una conversación y descarta las inactivas"""
+        ahora = time.time()
+        with self._lock_sesiones:
+            if ahora - self._ultima_limpieza > 60:
+                self._ultima_limpieza = ahora
+                for id_inactiva in [
+                    i for i, s in self.sesiones.items() if ahora - s.ultimo_uso > max_inactividad
+                ]:
+                    del self.sesiones[id_inactiva]
+            sesion = self.sesiones.get(id_sesion)
+            if sesion is None:
+                sesion = self.sesiones[id_sesion] = SesionChat(id_sesion)
+            sesion.ultimo_uso = ahora
+            return sesion
+
+    def cerrar_sesion(self, id_sesion: str):
+        """Olvida el estado de una conversación"""
+        with self._lock_sesiones:
+            self.sesiones.pop(id_sesion, None)
+
+    @property
+    def usuario_actual(self) -> Optional[str]:
+        """Usuario de la sesión por defecto (terminal y uso de una sola conversación)"""
+        return self.sesion_por_defecto.usuario_actual
+
+    @usuario_actual.setter
+    def usuario_actual(self, valor: Optional[str]):
+        self.sesion_por_defecto.usuario_actual = valor
+
+    # ----------------------------------------
+    # Métricas
+    # ----------------------------------------
+
+    def estadisticas_deteccion(self) -> dict:
+        """Aciertos del detector local y llamadas al LLM detector evitadas"""
+        if self.detector_local is None:
+            return {}
+        return self.detector_local.estadisticas()
+
+    def estadisticas_redis(self) -> dict:
+        """Uso del pool de conexiones Redis (en uso, esperas, conexiones creadas)"""
+        return self.historiales.estadisticas_pool()
+
+    def estadisticas_cache(self) -> dict:
+        """Aciertos, desalojos y bytes retenidos por la caché de historiales"""
+        if self.historiales.cache is None:
+            return {}
+        return self.historiales.cache.estadisticas()
+
+    def estadisticas_cache_respuestas(self) -> dict:
+        """Aciertos exactos y semánticos de la caché de respuestas"""
+        if self.cache_respuestas is None:
+            return {}
+        return self.cache_respuestas.estadisticas()
+
+    def estadisticas_lotes_detector(self) -> dict:
+        """Tamaño de los micro-lotes del detector y espera agregada por la ventana"""
+        agrupador = self.__dict__.get("agrupador_detector")
+        if agrupador is None:
+            return {}
+        return agrupador.estadisticas()
+
+    def ultimas_trazas(self, cantidad: int = 20, sesion: Optional[SesionChat] = None) -> list:
+        """Desglose por etapa de los últimos turnos (más nuevos primero)"""
+        return self.trazador.ultimas(cantidad, sesion.id_sesion if sesion is not None else None)
+
+    def estadisticas_cache_prompts(self) -> dict:
+        """Tokens de entrada leídos de la caché de prompts del proveedor (de las trazas)"""
+        tokens = self.trazador.tokens()
+        entrada, en_cache = tokens["entrada"], tokens["entrada_cache"]
+        return {
+            "tokens_entrada": entrada,
+            "tokens_en_cache": en_cache,
+            "tokens_sin_cache": entrada - en_cache,
+            "tasa_cache": en_cache / entrada if entrada else 0.0,
+        }
+
+    def estadisticas_contexto(self, sesion: Optional[SesionChat] = None) -> dict:
+        """
+        Tokens enviados por turno (estimados) y tamaño medio del historial
+        usado, en todo el motor; `ultimo_turno` es el de la sesión indicada
+        """
+        with self._lock_metricas:
+            metricas = dict(self.metricas_contexto)
+        turnos = metricas["turnos"]
+        metricas["tokens_prompt_promedio"] = metricas["tokens_prompt"] / turnos if turnos else 0.0
+        metricas["mensajes_historial_promedio"] = (
+            metricas["mensajes_historial"] / turnos if turnos else 0.0
+        )
+        metricas["ultimo_turno"] = dict((sesion or self.sesion_por_defecto).ultimo_contexto)
+        return metricas
+
+    def estadisticas_resumen(self) -> dict:
+        """Compactaciones realizadas y mensajes incorporados a resúmenes"""
+        compactador = self.__dict__.get("compactador")
+        if compactador is None:
+            return {}
+        return compactador.estadisticas()
+
+    def estadisticas_memoria(self) -> dict:
+        """Intercambios indexados y búsquedas de la memoria semántica"""
+        if self.memoria is None:
+            return {}
+        return self.memoria.estadisticas()
+
+    def _contar_especulacion(self, evento: str, segundos_solapados: float = 0.0):
+        with self._lock_metricas:
+            self.metricas_especulacion[evento] += 1
+            self.metricas_especulacion["segundos_solapados"] += segundos_solapados
+
+    def estadisticas_especulacion(self) -> dict:
+        """Especulaciones lanzadas, aprovechadas y desperdiciadas"""
+        with self._lock_metricas:
+            metricas = dict(self.metricas_especulacion)
+        resueltas = metricas["aprovechadas"] + metricas["descartadas"]
+        metricas["tasa_desperdicio"] = metricas["descartadas"] / resueltas if resueltas else 0.0
+        return metricas
+
+    def estadisticas_pasarela(self) -> dict:
+        """Cola, esperas, rechazos, reintentos y estado del circuito de las llamadas al LLM"""
+        return self.pasarela_llm.estadisticas()
+
+    def estadisticas_bloqueo(self) -> dict:
+        """Turnos que tomaron el bloqueo de su usuario y cuánto esperaron"""
+        if self.bloqueos is None:
+            return {"activo": False}
+        return {"activo": True, **self.bloqueos.estadisticas()}
+
+    def _contar_fusion(self, evento: str):
+        with self._lock_metricas:
+            self.metricas_fusion[evento] += 1
+
+    def estadisticas_fusion(self) -> dict:
+        """Llamadas fusionadas y cuántas hubo que regenerar por cambio de usuario"""
+        with self._lock_metricas:
+            metricas = dict(self.metricas_fusion)
+        metricas["tasa_regeneracion"] = (
+            metricas["regeneradas"] / metricas["llamadas"] if metricas["llamadas"] else 0.0
+        )
+        return metricas
+
+    # ----------------------------------------
+    # Utilidades
+    # ----------------------------------------
+
+    def cambiar_usuario(self, nuevo_usuario: str, sesion: Optional[SesionChat] = None):
         """Cambia manualmente el usuario actual"""
-        self.usuario_actual = nuevo_usuario
-        print(f"🔄 Usuario cambiado a: {self.usuario_actual}")
+        if not nombre_usuario_valido(nuevo_usuario):
+            raise ValueError(f"Nombre de usuario no válido: {nuevo_usuario!r}")
+        sesion = sesion or self.sesion_por_defecto
+        sesion.usuario_actual = nuevo_usuario
+        print(f"🔄 Usuario cambiado a: {sesion.usuario_actual}")
 
     def mostrar_historial(self, nombre_usuario: str):
         """Muestra el historial de conversación de un usuario"""
@@ -178,35 +1145,6 @@ class ChatMultiUsuario:
                 print(f"{i}. 🤖 Asistente: {mensaje.content}")
         print("-" * 50)
 
-    def listar_usuarios_con_historial(self) -> list:
-        """Lista todos los usuarios con conversaciones previas"""
-        import redis
-        usuarios = []
-        try:
-            # Crear conexión Redis temporal
-            redis_client = redis.from_url(self.redis_url)
-            
-            # Buscar claves de usuarios
-            keys = redis_client.keys("message_store:usuario_*")
-            
-            for key in keys:
-                # Extraer nombre de usuario de la key
-                key_str = key.decode('utf-8') if isinstance(key, bytes) else key
-                
-                if key_str.startswith('message_store:usuario_'):
-                    # Extraer el nombre después de 'message_store:usuario_'
-                    usuario = key_str.replace('message_store:usuario_', '')
-                    # Verificar que la clave tiene contenido
-                    longitud = redis_client.llen(key_str)
-                    
-                    if longitud > 0:
-                        usuarios.append(usuario)
-                    
-        except Exception as e:
-            print(f"❌ Error al conectar con Redis: {e}")
-        
-        return usuarios
-
 # ========================================
 # 3. FUNCIÓN PRINCIPAL INTERACTIVA
 # ========================================
@@ -238,8 +1176,10 @@ def chat_interactivo():
     
     print(f"✅ Credenciales cargadas desde .env")
     
-    # Inicializar el sistema
-    chat_system = ChatMultiUsuario(REDIS_URL, OPENAI_API_KEY)
+    # Inicializar el sistema: los modelos se construyen en segundo plano
+    # mientras el usuario escribe su primer mensaje
+    chat_system = ChatMultiUsuario(REDIS_URL, OPENAI_API_KEY, inicializacion_perezosa=True)
+    chat_system.precalentar()
     
     print("\n🚀 Sistema iniciado. ¡Comienza a conversar!")
     print("💡 Tip: Identifícate diciendo 'Soy [tu nombre]' para que te recuerde.\n")
@@ -260,7 +1200,7 @@ def chat_interactivo():
                     nombre = mensaje.split('cambiar usuario')[1].strip()
                     chat_system.cambiar_usuario(nombre)
                     continue
-                except IndexError:
+                except (IndexError, ValueError):
                     print("❌ Uso: cambiar usuario [nombre]")
                     continue
             
@@ -285,17 +1225,24 @@ def chat_interactivo():
             if not mensaje:
                 continue
             
-            print("🤖 Asistente: ", end="")
-            respuesta = chat_system.procesar_mensaje(mensaje)
-            print(respuesta.mensaje)
+            print("🤖 Asistente: ", end="", flush=True)
+            for parte in chat_system.procesar_mensaje_stream(mensaje):
+                if isinstance(parte, str):
+                    print(parte, end="", flush=True)
+            print()
             
         except KeyboardInterrupt:
             print("\n\n👋 Chat interrumpido. ¡Hasta luego!")
             break
+        except LLMSaturado as e:
+            print(f"\n⏳ {e}")
+            continue
         except Exception as e:
             print(f"❌ Error: {e}")
             continue
 
+    chat_system.cerrar()
+
 # ========================================
 # 4. FUNCIÓN DE TESTING
 # ========================================
@@ -340,6 +1287,55 @@ def test_multi_usuario():
         print(f"🤖 Asistente: {respuesta.mensaje}")
         print(f"👥 Usuario actual: {respuesta.usuario_actual}")
 
+def test_prefijo_prompts():
+    """
+    Regresión de la caché de prompts: los mensajes estáticos del inicio de
+    cada prompt deben ser idénticos byte a byte para cualquier usuario y
+    turno, y el contexto del usuario no debe cambiar entre sus turnos.
+    No necesita Redis ni OpenAI.
+    """
+    from modelos import fabrica_falsa
+
+    print("🧪 TESTING PREFIJO DE PROMPTS")
+    print("=" * 40)
+
+    chat = ChatMultiUsuario(
+        "redis://localhost:6379", fabrica_modelos=fabrica_falsa(), inicializacion_perezosa=True
+    )
+    compactador = CompactadorHistorial(chat.historiales, chat.fabrica_modelos("resumen"))
+    historial = [HumanMessage(content="Mi color favorito es azul"), AIMessage(content="¡Anotado!")]
+    turnos = [
+        {"usuario_actual": "Ana", "input": "Hola, soy Ana", "chat_history": []},
+        {"usuario_actual": "Ana", "input": "¿Cuál es mi color?", "chat_history": historial,
+         "recuerdos": "- Ana: me gusta el azul / Asistente: ¡Anotado!"},
+        {"usuario_actual": "Pablo", "input": "Soy Pablo", "chat_history": [],
+         "resumen": "- Le gusta el fútbol"},
+    ]
+
+    def serializar(mensajes: list) -> list:
+        return [f"{m.type}\0{m.content}".encode("utf-8") for m in mensajes]
+
+    # prompt -> (variables por turno, mensajes estáticos, mensajes fijos por usuario)
+    casos = {
+        "chat": (chat.prompt_chat, turnos, 1, 2),
+        "fusionado": (chat.prompt_fusionado, turnos, 2, 3),
+        "detector": (chat.prompt_detector, [{"mensaje": t["input"]} for t in turnos], 1, 1),
+        "resumen": (compactador.prompt_resumen, [
+            {"usuario": t["usuario_actual"], "resumen": t.get("resumen", ""), "mensajes": t["input"]}
+            for t in turnos
+        ], 1, 1),
+    }
+    for nombre, (prompt, variables, estaticos, por_usuario) in casos.items():
+        formateados = [serializar(prompt.format_messages(**v)) for v in variables]
+        prefijos = {b"".join(f[:estaticos]) for f in formateados}
+        assert len(prefijos) == 1, f"El prefijo estático de {nombre} cambia entre usuarios o turnos"
+        assert all(len(f) > estaticos for f in formateados), f"{nombre} no tiene partes variables"
+        # Los dos primeros turnos son de Ana: su contexto de usuario tampoco cambia
+        assert formateados[0][:por_usuario] == formateados[1][:por_usuario], (
+            f"El contexto de usuario de {nombre} cambia entre turnos"
+        )
+        print(f"✅ {nombre}: {len(prefijos.pop())} bytes estáticos")
+
 if __name__ == "__main__":
     # Ejecutar en modo interactivo
     chat_interactivo() 
\ No newline at end of file
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Detector local de identificación de usuarios
+
+Motor basado en reglas que resuelve los casos obvios ("Soy X", "Me llamo X",
+"aquí X otra vez" o mensajes sin identificación) sin llamar al LLM detector.
+Solo los mensajes ambiguos se envían a `cadena_detector`.
+"""
+
+import re
+import threading
+from typing import Iterable, Optional
+
+# Letras (incluye acentos y ñ), sin dígitos ni guion bajo
+_PALABRA = r"[^\W\d_]+"
+# El segundo nombre (opcional) debe ir en mayúscula: los patrones son sensibles
+# a mayúsculas y solo las palabras clave usan (?i:...)
+_NOMBRE = rf"(?P<nombre>{_PALABRA}(?:\s+[A-ZÁÉÍÓÚÑ]{_PALABRA})?)"
+
+# Palabras que pueden seguir a "soy" / "aquí" sin ser un nombre
+PALABRAS_NO_NOMBRE = {
+    "yo", "el", "la", "los", "las", "un", "una", "unos", "unas", "de", "del",
+    "muy", "tan", "tu", "su", "mi", "tuyo", "nuevo", "nueva", "otra", "otro",
+    "bastante", "algo", "nadie", "alguien", "quien", "quién", "como", "cómo",
+    "estoy", "esta", "está", "vez", "ahora", "bien", "mal", "feliz", "triste",
+    "fan", "alérgico", "alérgica", "vegetariano", "vegetariana", "estudiante",
+    "profesor", "profesora", "hombre", "mujer", "chileno", "chilena", "hay",
+    "todo", "todos", "eso", "esto", "ese", "lo", "que", "qué", "y",
+    "ingeniero", "ingeniera", "médico", "médica", "doctor", "doctora",
+    "abogado", "abogada", "programador", "programadora", "cliente", "usuario",
+    "usuaria", "nuevamente", "también", "quiero", "necesito", "tengo",
+    "busco", "vuelvo", "regreso", "acá", "aquí", "por", "para", "con", "e", "o",
+}
+
+# Terminaciones típicas de profesiones y adjetivos ("Ingeniero", "Cansado"):
+# un nombre nuevo con ellas tras "soy" / "aquí" / "habla" se deriva al LLM
+_TERMINACIONES_DUDOSAS = re.compile(r"(?:ero|era|ista|ante|ente|ado|ada|dor|dora|ólogo|óloga)$", re.IGNORECASE)
+
+# Palabras que indican que el mensaje podría ser una identificación
+_DISPARADORES = re.compile(
+    r"\b(soy|llamo|llaman|nombre|aqu[ií]|habla|hablando|regres[eéo]|volv[ií])\b",
+    re.IGNORECASE,
+)
+_NEGACION = re.compile(r"\bno\s+(soy|me\s+llamo|es\s+mi\s+nombre)\b", re.IGNORECASE)
+
+# (patrón compilado, tipo_identificacion, fuerte)
+# Los patrones fuertes aceptan nombres en minúscula: "me llamo ana" no es ambiguo
+PATRONES_IDENTIFICACION = [
+    (re.compile(rf"\b(?i:me\s+llamo)\s+{_NOMBRE}"), "presentacion", True),
+    (re.compile(rf"\b(?i:mi\s+nombre\s+es)\s+{_NOMBRE}"), "referencia", True),
+    (re.compile(
+        rf"\b(?i:aqu[ií])\s+{_NOMBRE}\s+(?i:otra\s+vez|de\s+nuevo|nuevamente)\b"
+    ), "referencia", False),
+    (re.compile(rf"\b(?i:habla)\s+{_NOMBRE}\b"), "referencia", False),
+    (re.compile(rf"\b(?i:soy)\s+{_NOMBRE}"), "presentacion", False),
+]
+
+
+class DetectorLocal:
+    """Resuelve la detección de usuarios con reglas y un índice de usuarios conocidos"""
+
+    def __init__(self):
+        self._usuarios_conocidos: Optional[set] = None
+        self._lock = threading.Lock()
+        self.aciertos_identificacion = 0
+        self.aciertos_ninguna = 0
+        self.derivados_llm = 0
+
+    # ----------------------------------------
+    # Índice de usuarios conocidos
+    # ----------------------------------------
+
+    @property
+    def requiere_carga(self) -> bool:
+        """True mientras el índice no se haya cargado desde Redis"""
+        return self._usuarios_conocidos is None
+
+    @property
+    def usuarios_conocidos(self) -> set:
+        """Nombres (en minúsculas) con historial en Redis"""
+        return self._usuarios_conocidos or set()
+
+    def cargar_usuarios(self, usuarios: Iterable[str]):
+        """Carga el índice con los usuarios que ya tienen historial"""
+        with self._lock:
+            self._usuarios_conocidos = {u.lower() for u in usuarios}
+
+    def registrar_usuario(self, nombre_usuario: str):
+        """Agrega un usuario al índice tras escribir su historial"""
+        with self._lock:
+            if self._usuarios_conocidos is not None:
+                self._usuarios_conocidos.add(nombre_usuario.lower())
+
+    def olvidar_usuarios(self, nombres: Iterable[str]):
+        """Quita del índice a usuarios cuyo historial ya no existe"""
+        with self._lock:
+            if self._usuarios_conocidos is not None:
+                self._usuarios_conocidos.difference_update(n.lower() for n in nombres)
+
+    # ----------------------------------------
+    # Detección
+    # ----------------------------------------
+
+    def _nombre_confiable(self, nombre: str, fuerte: bool = False) -> Optional[str]:
+        """Devuelve el nombre si es claramente un nombre propio, o None si es dudoso"""
+        palabras = nombre.split()
+        primera = palabras[0]
+        if primera.lower() in PALABRAS_NO_NOMBRE:
+            return None
+        if len(palabras) > 1 and palabras[1].lower() in PALABRAS_NO_NOMBRE:
+            # "Soy Pablo De nuevo": la segunda palabra continúa la frase
+            nombre = primera
+        if nombre.lower() in self.usuarios_conocidos:
+            return nombre
+        if primera.lower() in self.usuarios_conocidos:
+            return primera
+        if fuerte:
+            return nombre
+        # Nombre nuevo tras un disparador débil: solo con mayúscula inicial y
+        # sin pinta de profesión o adjetivo; si no, lo decide el LLM
+        if primera[0].isupper() and not _TERMINACIONES_DUDOSAS.search(primera):
+            return nombre
+        return None
+
+    def detectar(self, mensaje: str):
+        """
+        Intenta resolver la detección localmente.
+
+        Devuelve un `DeteccionUsuario` cuando el resultado es seguro, o None
+        si el mensaje es ambiguo y debe consultarse al LLM detector.
+        """
+        from chat_multi_usuario import DeteccionUsuario
+
+        texto = mensaje.strip()
+
+        if not _DISPARADORES.search(texto):
+            # Sin palabras de identificación: solo es ambiguo si menciona un usuario conocido
+            palabras = {p.lower() for p in re.findall(_PALABRA, texto)}
+            if palabras & self.usuarios_conocidos:
+                return self._derivar()
+            self._contar("ninguna")
+            return DeteccionUsuario(
+                usuario_identificado=False,
+                nombre_usuario=None,
+                tipo_identificacion="ninguna",
+            )
+
+        if _NEGACION.search(texto):
+            return self._derivar()
+
+        for patron, tipo, fuerte in PATRONES_IDENTIFICACION:
+            coincidencia = patron.search(texto)
+            if not coincidencia:
+                continue
+            nombre = self._nombre_confiable(coincidencia.group("nombre"), fuerte)
+            if nombre is None:
+                return self._derivar()
+            self._contar("identificacion")
+            return DeteccionUsuario(
+                usuario_identificado=True,
+                nombre_usuario=nombre,
+                tipo_identificacion=tipo,
+            )
+
+        return self._derivar()
+
+    def _contar(self, resultado: str):
+        with self._lock:
+            if resultado == "identificacion":
+                self.aciertos_identificacion += 1
+            else:
+                self.aciertos_ninguna += 1
+
+    def _derivar(self):
+        with self._lock:
+            self.derivados_llm += 1
+        return None
+
+    def estadisticas(self) -> dict:
+        """Contadores de aciertos locales y llamadas derivadas al LLM"""
+        with self._lock:
+            aciertos = self.aciertos_identificacion + self.aciertos_ninguna
+            total = aciertos + self.derivados_llm
+            return {
+                "aciertos": aciertos,
+                "aciertos_identificacion": self.aciertos_identificacion,
+                "aciertos_ninguna": self.aciertos_ninguna,
+                "fallos": self.derivados_llm,
+                "llamadas_llm_ahorradas": aciertos,
+                "tasa_aciertos": aciertos / total if total else 0.0,
+            }
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Codificación compacta de historiales en Redis
+
+El formato de `RedisChatMessageHistory` guarda cada mensaje como el dict JSON
+completo de LangChain (type, data, additional_kwargs, response_metadata...).
+El formato compacto guarda solo `[rol, contenido, ts]` empaquetado con
+msgpack (o JSON compacto si msgpack no está instalado), precedido de un byte
+de marca. Los segmentos antiguos archivados se comprimen con zstd (o zlib).
+
+La lectura reconoce ambos formatos elemento a elemento, de modo que una lista
+puede migrarse en caliente y mezclar mensajes antiguos y nuevos.
+
+Dependencias opcionales: `msgpack` y `zstandard`. Lo escrito con ellas
+necesita las mismas bibliotecas para leerse.
+"""
+
+import json
+import time
+import zlib
+from typing import Iterable, List, Union
+
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    ChatMessage,
+    HumanMessage,
+    SystemMessage,
+    message_to_dict,
+    messages_from_dict,
+)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMATOS = ("langchain", "compacto")
+
+# Primer byte de cada elemento (el JSON de LangChain empieza con "{")
+MARCA_MSGPACK = b"\x01"
+MARCA_JSON = b"\x02"
+MARCA_ZSTD = b"\x03"
+MARCA_ZLIB = b"\x04"
+
+ROLES = {"human": "h", "ai": "a", "system": "s"}
+CLASES = {"h": HumanMessage, "a": AIMessage, "s": SystemMessage}
+
+Elemento = Union[bytes, str]
+
+
+def _empaquetar(objeto) -> bytes:
+    if msgpack is not None:
+        return MARCA_MSGPACK + msgpack.packb(objeto, use_bin_type=True)
+    return MARCA_JSON + json.dumps(objeto, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _desempaquetar(datos: bytes):
+    marca, cuerpo = datos[:1], datos[1:]
+    if marca == MARCA_MSGPACK:
+        if msgpack is None:
+            raise RuntimeError("Historial en msgpack: instala `msgpack` para leerlo")
+        return msgpack.unpackb(cuerpo, raw=False)
+    return json.loads(cuerpo)
+
+
+def _bytes(elemento: Elemento) -> bytes:
+    return elemento.encode("utf-8") if isinstance(elemento, str) else elemento
+
+
+def es_compacto(elemento: Elemento) -> bool:
+    return _bytes(elemento)[:1] in (MARCA_MSGPACK, MARCA_JSON)
+
+
+# ========================================
+# Mensajes individuales
+# ========================================
+
+def tupla_mensaje(mensaje: BaseMessage, ts: int = None) -> list:
+    """`[rol, contenido, ts]` de un mensaje"""
+    return [ROLES.get(mensaje.type, mensaje.type), mensaje.content, int(ts if ts is not None else time.time())]
+
+
+def mensaje_de_tupla(tupla) -> BaseMessage:
+    rol, contenido, _ = tupla
+    clase = CLASES.get(rol)
+    if clase is None:
+        return ChatMessage(role=rol, content=contenido)
+    return clase(content=contenido)
+
+
+def codificar(mensaje: BaseMessage, formato: str = "langchain") -> Elemento:
+    """Elemento de la lista Redis para un mensaje en el formato indicado"""
+    if formato == "compacto":
+        return _empaquetar(tupla_mensaje(mensaje))
+    return json.dumps(message_to_dict(mensaje))
+
+
+def compactar(elemento: Elemento) -> Elemento:
+    """El mismo elemento en formato compacto (sin cambios si ya lo está)"""
+    if es_compacto(elemento):
+        return elemento
+    return _empaquetar(tupla_de_elemento(elemento))
+
+
+def tupla_de_elemento(elemento: Elemento) -> list:
+    """Convierte un elemento (de cualquier formato) a `[rol, contenido, ts]`"""
+    datos = _bytes(elemento)
+    if es_compacto(datos):
+        return list(_desempaquetar(datos))
+    # Formato LangChain: no guarda fecha, se marca con 0
+    return tupla_mensaje(messages_from_dict([json.loads(datos)])[0], ts=0)
+
+
+def decodificar(elementos: Iterable[Elemento]) -> List[BaseMessage]:
+    """
+    Mensajes en orden cronológico a partir de elementos en orden LRANGE
+    (el más nuevo primero). Acepta ambos formatos mezclados.
+    """
+    mensajes = []
+    for elemento in reversed(list(elementos)):
+        datos = _bytes(elemento)
+        if es_compacto(datos):
+            mensajes.append(mensaje_de_tupla(_desempaquetar(datos)))
+        else:
+            mensajes.extend(messages_from_dict([json.loads(datos)]))
+    return mensajes
+
+
+# ========================================
+# Segmentos archivados
+# ========================================
+
+def comprimir_segmento(elementos_cronologicos: List[Elemento]) -> bytes:
+    """Un bloque comprimido con varios mensajes (del más antiguo al más nuevo)"""
+    datos = _empaquetar([tupla_de_elemento(e) for e in elementos_cronologicos])
+    if zstandard is not None:
+        return MARCA_ZSTD + zstandard.ZstdCompressor(level=6).compress(datos)
+    return MARCA_ZLIB + zlib.compress(datos, 6)
+
+
+def descomprimir_segmento(segmento: bytes) -> List[BaseMessage]:
+    marca, cuerpo = segmento[:1], segmento[1:]
+    if marca == MARCA_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Historial archivado con zstd: instala `zstandard` para leerlo")
+        datos = zstandard.ZstdDecompressor().decompress(cuerpo)
+    else:
+        datos = zlib.decompress(cuerpo)
+    return [mensaje_de_tupla(t) for t in _desempaquetar(datos)]
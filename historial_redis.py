@@ -0,0 +1,831 @@
+#!/usr/bin/env python3
+"""
+Historial de conversaciones en Redis con cliente asyncio
+
+Mantiene el mismo formato que `RedisChatMessageHistory` de LangChain
+(lista `message_store:usuario_<nombre>` con mensajes JSON, el más nuevo
+primero), de modo que los historiales existentes siguen siendo válidos.
+Con `formato="compacto"` cada mensaje se guarda como `[rol, contenido, ts]`
+(ver `formato_historial`) y los mensajes antiguos pueden archivarse en
+segmentos comprimidos bajo `archivo_store:usuario_<nombre>`.
+"""
+
+import asyncio
+import re
+import time
+import unicodedata
+import weakref
+from typing import Callable, Dict, List, Optional
+
+from langchain_core.messages import BaseMessage
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import WatchError
+
+from cache_historial import CacheHistoriales
+from formato_historial import (
+    FORMATOS,
+    codificar,
+    compactar,
+    comprimir_segmento,
+    decodificar,
+    descomprimir_segmento,
+    es_compacto,
+)
+from trazas import anotar
+
+PREFIJO_CLAVE = "message_store:"
+PREFIJO_USUARIO = "usuario_"
+# Fuera de `message_store:` para que el SCAN del registro no lo confunda con un historial
+PREFIJO_ARCHIVO = "archivo_store:"
+# Bloqueo por usuario de los turnos (ver `bloqueo_usuarios`)
+PREFIJO_BLOQUEO = "bloqueo_turno:"
+# Resumen incremental por usuario (ver `resumenes`); su TTL se renueva con cada escritura
+PREFIJO_RESUMEN = "resumen_store:usuario_"
+
+# Registro de usuarios mantenido en cada escritura
+CLAVE_ACTIVIDAD = "chat_usuarios:actividad"  # sorted set: usuario -> última actividad (epoch)
+CLAVE_CONTEO = "chat_usuarios:mensajes"  # hash: usuario -> mensajes escritos
+CLAVE_INDICE_LISTO = "chat_usuarios:indice_listo"  # marca del backfill inicial
+CLAVE_VERSIONES = "chat_usuarios:versiones"  # hash: usuario -> versión del historial
+
+# Nombres de usuario admitidos en las claves: letras (con acentos), dígitos,
+# espacio, punto, guion y guion bajo. Sin ":", que separa las claves derivadas
+# (`...:mensajes`, `...:fencing`), ni comodines de SCAN
+MAX_LARGO_NOMBRE = 64
+_NOMBRE_VALIDO = re.compile(r"\w[\w .\-]*")
+
+# Mensajes mínimos por segmento archivado (evita segmentos diminutos)
+MIN_SEGMENTO_ARCHIVO = 50
+
+# Tramo de la lista por posición cronológica, leyendo el total en la misma
+# operación atómica: devuelve {total, archivados, elementos del tramo}
+_TRAMO_POR_POSICION = """
+local largo = redis.call('llen', KEYS[1])
+local archivados = tonumber(redis.call('get', KEYS[2]) or '0')
+local total = largo + archivados
+local hasta = tonumber(ARGV[1])
+if hasta < 0 or hasta > total then hasta = total end
+local desde = math.max(hasta - tonumber(ARGV[2]), archivados)
+local items = {}
+if hasta > desde then
+    items = redis.call('lrange', KEYS[1], total - hasta, total - 1 - desde)
+end
+return {total, archivados, items}
+"""
+
+
+def clave_historial(nombre_usuario: str) -> str:
+    """Clave Redis del historial de un usuario"""
+    return f"{PREFIJO_CLAVE}{PREFIJO_USUARIO}{nombre_usuario.lower()}"
+
+
+def clave_archivo(nombre_usuario: str) -> str:
+    """Clave Redis de los segmentos archivados (lista, el más antiguo primero)"""
+    return f"{PREFIJO_ARCHIVO}{PREFIJO_USUARIO}{nombre_usuario.lower()}"
+
+
+def clave_archivados(nombre_usuario: str) -> str:
+    """Clave Redis con el número de mensajes archivados de un usuario"""
+    return clave_archivo(nombre_usuario) + ":mensajes"
+
+
+# Quita del registro a los usuarios cuyo historial ya no existe (expiró por TTL
+# o se borró). Se comprueba dentro del script para no borrar a un usuario que
+# volvió a escribir entre la lectura de la página y la limpieza
+_PURGAR_REGISTRO = """
+local purgados = {}
+for i, clave in ipairs(KEYS) do
+    if redis.call('exists', clave) == 0 then
+        redis.call('zrem', ARGV[1], ARGV[i + 2])
+        redis.call('hdel', ARGV[2], ARGV[i + 2])
+        table.insert(purgados, ARGV[i + 2])
+    end
+end
+return purgados
+"""
+
+
+def clave_resumen(nombre_usuario: str) -> str:
+    """Clave Redis (hash) del resumen de un usuario"""
+    return f"{PREFIJO_RESUMEN}{nombre_usuario.lower()}"
+
+
+def clave_bloqueo(nombre_usuario: str) -> str:
+    """Clave Redis del bloqueo de turnos de un usuario (valor = token de fencing)"""
+    return f"{PREFIJO_BLOQUEO}{PREFIJO_USUARIO}{nombre_usuario.lower()}"
+
+
+def nombre_usuario_valido(nombre_usuario: str) -> bool:
+    """True si el nombre puede usarse en las claves Redis sin chocar con otras"""
+    return len(nombre_usuario) <= MAX_LARGO_NOMBRE and _NOMBRE_VALIDO.fullmatch(nombre_usuario) is not None
+
+
+class BloqueoPerdido(RuntimeError):
+    """La escritura llegó con un token de fencing que ya no es el del bloqueo"""
+
+
+def normalizar_texto(texto: str) -> str:
+    """Minúsculas, sin acentos ni signos de puntuación y con espacios simples"""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return " ".join(re.findall(r"\w+", texto))
+
+
+def estimar_tokens(texto: str) -> int:
+    """Estimación rápida de tokens (~4 caracteres por token en español/inglés)"""
+    return (len(texto) + 3) // 4
+
+
+def estimar_tokens_mensaje(mensaje: BaseMessage) -> int:
+    """Tokens de un mensaje incluyendo el sobrecosto fijo por mensaje del formato chat"""
+    return estimar_tokens(str(mensaje.content)) + 4
+
+
+class PoolConMetricas(BlockingConnectionPool):
+    """Pool de conexiones bloqueante que cuenta creaciones, esperas y agotamientos"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.conexiones_creadas = 0
+        self.esperas = 0
+        self.segundos_espera = 0.0
+        self.agotamientos = 0
+
+    def make_connection(self):
+        self.conexiones_creadas += 1
+        return super().make_connection()
+
+    async def get_connection(self, *args, **kwargs):
+        if self.can_get_connection():
+            return await super().get_connection(*args, **kwargs)
+
+        # Pool lleno: la petición espera a que se libere una conexión
+        self.esperas += 1
+        inicio = time.perf_counter()
+        try:
+            return await super().get_connection(*args, **kwargs)
+        except RedisConnectionError:
+            self.agotamientos += 1
+            raise
+        finally:
+            self.segundos_espera += time.perf_counter() - inicio
+
+    def estadisticas(self) -> dict:
+        return {
+            "max_conexiones": self.max_connections,
+            "en_uso": len(self._in_use_connections),
+            "disponibles": len(self._available_connections),
+            "creadas": self.conexiones_creadas,
+            "esperas": self.esperas,
+            "segundos_espera": self.segundos_espera,
+            "agotamientos": self.agotamientos,
+        }
+
+
+class HistorialRedis:
+    """Lectura y escritura asíncrona de historiales por usuario"""
+
+    def __init__(
+        self,
+        redis_url: str,
+        max_conexiones: int = 20,
+        timeout_espera: float = 5.0,
+        timeout_socket: float = 5.0,
+        ttl_segundos: Optional[int] = None,
+        max_mensajes: Optional[int] = None,
+        cache: Optional[CacheHistoriales] = None,
+        opciones_pool: Optional[dict] = None,
+        formato: str = "langchain",
+    ):
+        if formato not in FORMATOS:
+            raise ValueError(f"formato debe ser uno de {FORMATOS}, no {formato!r}")
+        self.redis_url = redis_url
+        self.max_conexiones = max_conexiones
+        self.timeout_espera = timeout_espera
+        self.timeout_socket = timeout_socket
+        # Políticas opcionales aplicadas en la misma transacción de cada escritura
+        self.ttl_segundos = ttl_segundos
+        self.max_mensajes = max_mensajes
+        # Caché opcional de historiales deserializados (None = leer siempre de Redis)
+        self.cache = cache
+        # Argumentos extra para `from_url` (p. ej. `connection_class` instrumentada)
+        self.opciones_pool = opciones_pool or {}
+        # Formato de los mensajes nuevos; la lectura acepta ambos
+        self.formato = formato
+        # Los pools asyncio quedan ligados al event loop donde se crean; en la
+        # práctica hay uno solo (el loop propio de ChatMultiUsuario o el del servidor)
+        self._clientes = weakref.WeakKeyDictionary()
+        self._pools = weakref.WeakKeyDictionary()
+        self._indice_listo = False
+        # Se llama con los nombres quitados del registro (p. ej. para olvidarlos en el detector)
+        self.al_purgar: Optional[Callable[[List[str]], None]] = None
+
+    def cliente(self) -> Redis:
+        """Cliente Redis del event loop en ejecución, sobre el pool compartido"""
+        bucle = asyncio.get_running_loop()
+        cliente = self._clientes.get(bucle)
+        if cliente is None:
+            pool = PoolConMetricas.from_url(
+                self.redis_url,
+                max_connections=self.max_conexiones,
+                timeout=self.timeout_espera,
+                socket_timeout=self.timeout_socket,
+                socket_connect_timeout=self.timeout_socket,
+                **self.opciones_pool,
+            )
+            cliente = Redis(connection_pool=pool)
+            self._pools[bucle] = pool
+            self._clientes[bucle] = cliente
+        return cliente
+
+    def estadisticas_pool(self) -> dict:
+        """Estadísticas agregadas de los pools de conexiones"""
+        total = {
+            "max_conexiones": self.max_conexiones,
+            "en_uso": 0,
+            "disponibles": 0,
+            "creadas": 0,
+            "esperas": 0,
+            "segundos_espera": 0.0,
+            "agotamientos": 0,
+        }
+        for pool in list(self._pools.values()):
+            for campo, valor in pool.estadisticas().items():
+                if campo != "max_conexiones":
+                    total[campo] += valor
+        return total
+
+    async def acerrar(self):
+        """Cierra las conexiones del pool del event loop en ejecución"""
+        bucle = asyncio.get_running_loop()
+        cliente = self._clientes.pop(bucle, None)
+        self._pools.pop(bucle, None)
+        if cliente is not None:
+            await cliente.aclose(close_connection_pool=True)
+
+    async def aobtener(self, nombre_usuario: str) -> List[BaseMessage]:
+        """Obtiene todos los mensajes de un usuario en orden cronológico"""
+        if self.cache is not None:
+            return list(await self._aobtener_cacheado(nombre_usuario))
+        mensajes, _, _ = await self._aleer_completo(nombre_usuario)
+        return mensajes
+
+    async def _aleer_completo(self, nombre_usuario: str) -> tuple:
+        """
+        Lista y segmentos archivados en una transacción.
+        Devuelve (mensajes cronológicos, bytes leídos, versión).
+        """
+        usuario = nombre_usuario.lower()
+        async with self.cliente().pipeline(transaction=True) as pipe:
+            pipe.lrange(clave_historial(usuario), 0, -1)
+            pipe.lrange(clave_archivo(usuario), 0, -1)
+            pipe.hget(CLAVE_VERSIONES, usuario)
+            items, segmentos, version = await pipe.execute()
+        mensajes = []
+        for segmento in segmentos:
+            mensajes.extend(descomprimir_segmento(segmento))
+        mensajes.extend(decodificar(items))
+        tamano = sum(len(m) for m in items) + sum(len(s) for s in segmentos)
+        return mensajes, tamano, int(version or 0)
+
+    async def _aobtener_archivados(self, nombre_usuario: str) -> List[BaseMessage]:
+        """Mensajes archivados en orden cronológico"""
+        segmentos = await self.cliente().lrange(clave_archivo(nombre_usuario), 0, -1)
+        mensajes = []
+        for segmento in segmentos:
+            mensajes.extend(descomprimir_segmento(segmento))
+        return mensajes
+
+    async def _aentrada_valida(self, nombre_usuario: str, cubre: Callable[[List[BaseMessage]], bool]):
+        """
+        Mensajes de la entrada en caché si sigue vigente y alcanza para la
+        lectura (`cubre`, o el historial completo); si no, None.
+
+        Una entrada es válida si su versión coincide con la de Redis y el
+        total de mensajes (lista + archivados) no cambió (expiración por TTL);
+        validar cuesta un round trip con HGET + LLEN + GET.
+        """
+        usuario = nombre_usuario.lower()
+        entrada = self.cache.obtener(usuario)
+        if entrada is None:
+            self.cache.contar("fallos")
+            anotar("cache_historial", "fallo")
+            return None
+        version_cache, mensajes, total = entrada
+        async with self.cliente().pipeline(transaction=False) as pipe:
+            pipe.hget(CLAVE_VERSIONES, usuario)
+            pipe.llen(clave_historial(usuario))
+            pipe.get(clave_archivados(usuario))
+            version, longitud, archivados = await pipe.execute()
+        if int(version or 0) != version_cache or longitud + int(archivados or 0) != total:
+            self.cache.contar("obsoletos")
+            anotar("cache_historial", "obsoleto")
+            return None
+        if len(mensajes) < total and not cubre(mensajes):
+            # Vigente, pero la ventana guardada es más corta que lo pedido
+            self.cache.contar("fallos")
+            anotar("cache_historial", "fallo")
+            return None
+        self.cache.contar("aciertos")
+        anotar("cache_historial", "acierto")
+        return mensajes
+
+    async def _aobtener_cacheado(self, nombre_usuario: str) -> List[BaseMessage]:
+        """Historial completo a través de la caché (se recarga con la versión en la misma transacción)"""
+        usuario = nombre_usuario.lower()
+        mensajes = await self._aentrada_valida(usuario, lambda _: False)
+        if mensajes is not None:
+            return mensajes
+        mensajes, tamano, version = await self._aleer_completo(usuario)
+        self.cache.guardar(usuario, version, mensajes, tamano)
+        return mensajes
+
+    async def aobtener_recientes(self, nombre_usuario: str, cantidad: int) -> List[BaseMessage]:
+        """
+        Obtiene solo los últimos `cantidad` mensajes con un LRANGE acotado.
+        Con caché, un fallo guarda solo esa ventana final.
+        """
+        if cantidad <= 0:
+            return []
+        if self.cache is not None:
+            mensajes = await self._aentrada_valida(nombre_usuario, lambda m: len(m) >= cantidad)
+            if mensajes is not None:
+                return mensajes[-cantidad:]
+        async with self.cliente().pipeline(transaction=True) as pipe:
+            pipe.lrange(clave_historial(nombre_usuario), 0, cantidad - 1)
+            pipe.get(clave_archivados(nombre_usuario))
+            pipe.llen(clave_historial(nombre_usuario))
+            pipe.hget(CLAVE_VERSIONES, nombre_usuario.lower())
+            items, archivados, longitud, version = await pipe.execute()
+        mensajes = decodificar(items)
+        if len(items) < cantidad and int(archivados or 0):
+            # La lista no alcanza: completar con el archivo
+            mensajes = (await self._aobtener_archivados(nombre_usuario))[-(cantidad - len(items)):] + mensajes
+        if self.cache is not None:
+            self._guardar_ventana(nombre_usuario, version, mensajes, items, longitud + int(archivados or 0))
+        return mensajes
+
+    def _guardar_ventana(self, nombre_usuario: str, version, mensajes: list, items: list, total: int):
+        """Guarda en caché la ventana final leída (el tamaño se estima con los bytes de la lista)"""
+        tamano = sum(len(m) for m in items)
+        if len(mensajes) > len(items) and items:
+            tamano = tamano * len(mensajes) // len(items)
+        self.cache.guardar(nombre_usuario, int(version or 0), mensajes, tamano, total)
+
+    async def aobtener_por_presupuesto(
+        self,
+        nombre_usuario: str,
+        max_tokens: int,
+        max_mensajes: Optional[int] = None,
+        tamano_bloque: int = 20,
+    ) -> List[BaseMessage]:
+        """
+        Obtiene los mensajes más recientes que caben en `max_tokens`.
+
+        Lee la cola de la lista por bloques (LRANGE) del más nuevo al más
+        antiguo y se detiene al agotar el presupuesto, sin cargar el resto.
+        El archivo solo se lee si la lista se agota antes que el presupuesto.
+        """
+        def seleccionar(mensajes: List[BaseMessage]) -> tuple:
+            """(los más recientes que caben, cronológicos; True si se agotaron los mensajes)"""
+            elegidos, usados = [], 0
+            for mensaje in reversed(mensajes):
+                tokens_mensaje = estimar_tokens_mensaje(mensaje)
+                if usados + tokens_mensaje > max_tokens or (max_mensajes and len(elegidos) >= max_mensajes):
+                    return elegidos[::-1], False
+                elegidos.append(mensaje)
+                usados += tokens_mensaje
+            return elegidos[::-1], True
+
+        if self.cache is not None:
+            # La ventana guardada alcanza si el presupuesto se agota antes que ella
+            mensajes = await self._aentrada_valida(nombre_usuario, lambda m: not seleccionar(m)[1])
+            if mensajes is not None:
+                return seleccionar(mensajes)[0]
+
+        cliente = self.cliente()
+        clave = clave_historial(nombre_usuario)
+        if max_mensajes:
+            tamano_bloque = min(tamano_bloque, max_mensajes)
+
+        seleccion = []  # del más nuevo al más antiguo
+        tokens = 0
+
+        def tomar(mensajes_recientes_primero) -> bool:
+            """Agrega mensajes mientras quepan; False al agotar el presupuesto"""
+            nonlocal tokens
+            for mensaje in mensajes_recientes_primero:
+                tokens_mensaje = estimar_tokens_mensaje(mensaje)
+                if tokens + tokens_mensaje > max_tokens:
+                    return False
+                if max_mensajes and len(seleccion) >= max_mensajes:
+                    return False
+                seleccion.append(mensaje)
+                tokens += tokens_mensaje
+            return True
+
+        async with cliente.pipeline(transaction=True) as pipe:
+            pipe.lrange(clave, 0, tamano_bloque - 1)
+            pipe.get(clave_archivados(nombre_usuario))
+            pipe.llen(clave)
+            pipe.hget(CLAVE_VERSIONES, nombre_usuario.lower())
+            items, archivados, longitud, version = await pipe.execute()
+        leidos = []
+        inicio = 0
+        while True:
+            leidos.extend(items)
+            if not tomar(reversed(decodificar(items))):
+                break
+            if len(items) < tamano_bloque:
+                if int(archivados or 0):
+                    tomar(reversed(await self._aobtener_archivados(nombre_usuario)))
+                break
+            inicio += tamano_bloque
+            items = await cliente.lrange(clave, inicio, inicio + tamano_bloque - 1)
+
+        seleccion = seleccion[::-1]
+        if self.cache is not None:
+            # Solo la ventana elegida; la versión es la del primer bloque, así que
+            # una escritura concurrente deja la entrada obsoleta, nunca incorrecta
+            self._guardar_ventana(
+                nombre_usuario, version, seleccion, leidos[: len(seleccion)], longitud + int(archivados or 0)
+            )
+        return seleccion
+
+    def _encolar_escritura(self, pipe, nombre_usuario: str, mensajes: List[BaseMessage]) -> int:
+        """
+        Encola LPUSH de los mensajes, TTL/recorte, registro de usuario y
+        versión en un pipeline. El primer comando es el LPUSH (devuelve el
+        largo de la lista) y el último el HINCRBY de la versión.
+        Devuelve los bytes escritos.
+        """
+        clave = clave_historial(nombre_usuario)
+        usuario = nombre_usuario.lower()
+        serializados = [codificar(m, self.formato) for m in mensajes]
+        # LPUSH con varios valores los inserta en orden: el último queda primero
+        pipe.lpush(clave, *serializados)
+        if self.max_mensajes:
+            pipe.ltrim(clave, 0, self.max_mensajes - 1)
+        if self.ttl_segundos:
+            pipe.expire(clave, self.ttl_segundos)
+            # EXPIRE sobre claves inexistentes no hace nada
+            pipe.expire(clave_archivo(usuario), self.ttl_segundos)
+            pipe.expire(clave_archivados(usuario), self.ttl_segundos)
+            pipe.expire(clave_resumen(usuario), self.ttl_segundos)
+        pipe.zadd(CLAVE_ACTIVIDAD, {usuario: time.time()})
+        pipe.hincrby(CLAVE_CONTEO, usuario, len(mensajes))
+        pipe.hincrby(CLAVE_VERSIONES, usuario, 1)
+        return sum(len(m) for m in serializados)
+
+    async def aagregar(
+        self, nombre_usuario: str, mensajes: List[BaseMessage], fencing: Optional[int] = None
+    ) -> int:
+        """
+        Agrega mensajes al historial en una sola transacción MULTI/EXEC.
+        Devuelve el largo de la lista sin archivar.
+
+        Con `fencing`, la transacción vigila el bloqueo del usuario y solo se
+        aplica si sigue teniendo ese token; si no, lanza `BloqueoPerdido`.
+        """
+        if not mensajes:
+            return 0
+        async with self.cliente().pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    if fencing is not None:
+                        await pipe.watch(clave_bloqueo(nombre_usuario))
+                        actual = await pipe.get(clave_bloqueo(nombre_usuario))
+                        if actual is None or int(actual) != fencing:
+                            await pipe.reset()
+                            raise BloqueoPerdido(
+                                f"El bloqueo de {nombre_usuario} ya no tiene el token {fencing}"
+                            )
+                        pipe.multi()
+                    tamano = self._encolar_escritura(pipe, nombre_usuario, mensajes)
+                    resultados = await pipe.execute()
+                    break
+                except WatchError:
+                    # El bloqueo cambió (p. ej. la propia renovación): se vuelve a comprobar
+                    continue
+        if self.cache is not None:
+            # Write-through con la versión que dejó esta misma transacción
+            self.cache.agregar(nombre_usuario, resultados[-1], list(mensajes), tamano, self.max_mensajes)
+        return resultados[0]
+
+    async def aimportar(
+        self, conversaciones: Dict[str, List[BaseMessage]], tamano_lote: int = 100
+    ) -> int:
+        """
+        Carga muchas conversaciones a la vez (migraciones).
+
+        Agrupa `tamano_lote` usuarios por pipeline, de modo que cada lote es un
+        solo round trip. Devuelve el número de mensajes escritos.
+        """
+        cliente = self.cliente()
+        escritos = 0
+        usuarios = [(u, m) for u, m in conversaciones.items() if m]
+        for inicio in range(0, len(usuarios), tamano_lote):
+            async with cliente.pipeline(transaction=False) as pipe:
+                for nombre_usuario, mensajes in usuarios[inicio:inicio + tamano_lote]:
+                    self._encolar_escritura(pipe, nombre_usuario, mensajes)
+                    escritos += len(mensajes)
+                    if self.cache is not None:
+                        self.cache.invalidar(nombre_usuario)
+                await pipe.execute()
+        return escritos
+
+    # ----------------------------------------
+    # Navegación y búsqueda
+    # ----------------------------------------
+
+    async def _atramo(self, nombre_usuario: str, hasta: Optional[int], cantidad: int) -> tuple:
+        """
+        Hasta `cantidad` mensajes con posición cronológica < `hasta` (None = el
+        final) en un round trip. Devuelve (total, inicio, mensajes cronológicos);
+        los que caen en el archivo se leen de los segmentos.
+        """
+        total, archivados, items = await self.cliente().eval(
+            _TRAMO_POR_POSICION,
+            2,
+            clave_historial(nombre_usuario),
+            clave_archivados(nombre_usuario),
+            -1 if hasta is None else hasta,
+            cantidad,
+        )
+        hasta = total if hasta is None or hasta > total else hasta
+        mensajes = decodificar(items)
+        inicio = hasta - len(mensajes)
+        faltan = min(cantidad - len(mensajes), inicio)
+        if faltan > 0 and archivados:
+            # El tramo llega al archivo (posiciones 0..archivados-1)
+            mensajes = (await self._aobtener_archivados(nombre_usuario))[inicio - faltan:inicio] + mensajes
+            inicio -= faltan
+        return total, inicio, mensajes
+
+    async def aobtener_pagina(
+        self, nombre_usuario: str, cursor: Optional[int] = None, tamano: int = 20
+    ) -> dict:
+        """
+        Página de mensajes del más nuevo al más antiguo.
+
+        `cursor` es la posición cronológica (0 = el primer mensaje) donde
+        termina la página: None para la más reciente y luego el `cursor`
+        devuelto por la página anterior, que sigue siendo válido aunque
+        lleguen mensajes nuevos. Devuelve `mensajes` (más nuevo primero),
+        `cursor` de la siguiente página (None si no hay más) y `total`.
+        """
+        total, inicio, mensajes = await self._atramo(nombre_usuario, cursor, tamano)
+        return {
+            "mensajes": mensajes[::-1],
+            "cursor": inicio if inicio > 0 else None,
+            "total": total,
+        }
+
+    async def abuscar(
+        self,
+        nombre_usuario: str,
+        texto: str,
+        limite: int = 20,
+        cursor: Optional[int] = None,
+        max_escaneo: int = 1000,
+        tamano_bloque: int = 200,
+    ) -> dict:
+        """
+        Busca `texto` en el historial (sin distinguir mayúsculas ni acentos),
+        del más nuevo al más antiguo.
+
+        Recorre la lista por bloques con LRANGE y devuelve solo las
+        coincidencias: nunca carga el historial completo. Se detiene al
+        encontrar `limite` resultados o tras revisar `max_escaneo` mensajes;
+        `cursor` (como en `aobtener_pagina`) permite continuar. Devuelve
+        `resultados` (dicts con `posicion` y `mensaje`), `cursor`, `revisados`
+        y `total`.
+        """
+        buscado = normalizar_texto(texto)
+        resultados = []
+        revisados = 0
+        total = None
+        while cursor is None or cursor > 0:
+            cantidad = min(tamano_bloque, max_escaneo - revisados)
+            if cantidad <= 0 or len(resultados) >= limite:
+                break
+            total_bloque, inicio, mensajes = await self._atramo(nombre_usuario, cursor, cantidad)
+            total = total_bloque if total is None else total
+            if not mensajes:
+                cursor = 0
+                break
+            for desplazamiento in range(len(mensajes) - 1, -1, -1):
+                mensaje = mensajes[desplazamiento]
+                revisados += 1
+                cursor = inicio + desplazamiento
+                if buscado in normalizar_texto(str(mensaje.content)):
+                    resultados.append({"posicion": cursor, "mensaje": mensaje})
+                    if len(resultados) >= limite:
+                        break
+        return {
+            "resultados": resultados,
+            "cursor": cursor if cursor else None,
+            "revisados": revisados,
+            "total": total or 0,
+        }
+
+    # ----------------------------------------
+    # Formato compacto y archivo
+    # ----------------------------------------
+
+    async def aarchivar(
+        self, nombre_usuario: str, conservar: int, hasta: Optional[int] = None, minimo: int = 1
+    ) -> int:
+        """
+        Mueve a un segmento comprimido en `archivo_store:` los mensajes de la
+        lista salvo los `conservar` más recientes y, si se indica, solo los de
+        posición cronológica < `hasta` (p. ej. los ya resumidos).
+
+        El segmento se arma con LRANGE del extremo antiguo de la lista bajo
+        WATCH y se escribe junto al LTRIM, el contador de archivados y la
+        versión en una transacción; si otro proceso toca el historial entre
+        medio, se reintenta. No hace nada si quedan menos de `minimo`
+        mensajes por archivar o con `max_mensajes` (el recorte ya descarta
+        los antiguos). Devuelve el número de mensajes archivados.
+        """
+        if self.max_mensajes:
+            return 0
+        usuario = nombre_usuario.lower()
+        clave = clave_historial(usuario)
+        contador = clave_archivados(usuario)
+
+        async with self.cliente().pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(clave, contador)
+                    archivados = int(await pipe.get(contador) or 0)
+                    longitud = await pipe.llen(clave)
+                    # Nunca se archiva la lista completa
+                    cantidad = longitud - max(conservar, 1)
+                    if hasta is not None:
+                        cantidad = min(cantidad, hasta - archivados)
+                    if cantidad < max(minimo, 1):
+                        await pipe.reset()
+                        return 0
+                    items = await pipe.lrange(clave, -cantidad, -1)
+                    segmento = comprimir_segmento(items[::-1])
+
+                    pipe.multi()
+                    pipe.rpush(clave_archivo(usuario), segmento)
+                    pipe.ltrim(clave, 0, -(cantidad + 1))
+                    pipe.incrby(contador, cantidad)
+                    pipe.hincrby(CLAVE_VERSIONES, usuario, 1)
+                    if self.ttl_segundos:
+                        pipe.expire(clave_archivo(usuario), self.ttl_segundos)
+                        pipe.expire(contador, self.ttl_segundos)
+                    await pipe.execute()
+                    return cantidad
+                except WatchError:
+                    continue
+
+    async def amigrar(self, nombre_usuario: str) -> int:
+        """
+        Reescribe en formato compacto los elementos de la lista que están en
+        otro formato, conservando el orden. Usa WATCH y reintenta si hay
+        escrituras concurrentes. Devuelve el número de mensajes convertidos.
+        """
+        usuario = nombre_usuario.lower()
+        clave = clave_historial(usuario)
+        async with self.cliente().pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(clave)
+                    items = await pipe.lrange(clave, 0, -1)
+                    convertidos = [compactar(m) for m in items]
+                    cambios = sum(1 for m in items if not es_compacto(m))
+                    if not cambios:
+                        await pipe.reset()
+                        return 0
+                    ttl = await pipe.ttl(clave)
+
+                    pipe.multi()
+                    pipe.delete(clave)
+                    pipe.rpush(clave, *convertidos)
+                    if ttl > 0:
+                        pipe.expire(clave, ttl)
+                    pipe.hincrby(CLAVE_VERSIONES, usuario, 1)
+                    await pipe.execute()
+                    break
+                except WatchError:
+                    continue
+        if self.cache is not None:
+            self.cache.invalidar(usuario)
+        return cambios
+
+    # ----------------------------------------
+    # Registro de usuarios
+    # ----------------------------------------
+
+    async def arespaldar_indice(self) -> int:
+        """
+        Backfill único del registro a partir de las claves existentes.
+
+        Recorre `message_store:usuario_*` con SCAN (sin bloquear Redis como
+        KEYS) y registra cada usuario con su número de mensajes. Es idempotente:
+        ZADD NX no pisa la actividad real escrita por turnos concurrentes.
+        Devuelve el número de usuarios registrados.
+        """
+        cliente = self.cliente()
+        if await cliente.exists(CLAVE_INDICE_LISTO):
+            self._indice_listo = True
+            return 0
+
+        prefijo = PREFIJO_CLAVE + PREFIJO_USUARIO
+        registrados = 0
+        lote = []
+        async for key in cliente.scan_iter(match=f"{prefijo}*", count=500):
+            lote.append(key.decode("utf-8") if isinstance(key, bytes) else key)
+            if len(lote) >= 500:
+                registrados += await self._registrar_claves(cliente, lote, prefijo)
+                lote = []
+        if lote:
+            registrados += await self._registrar_claves(cliente, lote, prefijo)
+
+        await cliente.set(CLAVE_INDICE_LISTO, time.time())
+        self._indice_listo = True
+        print(f"📇 Registro de usuarios reconstruido: {registrados} usuarios")
+        return registrados
+
+    async def _registrar_claves(self, cliente, claves: List[str], prefijo: str) -> int:
+        async with cliente.pipeline(transaction=False) as pipe:
+            for clave in claves:
+                pipe.llen(clave)
+            longitudes = await pipe.execute()
+
+        registrados = 0
+        async with cliente.pipeline(transaction=False) as pipe:
+            for clave, longitud in zip(claves, longitudes):
+                if longitud > 0:
+                    usuario = clave[len(prefijo):]
+                    # Actividad desconocida: 0 los deja al final en "más recientes"
+                    pipe.zadd(CLAVE_ACTIVIDAD, {usuario: 0}, nx=True)
+                    pipe.hset(CLAVE_CONTEO, usuario, longitud)
+                    registrados += 1
+            await pipe.execute()
+        return registrados
+
+    async def alistar_usuarios_detalle(
+        self, offset: int = 0, limite: Optional[int] = None, orden: str = "reciente"
+    ) -> List[dict]:
+        """
+        Lista usuarios del registro con última actividad y número de mensajes.
+
+        `orden` es "reciente" (más activos primero) o "antiguo". Cada página
+        cuesta dos round trips (ZRANGE y luego HMGET + EXISTS por usuario), sin
+        importar cuántas claves haya. Los usuarios cuyo historial expiró se
+        quitan del registro al encontrarlos y la página se vuelve a leer.
+        """
+        if limite is not None and limite <= 0:
+            return []
+        if not self._indice_listo:
+            await self.arespaldar_indice()
+
+        cliente = self.cliente()
+        fin = -1 if limite is None else offset + limite - 1
+        while True:
+            if orden == "antiguo":
+                pagina = await cliente.zrange(CLAVE_ACTIVIDAD, offset, fin, withscores=True)
+            else:
+                pagina = await cliente.zrevrange(CLAVE_ACTIVIDAD, offset, fin, withscores=True)
+            if not pagina:
+                return []
+            usuarios = [u.decode("utf-8") if isinstance(u, bytes) else u for u, _ in pagina]
+            async with cliente.pipeline(transaction=False) as pipe:
+                pipe.hmget(CLAVE_CONTEO, usuarios)
+                for usuario in usuarios:
+                    pipe.exists(clave_historial(usuario))
+                conteos, *existen = await pipe.execute()
+            muertos = [u for u, existe in zip(usuarios, existen) if not existe]
+            if not muertos:
+                break
+            purgados = await cliente.eval(
+                _PURGAR_REGISTRO, len(muertos), *[clave_historial(u) for u in muertos],
+                CLAVE_ACTIVIDAD, CLAVE_CONTEO, *muertos,
+            )
+            purgados = [p.decode("utf-8") if isinstance(p, bytes) else p for p in purgados]
+            if purgados and self.al_purgar is not None:
+                self.al_purgar(purgados)
+            if not purgados:
+                # Todos volvieron a escribir entre la página y la limpieza
+                break
+        return [
+            {
+                "usuario": usuario,
+                "ultima_actividad": puntaje or None,
+                "mensajes": int(conteo or 0),
+            }
+            for usuario, (_, puntaje), conteo in zip(usuarios, pagina, conteos)
+        ]
+
+    async def alistar_usuarios(
+        self, offset: int = 0, limite: Optional[int] = None, orden: str = "reciente"
+    ) -> List[str]:
+        """Lista los nombres de usuarios con historial"""
+        detalle = await self.alistar_usuarios_detalle(offset, limite, orden)
+        return [d["usuario"] for d in detalle]
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Agrupador de llamadas al detector en micro-lotes
+
+Con muchas sesiones activas, cada mensaje ambiguo hace su propia llamada
+pequeña a `cadena_detector`. `AgrupadorLotes` junta las entradas que llegan
+dentro de una ventana corta (o hasta llenar el lote) y las envía juntas con
+`abatch`, devolviendo a cada llamador su resultado. Los errores de una
+entrada solo afectan a su llamador.
+"""
+
+import asyncio
+import contextvars
+import threading
+import time
+from typing import Any, List, Optional, Tuple
+
+
+class AgrupadorLotes:
+    """Coalesce invocaciones concurrentes de un Runnable en llamadas `abatch`"""
+
+    def __init__(self, cadena, ventana_ms: float = 10.0, max_lote: int = 16):
+        self.cadena = cadena
+        self.ventana_ms = ventana_ms
+        self.max_lote = max_lote
+        self._pendientes: List[Tuple[Any, asyncio.Future, float]] = []
+        self._temporizador: Optional[asyncio.TimerHandle] = None
+        self._tareas = set()
+        self._lock = threading.Lock()
+        self.solicitudes = 0
+        self.lotes = 0
+        self.lote_maximo = 0
+        self.segundos_espera = 0.0
+
+    async def ainvocar(self, entrada) -> Any:
+        """Encola una entrada y espera su resultado del lote en que se envíe"""
+        bucle = asyncio.get_running_loop()
+        futuro = bucle.create_future()
+        self._pendientes.append((entrada, futuro, time.perf_counter()))
+
+        if len(self._pendientes) >= self.max_lote:
+            self._despachar()
+        elif self._temporizador is None:
+            self._temporizador = bucle.call_later(self.ventana_ms / 1000, self._despachar)
+        return await futuro
+
+    def _despachar(self):
+        """Envía lo acumulado como un lote (llamado por la ventana o al llenarse)"""
+        if self._temporizador is not None:
+            self._temporizador.cancel()
+            self._temporizador = None
+        lote, self._pendientes = self._pendientes, []
+        if not lote:
+            return
+        # El lote no pertenece a ningún llamador: contexto vacío para no atribuir
+        # su ejecución (trazas, tokens) a quien lo llenó
+        tarea = contextvars.Context().run(asyncio.ensure_future, self._aejecutar(lote))
+        self._tareas.add(tarea)
+        tarea.add_done_callback(self._tareas.discard)
+
+    async def _aejecutar(self, lote: List[Tuple[Any, asyncio.Future, float]]):
+        ahora = time.perf_counter()
+        with self._lock:
+            self.solicitudes += len(lote)
+            self.lotes += 1
+            self.lote_maximo = max(self.lote_maximo, len(lote))
+            self.segundos_espera += sum(ahora - encolado for _, _, encolado in lote)
+
+        try:
+            resultados = await self.cadena.abatch([e for e, _, _ in lote], return_exceptions=True)
+        except Exception as e:
+            resultados = [e] * len(lote)
+
+        for (_, futuro, _), resultado in zip(lote, resultados):
+            if futuro.done():
+                # El llamador se canceló mientras esperaba el lote
+                continue
+            if isinstance(resultado, Exception):
+                futuro.set_exception(resultado)
+            else:
+                futuro.set_result(resultado)
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            return {
+                "solicitudes": self.solicitudes,
+                "lotes": self.lotes,
+                "tamano_promedio": self.solicitudes / self.lotes if self.lotes else 0.0,
+                "lote_maximo": self.lote_maximo,
+                "espera_promedio_ms": (
+                    self.segundos_espera / self.solicitudes * 1000 if self.solicitudes else 0.0
+                ),
+            }
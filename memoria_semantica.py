@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Memoria semántica por usuario
+
+Cada intercambio (mensaje del usuario + respuesta) se indexa como vector en
+Redis (`memoria_store:usuario_<nombre>:*`) a medida que se escribe. En cada
+turno se recuperan los k intercambios más parecidos al mensaje actual con un
+top-k vectorizado en NumPy, de modo que el prompt se mantiene pequeño y aun
+así el asistente responde a "¿recuerdas mi color favorito?" meses después.
+
+Los embeddings son intercambiables: cualquier `Embeddings` de LangChain
+(p. ej. `OpenAIEmbeddings`) o `EmbeddingsHashing`, que funciona sin red.
+
+La copia en memoria de los índices es un LRU acotado por usuarios y bytes,
+y con `ttl_historial` las claves de memoria expiran junto con el historial.
+"""
+
+import asyncio
+import json
+import re
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage, HumanMessage
+
+from historial_redis import HistorialRedis
+
+PREFIJO_MEMORIA = "memoria_store:usuario_"
+
+# Palabras vacías que no aportan al parecido entre mensajes
+PALABRAS_VACIAS = {
+    "a", "al", "de", "del", "el", "la", "los", "las", "un", "una", "y", "o", "en",
+    "es", "que", "se", "por", "con", "para", "lo", "le", "me", "te", "su", "tu",
+    "yo", "como", "mas", "pero", "si", "no", "ya", "muy", "esta", "este", "eso",
+}
+
+
+def claves_memoria(nombre_usuario: str):
+    """Claves Redis (vectores, textos) del índice de un usuario"""
+    base = f"{PREFIJO_MEMORIA}{nombre_usuario.lower()}"
+    return f"{base}:vectores", f"{base}:textos"
+
+
+class EmbeddingsHashing(Embeddings):
+    """
+    Embeddings locales por hashing de palabras y bigramas (sin red ni modelo).
+
+    Usa crc32 en lugar de `hash()` para que los vectores sean estables entre
+    procesos y réplicas.
+    """
+
+    def __init__(self, dimensiones: int = 1024):
+        self.dimensiones = dimensiones
+
+    @staticmethod
+    def _terminos(texto: str) -> List[str]:
+        texto = unicodedata.normalize("NFKD", texto.lower())
+        texto = "".join(c for c in texto if not unicodedata.combining(c))
+        palabras = [p for p in re.findall(r"\w+", texto) if p not in PALABRAS_VACIAS]
+        return palabras + [f"{a}_{b}" for a, b in zip(palabras, palabras[1:])]
+
+    def _vector(self, texto: str) -> List[float]:
+        vector = np.zeros(self.dimensiones, dtype=np.float32)
+        for termino in self._terminos(texto):
+            h = zlib.crc32(termino.encode("utf-8"))
+            vector[h % self.dimensiones] += 1.0 if (h >> 31) & 1 else -1.0
+        norma = np.linalg.norm(vector)
+        return (vector / norma if norma else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._vector(text)
+
+
+class MemoriaSemantica:
+    """Índice vectorial incremental por usuario con búsqueda top-k"""
+
+    def __init__(
+        self,
+        historiales: HistorialRedis,
+        embeddings: Optional[Embeddings] = None,
+        max_usuarios: int = 1000,
+        max_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.historiales = historiales
+        self.embeddings = embeddings or EmbeddingsHashing()
+        self.max_usuarios = max_usuarios
+        self.max_bytes = max_bytes
+        # LRU con la copia en memoria del índice de cada usuario: usuario -> (matriz, textos)
+        self._indices: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._tareas = set()
+        self.bytes_retenidos = 0
+        self.intercambios_indexados = 0
+        self.busquedas = 0
+        self.desalojos = 0
+
+    # ----------------------------------------
+    # Indexado
+    # ----------------------------------------
+
+    async def aindexar(self, nombre_usuario: str, intercambios: List[dict]):
+        """Agrega intercambios {"humano", "asistente"} al índice del usuario"""
+        if not intercambios:
+            return
+        textos = [f"{i['humano']}\n{i['asistente']}" for i in intercambios]
+        vectores = np.asarray(await self.embeddings.aembed_documents(textos), dtype=np.float32)
+        clave_vectores, clave_textos = claves_memoria(nombre_usuario)
+        async with self.historiales.cliente().pipeline(transaction=True) as pipe:
+            pipe.rpush(clave_vectores, *[v.tobytes() for v in vectores])
+            pipe.rpush(clave_textos, *[json.dumps(i, ensure_ascii=False) for i in intercambios])
+            if self.historiales.ttl_segundos:
+                pipe.expire(clave_vectores, self.historiales.ttl_segundos)
+                pipe.expire(clave_textos, self.historiales.ttl_segundos)
+            await pipe.execute()
+        self.intercambios_indexados += len(intercambios)
+
+    def programar_indexado(self, nombre_usuario: str, humano: str, asistente: str):
+        """Indexa un intercambio en segundo plano, fuera del camino de la petición"""
+        tarea = asyncio.ensure_future(
+            self.aindexar(nombre_usuario, [{"humano": humano, "asistente": asistente}])
+        )
+        self._tareas.add(tarea)
+        tarea.add_done_callback(self._tareas.discard)
+
+    async def aindexar_historial(self, nombre_usuario: str) -> int:
+        """
+        Indexa el historial ya existente de un usuario (una sola vez).
+
+        Una marca en Redis evita que varios procesos lo indexen a la vez.
+        """
+        cliente = self.historiales.cliente()
+        clave_vectores, _ = claves_memoria(nombre_usuario)
+        if not await cliente.set(f"{clave_vectores}:backfill", 1, nx=True, ex=self.historiales.ttl_segundos):
+            return 0
+
+        intercambios = []
+        pregunta = None
+        for mensaje in await self.historiales.aobtener(nombre_usuario):
+            if isinstance(mensaje, HumanMessage):
+                pregunta = mensaje.content
+            elif isinstance(mensaje, AIMessage) and pregunta is not None:
+                intercambios.append({"humano": pregunta, "asistente": mensaje.content})
+                pregunta = None
+        await self.aindexar(nombre_usuario, intercambios)
+        return len(intercambios)
+
+    # ----------------------------------------
+    # Búsqueda
+    # ----------------------------------------
+
+    async def _acargar_indice(self, nombre_usuario: str):
+        """Sincroniza la copia local leyendo solo las entradas nuevas de Redis"""
+        usuario = nombre_usuario.lower()
+        clave_vectores, clave_textos = claves_memoria(usuario)
+        with self._lock:
+            matriz, textos = self._indices.get(usuario, (None, []))
+            if matriz is not None:
+                self._indices.move_to_end(usuario)
+
+        cliente = self.historiales.cliente()
+        total = await cliente.llen(clave_textos)
+        if total < len(textos):
+            # Las claves expiraron (TTL): la copia local ya no corresponde
+            self._descartar(usuario)
+            matriz, textos = None, []
+        if total > len(textos):
+            async with cliente.pipeline(transaction=False) as pipe:
+                pipe.lrange(clave_vectores, len(textos), total - 1)
+                pipe.lrange(clave_textos, len(textos), total - 1)
+                nuevos_vectores, nuevos_textos = await pipe.execute()
+            nuevos = np.vstack([np.frombuffer(v, dtype=np.float32) for v in nuevos_vectores])
+            matriz = nuevos if matriz is None else np.vstack([matriz, nuevos])
+            textos = textos + [json.loads(t) for t in nuevos_textos]
+            self._guardar(usuario, matriz, textos)
+        return matriz, textos
+
+    def _guardar(self, usuario: str, matriz, textos: list):
+        """Guarda la copia local de un índice y desaloja los usuarios menos recientes"""
+        with self._lock:
+            anterior = self._indices.pop(usuario, None)
+            if anterior is not None:
+                self.bytes_retenidos -= anterior[0].nbytes
+            self._indices[usuario] = (matriz, textos)
+            self.bytes_retenidos += matriz.nbytes
+            while len(self._indices) > 1 and (
+                len(self._indices) > self.max_usuarios or self.bytes_retenidos > self.max_bytes
+            ):
+                _, (desalojada, _) = self._indices.popitem(last=False)
+                self.bytes_retenidos -= desalojada.nbytes
+                self.desalojos += 1
+
+    def _descartar(self, usuario: str):
+        with self._lock:
+            anterior = self._indices.pop(usuario, None)
+            if anterior is not None:
+                self.bytes_retenidos -= anterior[0].nbytes
+
+    async def abuscar(
+        self, nombre_usuario: str, consulta: str, k: int = 3, excluir: Optional[set] = None
+    ) -> List[dict]:
+        """
+        Devuelve los k intercambios más parecidos a la consulta.
+
+        `excluir` son mensajes del usuario que ya van en el prompt (historial
+        reciente) y no vale la pena repetir.
+        """
+        matriz, textos = await self._acargar_indice(nombre_usuario)
+        self.busquedas += 1
+        if matriz is None:
+            # Índice vacío: indexar en segundo plano lo que ya hubiera en Redis
+            tarea = asyncio.ensure_future(self.aindexar_historial(nombre_usuario))
+            self._tareas.add(tarea)
+            tarea.add_done_callback(self._tareas.discard)
+            return []
+
+        consulta_vec = np.asarray(await self.embeddings.aembed_query(consulta), dtype=np.float32)
+        puntajes = matriz @ consulta_vec
+        candidatos = min(len(textos), k + len(excluir or ()))
+        mejores = np.argpartition(-puntajes, candidatos - 1)[:candidatos]
+        mejores = mejores[np.argsort(-puntajes[mejores])]
+
+        resultados = []
+        for i in mejores:
+            if excluir and textos[i]["humano"] in excluir:
+                continue
+            resultados.append({**textos[i], "similitud": float(puntajes[i])})
+            if len(resultados) == k:
+                break
+        return resultados
+
+    async def aesperar(self):
+        """Espera a que terminen los indexados en curso"""
+        if self._tareas:
+            await asyncio.gather(*list(self._tareas), return_exceptions=True)
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            en_memoria = sum(len(t) for _, t in self._indices.values())
+        return {
+            "intercambios_indexados": self.intercambios_indexados,
+            "busquedas": self.busquedas,
+            "usuarios_en_memoria": len(self._indices),
+            "intercambios_en_memoria": en_memoria,
+            "bytes_en_memoria": self.bytes_retenidos,
+            "desalojos": self.desalojos,
+        }
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Migración de historiales al formato compacto
+
+Recorre `message_store:usuario_*` con SCAN y reescribe cada lista en formato
+compacto (`[rol, contenido, ts]`, ver `formato_historial`). Cada usuario se
+migra en una transacción con WATCH, así que puede ejecutarse con la app en
+marcha: si llega un mensaje mientras tanto, ese usuario se reintenta. Los
+mensajes migrados quedan con ts=0 (el formato de LangChain no guarda fecha).
+
+Con `--archivar-mas-de N` además archiva en segmentos comprimidos todo salvo
+los N mensajes más recientes de cada usuario.
+
+Uso:
+    python migrar_historial.py [--redis-url redis://localhost:6379] [--dry-run]
+        [--archivar-mas-de 200]
+"""
+
+import argparse
+import asyncio
+import os
+
+from dotenv import load_dotenv
+
+from formato_historial import es_compacto
+from historial_redis import MIN_SEGMENTO_ARCHIVO, PREFIJO_CLAVE, PREFIJO_USUARIO, HistorialRedis
+
+
+async def migrar(redis_url: str, dry_run: bool = False, archivar_mas_de: int = None) -> dict:
+    historiales = HistorialRedis(redis_url, formato="compacto")
+    cliente = historiales.cliente()
+    prefijo = PREFIJO_CLAVE + PREFIJO_USUARIO
+    totales = {"usuarios": 0, "mensajes_convertidos": 0, "mensajes_archivados": 0, "bytes_antes": 0}
+
+    try:
+        async for clave in cliente.scan_iter(match=f"{prefijo}*", count=500):
+            clave = clave.decode("utf-8") if isinstance(clave, bytes) else clave
+            usuario = clave[len(prefijo):]
+            totales["usuarios"] += 1
+            if dry_run:
+                items = await cliente.lrange(clave, 0, -1)
+                totales["mensajes_convertidos"] += sum(1 for m in items if not es_compacto(m))
+                totales["bytes_antes"] += sum(len(m) for m in items)
+                continue
+
+            totales["mensajes_convertidos"] += await historiales.amigrar(usuario)
+            if archivar_mas_de is not None:
+                totales["mensajes_archivados"] += await historiales.aarchivar(
+                    usuario, archivar_mas_de, minimo=MIN_SEGMENTO_ARCHIVO
+                )
+    finally:
+        await historiales.acerrar()
+    return totales
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default=os.getenv("REDIS_URL", "redis://localhost:6379"))
+    parser.add_argument("--dry-run", action="store_true", help="solo contar, sin escribir")
+    parser.add_argument("--archivar-mas-de", type=int, default=None, help="mensajes recientes que quedan sin archivar")
+    args = parser.parse_args()
+
+    totales = asyncio.run(migrar(args.redis_url, args.dry_run, args.archivar_mas_de))
+    if args.dry_run:
+        print(
+            f"🔎 {totales['usuarios']} usuarios, {totales['mensajes_convertidos']} mensajes por convertir "
+            f"({totales['bytes_antes']} bytes actuales)"
+        )
+    else:
+        print(
+            f"✅ {totales['usuarios']} usuarios migrados: {totales['mensajes_convertidos']} mensajes "
+            f"convertidos, {totales['mensajes_archivados']} archivados"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Fábricas de modelos de lenguaje para ChatMultiUsuario
+
+Una fábrica es cualquier callable `fabrica(rol) -> modelo de chat` donde
+`rol` es "detector", "chat" o "resumen". Así cada cadena puede usar un modelo
+distinto (p. ej. un detector más barato) y las pruebas de carga pueden correr
+sin red con `LLMFalso`, que devuelve `DeteccionUsuario`/`RespuestaChat`
+válidos con latencia y cantidad de tokens configurables, `ServidorFalso`
+simula los límites del proveedor (respuestas 429) y `CachePrefijosFalsa` su
+caché de prompts (tokens de entrada en caché en `usage_metadata`).
+"""
+
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableLambda
+
+from historial_redis import estimar_tokens
+
+MODELO_POR_DEFECTO = "gpt-4o-mini"
+
+FabricaModelos = Callable[[str], BaseChatModel]
+
+
+def fabrica_openai(
+    api_key: Optional[str] = None, modelos: Optional[Dict[str, str]] = None, **parametros
+) -> FabricaModelos:
+    """
+    Fábrica de `ChatOpenAI` por rol.
+
+    `modelos` permite elegir el modelo de cada rol, p. ej.
+    `{"detector": "gpt-4o-mini", "chat": "gpt-4o"}`. La API key se pasa al
+    cliente sin escribirla en `os.environ`. `langchain_openai` se importa al
+    crear el primer modelo, no al crear la fábrica.
+    """
+    modelos = modelos or {}
+
+    parametros.setdefault("temperature", 0)
+    # Los reintentos (con backoff y cortocircuito) los hace PasarelaLLM
+    parametros.setdefault("max_retries", 0)
+    # Sin esto OpenAI no reporta tokens en streaming
+    parametros.setdefault("stream_usage", True)
+    if api_key:
+        parametros["api_key"] = api_key
+
+    def fabrica(rol: str) -> BaseChatModel:
+        from langchain_openai import ChatOpenAI
+
+        return ChatOpenAI(model=modelos.get(rol, MODELO_POR_DEFECTO), **parametros)
+
+    return fabrica
+
+
+def fabrica_falsa(**parametros) -> FabricaModelos:
+    """Fábrica de `LLMFalso` (los parámetros se aplican a todos los roles)"""
+
+    def fabrica(rol: str) -> BaseChatModel:
+        return LLMFalso(**parametros)
+
+    return fabrica
+
+
+# ========================================
+# LLM FALSO DETERMINISTA
+# ========================================
+
+class ErrorLimiteFalso(Exception):
+    """429 simulado, con los atributos que `PasarelaLLM` lee de los errores de OpenAI"""
+
+    status_code = 429
+
+    def __init__(self, motivo: str, retry_after: Optional[float] = None):
+        super().__init__(f"Error code: 429 - {motivo}")
+        self.retry_after = retry_after
+
+
+class ServidorFalso:
+    """
+    Proveedor simulado compartido por varios `LLMFalso`: responde 429 si hay
+    más de `max_concurrentes` solicitudes en curso, si se pasan
+    `solicitudes_por_minuto` (ventana deslizante) o al azar con `tasa_429`.
+    """
+
+    def __init__(
+        self,
+        max_concurrentes: Optional[int] = None,
+        solicitudes_por_minuto: Optional[int] = None,
+        tasa_429: float = 0.0,
+        retry_after: Optional[float] = None,
+        semilla: int = 0,
+    ):
+        self.max_concurrentes = max_concurrentes
+        self.solicitudes_por_minuto = solicitudes_por_minuto
+        self.tasa_429 = tasa_429
+        self.retry_after = retry_after
+        self._azar = random.Random(semilla)
+        self._recientes = deque()
+        self._lock = threading.Lock()
+        self.en_curso = 0
+        self.atendidas = 0
+        self.rechazadas = 0
+
+    def entrar(self):
+        with self._lock:
+            ahora = time.monotonic()
+            while self._recientes and ahora - self._recientes[0] > 60:
+                self._recientes.popleft()
+            motivo = None
+            if self.tasa_429 and self._azar.random() < self.tasa_429:
+                motivo = "Rate limit reached (inyectado)"
+            elif self.max_concurrentes and self.en_curso >= self.max_concurrentes:
+                motivo = "Too many concurrent requests"
+            elif self.solicitudes_por_minuto and len(self._recientes) >= self.solicitudes_por_minuto:
+                motivo = "Rate limit reached for requests per min"
+            if motivo:
+                self.rechazadas += 1
+                raise ErrorLimiteFalso(motivo, self.retry_after)
+            self._recientes.append(ahora)
+            self.en_curso += 1
+            self.atendidas += 1
+
+    def salir(self):
+        with self._lock:
+            self.en_curso -= 1
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            return {"atendidas": self.atendidas, "rechazadas_429": self.rechazadas}
+
+
+class CachePrefijosFalsa:
+    """
+    Caché de prompts simulada del proveedor, compartida por varios `LLMFalso`.
+    Como la de OpenAI, reutiliza el prefijo más largo ya visto, redondeado a
+    bloques de `bloque` tokens, y solo en prompts de al menos `tokens_minimos`.
+    Compara mensajes completos (la real compara tokens), así que nunca
+    reporta más caché que un proveedor real.
+    """
+
+    def __init__(self, tokens_minimos: int = 1024, bloque: int = 128, max_prefijos: int = 100_000):
+        self.tokens_minimos = tokens_minimos
+        self.bloque = bloque
+        self.max_prefijos = max_prefijos
+        self._prefijos = OrderedDict()
+        self._lock = threading.Lock()
+        self.consultas = 0
+        self.tokens_entrada = 0
+        self.tokens_en_cache = 0
+
+    def consultar(self, messages: List[BaseMessage]) -> int:
+        """Registra el prompt y devuelve cuántos de sus tokens estaban en caché"""
+        claves, acumulados = [], []
+        resumen, total = hashlib.sha1(), 0
+        for mensaje in messages:
+            resumen.update(f"{mensaje.type}\0{mensaje.content}\0".encode("utf-8"))
+            total += estimar_tokens(str(mensaje.content))
+            claves.append(resumen.hexdigest())
+            acumulados.append(total)
+
+        with self._lock:
+            prefijo = 0
+            for clave, tokens in zip(claves, acumulados):
+                if clave not in self._prefijos:
+                    break
+                self._prefijos.move_to_end(clave)
+                prefijo = tokens
+            for clave in claves:
+                self._prefijos[clave] = True
+                self._prefijos.move_to_end(clave)
+            while len(self._prefijos) > self.max_prefijos:
+                self._prefijos.popitem(last=False)
+            en_cache = prefijo // self.bloque * self.bloque if total >= self.tokens_minimos else 0
+            self.consultas += 1
+            self.tokens_entrada += total
+            self.tokens_en_cache += en_cache
+        return en_cache
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            return {
+                "consultas": self.consultas,
+                "tokens_entrada": self.tokens_entrada,
+                "tokens_en_cache": self.tokens_en_cache,
+                "tasa_cache": self.tokens_en_cache / self.tokens_entrada if self.tokens_entrada else 0.0,
+            }
+
+
+_MENSAJE_DETECTOR = re.compile(r'Mensaje:\s*"(?P<mensaje>.*)"\s*$', re.DOTALL)
+_USUARIO_ACTUAL = re.compile(r"Usuario actual:\s*(?P<usuario>.+)")
+
+
+class LLMFalso(BaseChatModel):
+    """
+    Modelo de chat local y determinista para pruebas de carga y perfilado.
+
+    Simula `latencia_ms` hasta el primer token y `ms_por_token` por cada uno
+    de los `tokens_respuesta` tokens generados. Con `with_structured_output`
+    devuelve objetos válidos: el detector aplica las reglas de
+    `DetectorLocal` y el chat responde al usuario que indica el prompt.
+    Con `servidor` (un `ServidorFalso`) cada llamada puede recibir un 429, y
+    con `cache_prompts` (una `CachePrefijosFalsa`) reporta tokens en caché.
+    """
+
+    latencia_ms: float = 50.0
+    ms_por_token: float = 0.0
+    tokens_respuesta: int = 20
+    servidor: Optional[Any] = None
+    cache_prompts: Optional[Any] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "llm-falso"
+
+    # ----------------------------------------
+    # Generación
+    # ----------------------------------------
+
+    def _texto(self, messages: List[BaseMessage]) -> str:
+        humano = next((m.content for m in reversed(messages) if isinstance(m, HumanMessage)), "")
+        palabras = f"Respuesta simulada a: {humano}".split()
+        relleno = max(self.tokens_respuesta - len(palabras), 0)
+        return " ".join((palabras + ["bla"] * relleno)[: max(self.tokens_respuesta, 1)])
+
+    def _contenido(self, messages: List[BaseMessage], esquema=None) -> str:
+        """Texto plano, o el JSON del esquema pedido con `with_structured_output`"""
+        if esquema is None:
+            return self._texto(messages)
+
+        prompt = "\n".join(str(m.content) for m in messages)
+        campos = esquema.model_fields
+        datos = {}
+        if "usuario_identificado" in campos:
+            from detector_local import DetectorLocal
+
+            # Prompt del detector ("Mensaje: ...") o, en el modo fusionado, el último mensaje humano
+            coincidencia = _MENSAJE_DETECTOR.search(prompt)
+            humano = next((m.content for m in reversed(messages) if isinstance(m, HumanMessage)), prompt)
+            mensaje = coincidencia.group("mensaje") if coincidencia else humano
+            deteccion = DetectorLocal().detectar(mensaje)
+            if deteccion is None:
+                datos.update(usuario_identificado=False, nombre_usuario=None, tipo_identificacion="ninguna")
+            else:
+                datos.update(deteccion.model_dump())
+        if "requiere_identificacion" in campos:
+            coincidencia = _USUARIO_ACTUAL.search(prompt)
+            datos.update(
+                mensaje=self._texto(messages),
+                usuario_actual=coincidencia.group("usuario").strip() if coincidencia else None,
+                requiere_identificacion=False,
+            )
+        if not datos:
+            raise ValueError(f"LLMFalso no sabe generar {esquema.__name__}")
+        return json.dumps(datos, ensure_ascii=False)
+
+    def _mensaje(self, messages: List[BaseMessage], contenido: str) -> AIMessage:
+        tokens_entrada = sum(estimar_tokens(str(m.content)) for m in messages)
+        tokens_salida = estimar_tokens(contenido)
+        uso = {
+            "input_tokens": tokens_entrada,
+            "output_tokens": tokens_salida,
+            "total_tokens": tokens_entrada + tokens_salida,
+        }
+        if self.cache_prompts is not None:
+            uso["input_token_details"] = {"cache_read": self.cache_prompts.consultar(messages)}
+        return AIMessage(content=contenido, usage_metadata=uso)
+
+    def _segundos(self) -> float:
+        return (self.latencia_ms + self.ms_por_token * self.tokens_respuesta) / 1000
+
+    def _entrar(self):
+        if self.servidor is not None:
+            self.servidor.entrar()
+
+    def _salir(self):
+        if self.servidor is not None:
+            self.servidor.salir()
+
+    def _generate(self, messages, stop=None, run_manager=None, esquema=None, **kwargs) -> ChatResult:
+        self._entrar()
+        try:
+            time.sleep(self._segundos())
+        finally:
+            self._salir()
+        contenido = self._contenido(messages, esquema)
+        return ChatResult(generations=[ChatGeneration(message=self._mensaje(messages, contenido))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, esquema=None, **kwargs) -> ChatResult:
+        self._entrar()
+        try:
+            await asyncio.sleep(self._segundos())
+        finally:
+            self._salir()
+        contenido = self._contenido(messages, esquema)
+        return ChatResult(generations=[ChatGeneration(message=self._mensaje(messages, contenido))])
+
+    def _fragmentos(self, messages: List[BaseMessage]) -> List[AIMessageChunk]:
+        """Un fragmento por palabra; el uso de tokens va en el último, como en OpenAI"""
+        texto = self._texto(messages)
+        palabras = texto.split()
+        fragmentos = [
+            AIMessageChunk(content=palabra if i == 0 else f" {palabra}") for i, palabra in enumerate(palabras)
+        ]
+        fragmentos.append(AIMessageChunk(content="", usage_metadata=self._mensaje(messages, texto).usage_metadata))
+        return fragmentos
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        self._entrar()
+        try:
+            time.sleep(self.latencia_ms / 1000)
+            for fragmento in self._fragmentos(messages):
+                time.sleep(self.ms_por_token / 1000 if fragmento.content else 0)
+                yield ChatGenerationChunk(message=fragmento)
+        finally:
+            self._salir()
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        self._entrar()
+        try:
+            await asyncio.sleep(self.latencia_ms / 1000)
+            for fragmento in self._fragmentos(messages):
+                await asyncio.sleep(self.ms_por_token / 1000 if fragmento.content else 0)
+                yield ChatGenerationChunk(message=fragmento)
+        finally:
+            self._salir()
+
+    def with_structured_output(self, schema, **kwargs: Any):
+        """Devuelve instancias de `schema` (modelo Pydantic) en lugar de texto"""
+        return self.bind(esquema=schema) | RunnableLambda(
+            lambda mensaje: schema.model_validate_json(mensaje.content)
+        )
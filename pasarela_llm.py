@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""
+Pasarela de llamadas al LLM: admisión, límites y reintentos
+
+Todas las cadenas de `ChatMultiUsuario` (detector, chat, streaming, resumen)
+llaman al proveedor a través de una misma `PasarelaLLM`, que aplica:
+
+- Límite de concurrencia: como mucho `max_concurrencia` llamadas en curso;
+  el resto espera en cola por orden de llegada.
+- Cubetas de tokens por minuto para solicitudes (`solicitudes_por_minuto`)
+  y tokens (`tokens_por_minuto`, estimados del prompt más
+  `tokens_salida_estimados`, y corregidos con el uso real cuando el modelo
+  lo reporta). Se reserva al admitir, así que no hay estampidas al recargar.
+- Cola acotada con plazo: si hay `max_cola` llamadas esperando, o si la
+  espera no cabe en `plazo_segundos`, la llamada se rechaza de inmediato con
+  `LLMSaturado` en lugar de acumular trabajo que llegaría tarde.
+- Reintentos con espera exponencial y jitter completo ante 429, 5xx y
+  errores de conexión, respetando `retry-after` si el proveedor lo envía.
+- Cortocircuito: tras `umbral_circuito` fallos reintentables seguidos, las
+  llamadas se rechazan durante `segundos_circuito` y luego pasa una sola de
+  prueba; si funciona, se cierra.
+
+`estadisticas()` expone cola, esperas, rechazos, reintentos y el estado del
+circuito. Los límites de concurrencia son por event loop (uno por instancia
+de `ChatMultiUsuario`); las cubetas y el circuito son de toda la pasarela.
+"""
+
+import asyncio
+import random
+import threading
+import time
+import weakref
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+from langchain_core.runnables import Runnable
+
+from historial_redis import estimar_tokens
+
+# Errores del proveedor que vale la pena reintentar
+CODIGOS_REINTENTABLES = {408, 409, 429, 500, 502, 503, 504}
+ERRORES_REINTENTABLES = {"APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError"}
+
+
+class LLMSaturado(RuntimeError):
+    """Llamada rechazada por la pasarela (cola llena, plazo vencido o circuito abierto)"""
+
+    def __init__(self, motivo: str, mensaje: str, reintentar_en: Optional[float] = None):
+        super().__init__(mensaje)
+        self.motivo = motivo
+        self.reintentar_en = reintentar_en
+
+
+def es_reintentable(error: BaseException) -> bool:
+    codigo = getattr(error, "status_code", None)
+    if codigo is not None:
+        return codigo in CODIGOS_REINTENTABLES
+    return type(error).__name__ in ERRORES_REINTENTABLES
+
+
+def espera_sugerida(error: BaseException) -> Optional[float]:
+    """Segundos de `retry-after` (atributo o cabecera HTTP de la respuesta), si los hay"""
+    segundos = getattr(error, "retry_after", None)
+    if segundos is not None:
+        return float(segundos)
+    cabeceras = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if "retry-after-ms" in cabeceras:
+            return float(cabeceras["retry-after-ms"]) / 1000
+        if "retry-after" in cabeceras:
+            return float(cabeceras["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def estimar_tokens_entrada(entrada) -> int:
+    """Tokens aproximados de lo que se envía al modelo (PromptValue, mensajes o texto)"""
+    if hasattr(entrada, "to_messages"):
+        entrada = entrada.to_messages()
+    if isinstance(entrada, list):
+        return sum(estimar_tokens(str(getattr(m, "content", m))) + 4 for m in entrada)
+    return estimar_tokens(str(entrada))
+
+
+class CubetaTokens:
+    """Cubeta que se recarga a `por_minuto` / 60 unidades por segundo (admite saldo negativo = reservas)"""
+
+    def __init__(self, por_minuto: float):
+        self.capacidad = float(por_minuto)
+        self.tasa = por_minuto / 60.0
+        self.disponibles = self.capacidad
+        self._actualizado = time.monotonic()
+
+    def _recargar(self):
+        ahora = time.monotonic()
+        self.disponibles = min(self.capacidad, self.disponibles + (ahora - self._actualizado) * self.tasa)
+        self._actualizado = ahora
+
+    def espera(self, cantidad: float) -> float:
+        """Segundos hasta que haya `cantidad` disponible"""
+        self._recargar()
+        faltan = min(cantidad, self.capacidad) - self.disponibles
+        return max(faltan, 0.0) / self.tasa
+
+    def reservar(self, cantidad: float):
+        self.disponibles -= min(cantidad, self.capacidad)
+
+    def devolver(self, cantidad: float):
+        self._recargar()
+        self.disponibles = min(self.capacidad, self.disponibles + cantidad)
+
+
+class PasarelaLLM:
+    """Control de admisión compartido para las llamadas al LLM"""
+
+    def __init__(
+        self,
+        max_concurrencia: Optional[int] = 16,
+        solicitudes_por_minuto: Optional[float] = None,
+        tokens_por_minuto: Optional[float] = None,
+        max_cola: int = 100,
+        plazo_segundos: float = 30.0,
+        max_reintentos: int = 3,
+        espera_base: float = 0.5,
+        espera_maxima: float = 8.0,
+        umbral_circuito: Optional[int] = 5,
+        segundos_circuito: float = 15.0,
+        tokens_salida_estimados: int = 256,
+    ):
+        """Con `max_concurrencia`, `umbral_circuito` o los límites por minuto en None no se aplica ese control"""
+        self.max_concurrencia = max_concurrencia
+        self.max_cola = max_cola
+        self.plazo_segundos = plazo_segundos
+        self.max_reintentos = max_reintentos
+        self.espera_base = espera_base
+        self.espera_maxima = espera_maxima
+        self.umbral_circuito = umbral_circuito
+        self.segundos_circuito = segundos_circuito
+        self.tokens_salida_estimados = tokens_salida_estimados
+        self.cubeta_solicitudes = CubetaTokens(solicitudes_por_minuto) if solicitudes_por_minuto else None
+        self.cubeta_tokens = CubetaTokens(tokens_por_minuto) if tokens_por_minuto else None
+
+        self._semaforos = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._azar = random.Random()
+        # Circuito: fallos seguidos, hasta cuándo está abierto y si hay una prueba en curso
+        self._fallos_seguidos = 0
+        self._abierto_hasta = 0.0
+        self._prueba_en_curso = False
+
+        self.en_cola = 0
+        self.en_curso = 0
+        self.max_en_cola = 0
+        self.admitidas = 0
+        self.completadas = 0
+        self.fallidas = 0
+        self.reintentos = 0
+        self.errores_reintentables = 0
+        self.segundos_espera = 0.0
+        self.espera_maxima_observada = 0.0
+        self.rechazos = {"cola_llena": 0, "plazo": 0, "circuito": 0}
+        self.aperturas_circuito = 0
+
+    def envolver(self, runnable: Runnable) -> "RunnableConPasarela":
+        """El mismo Runnable, con cada llamada pasando por la pasarela"""
+        return RunnableConPasarela(self, runnable)
+
+    # ----------------------------------------
+    # Admisión
+    # ----------------------------------------
+
+    def _semaforo(self) -> Optional[asyncio.Semaphore]:
+        if not self.max_concurrencia:
+            return None
+        bucle = asyncio.get_running_loop()
+        semaforo = self._semaforos.get(bucle)
+        if semaforo is None:
+            semaforo = self._semaforos[bucle] = asyncio.Semaphore(self.max_concurrencia)
+        return semaforo
+
+    def _rechazar(self, motivo: str, mensaje: str, reintentar_en: Optional[float] = None):
+        with self._lock:
+            self.rechazos[motivo] += 1
+        raise LLMSaturado(motivo, mensaje, reintentar_en)
+
+    def _comprobar_circuito(self) -> bool:
+        """Rechaza si el circuito está abierto; devuelve True si esta llamada es la de prueba"""
+        if self.umbral_circuito is None:
+            return False
+        with self._lock:
+            if self._fallos_seguidos < self.umbral_circuito:
+                return False
+            restante = self._abierto_hasta - time.monotonic()
+            if restante <= 0 and not self._prueba_en_curso:
+                self._prueba_en_curso = True
+                return True
+        self._rechazar(
+            "circuito", "El servicio del modelo está fallando; se reintentará en unos segundos",
+            max(restante, 0.0) or self.segundos_circuito,
+        )
+
+    def _registrar_resultado(self, exito: bool, reintentable: bool, prueba: bool):
+        with self._lock:
+            if prueba:
+                self._prueba_en_curso = False
+            if exito:
+                self._fallos_seguidos = 0
+                return
+            if not reintentable:
+                return
+            self._fallos_seguidos += 1
+            if self.umbral_circuito is not None and self._fallos_seguidos >= self.umbral_circuito:
+                if prueba or self._fallos_seguidos == self.umbral_circuito:
+                    self.aperturas_circuito += 1
+                    print(f"⛔ Circuito del LLM abierto por {self.segundos_circuito:g} s")
+                self._abierto_hasta = time.monotonic() + self.segundos_circuito
+
+    async def _aadmitir(self, tokens: int, limite: float):
+        """Espera turno (concurrencia y cubetas) sin pasar de `limite` (monotonic)"""
+        with self._lock:
+            if self.en_cola >= self.max_cola:
+                lleno = True
+            else:
+                lleno = False
+                self.en_cola += 1
+                self.max_en_cola = max(self.max_en_cola, self.en_cola)
+        if lleno:
+            self._rechazar("cola_llena", "Demasiadas solicitudes en espera; intenta de nuevo en unos segundos")
+
+        inicio = time.monotonic()
+        semaforo = self._semaforo()
+        try:
+            if semaforo is not None:
+                try:
+                    await asyncio.wait_for(semaforo.acquire(), max(limite - time.monotonic(), 0.0))
+                except asyncio.TimeoutError:
+                    self._rechazar("plazo", "El modelo está saturado; intenta de nuevo en unos segundos")
+            try:
+                with self._lock:
+                    espera = max(
+                        self.cubeta_solicitudes.espera(1) if self.cubeta_solicitudes else 0.0,
+                        self.cubeta_tokens.espera(tokens) if self.cubeta_tokens else 0.0,
+                    )
+                    cabe = time.monotonic() + espera <= limite
+                    if cabe:
+                        if self.cubeta_solicitudes:
+                            self.cubeta_solicitudes.reservar(1)
+                        if self.cubeta_tokens:
+                            self.cubeta_tokens.reservar(tokens)
+                if not cabe:
+                    self._rechazar("plazo", "Límite de uso del modelo alcanzado; intenta en unos segundos", espera)
+                if espera > 0:
+                    await asyncio.sleep(espera)
+            except BaseException:
+                if semaforo is not None:
+                    semaforo.release()
+                raise
+        finally:
+            esperado = time.monotonic() - inicio
+            with self._lock:
+                self.en_cola -= 1
+                self.segundos_espera += esperado
+                self.espera_maxima_observada = max(self.espera_maxima_observada, esperado)
+
+        with self._lock:
+            self.admitidas += 1
+            self.en_curso += 1
+
+    def _liberar(self, tokens_reservados: int, tokens_reales: Optional[int]):
+        semaforo = self._semaforo()
+        if semaforo is not None:
+            semaforo.release()
+        with self._lock:
+            self.en_curso -= 1
+            if self.cubeta_tokens and tokens_reales is not None:
+                # Corrige la reserva con el uso real reportado por el modelo
+                diferencia = tokens_reservados - tokens_reales
+                if diferencia > 0:
+                    self.cubeta_tokens.devolver(diferencia)
+                else:
+                    self.cubeta_tokens.reservar(-diferencia)
+
+    def _espera_reintento(self, intento: int, error: BaseException) -> float:
+        """Backoff exponencial con jitter completo (o lo que pida `retry-after`)"""
+        sugerida = espera_sugerida(error)
+        if sugerida is not None:
+            return min(sugerida, self.espera_maxima)
+        return self._azar.uniform(0, min(self.espera_maxima, self.espera_base * 2 ** intento))
+
+    # ----------------------------------------
+    # Ejecución
+    # ----------------------------------------
+
+    async def aejecutar(self, llamada: Callable[[], Awaitable[Any]], tokens_entrada: int = 0) -> Any:
+        """Ejecuta `llamada()` con admisión, reintentos y cortocircuito"""
+        tokens = tokens_entrada + self.tokens_salida_estimados
+        limite = time.monotonic() + self.plazo_segundos
+        intento = 0
+        while True:
+            prueba = self._comprobar_circuito()
+            try:
+                await self._aadmitir(tokens, limite)
+            except BaseException:
+                if prueba:
+                    self._registrar_resultado(False, False, True)
+                raise
+            try:
+                resultado = await llamada()
+            except Exception as e:
+                self._liberar(tokens, None)
+                reintentable = es_reintentable(e)
+                self._registrar_resultado(False, reintentable, prueba)
+                espera = await self._aantes_de_reintentar(e, reintentable, intento, limite)
+                if espera is None:
+                    raise
+                intento += 1
+                continue
+            except BaseException:
+                self._liberar(tokens, None)
+                if prueba:
+                    self._registrar_resultado(False, False, True)
+                raise
+            self._liberar(tokens, tokens_reales(resultado, tokens_entrada))
+            self._registrar_resultado(True, False, prueba)
+            with self._lock:
+                self.completadas += 1
+            return resultado
+
+    async def aejecutar_stream(
+        self, abrir: Callable[[], AsyncIterator[Any]], tokens_entrada: int = 0
+    ) -> AsyncIterator[Any]:
+        """Como `aejecutar` para un stream: solo se reintenta si aún no llegó ningún fragmento"""
+        tokens = tokens_entrada + self.tokens_salida_estimados
+        limite = time.monotonic() + self.plazo_segundos
+        intento = 0
+        while True:
+            prueba = self._comprobar_circuito()
+            try:
+                await self._aadmitir(tokens, limite)
+            except BaseException:
+                if prueba:
+                    self._registrar_resultado(False, False, True)
+                raise
+            emitidos = 0
+            ultimo = None
+            try:
+                async for fragmento in abrir():
+                    emitidos += 1
+                    ultimo = fragmento
+                    yield fragmento
+            except Exception as e:
+                self._liberar(tokens, None)
+                reintentable = es_reintentable(e)
+                self._registrar_resultado(False, reintentable, prueba)
+                if emitidos:
+                    with self._lock:
+                        self.fallidas += 1
+                    raise
+                espera = await self._aantes_de_reintentar(e, reintentable, intento, limite)
+                if espera is None:
+                    raise
+                intento += 1
+                continue
+            except BaseException:
+                self._liberar(tokens, None)
+                if prueba:
+                    self._registrar_resultado(False, False, True)
+                raise
+            self._liberar(tokens, tokens_reales(ultimo, tokens_entrada))
+            self._registrar_resultado(True, False, prueba)
+            with self._lock:
+                self.completadas += 1
+            return
+
+    async def _aantes_de_reintentar(
+        self, error: BaseException, reintentable: bool, intento: int, limite: float
+    ) -> Optional[float]:
+        """Espera antes del siguiente intento; None si no hay que reintentar"""
+        with self._lock:
+            if reintentable:
+                self.errores_reintentables += 1
+            puede = reintentable and intento < self.max_reintentos
+            espera = self._espera_reintento(intento, error) if puede else 0.0
+            if not puede or time.monotonic() + espera > limite:
+                self.fallidas += 1
+                return None
+            self.reintentos += 1
+        print(f"🔁 Reintento {intento + 1} del LLM en {espera:.2f} s ({type(error).__name__})")
+        await asyncio.sleep(espera)
+        return espera
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            fallos, abierto_hasta = self._fallos_seguidos, self._abierto_hasta
+            if self.umbral_circuito is None or fallos < self.umbral_circuito:
+                circuito = "cerrado"
+            else:
+                circuito = "abierto" if abierto_hasta > time.monotonic() else "semiabierto"
+            esperas = self.admitidas + sum(self.rechazos.values())
+            return {
+                "en_cola": self.en_cola,
+                "en_curso": self.en_curso,
+                "max_en_cola": self.max_en_cola,
+                "admitidas": self.admitidas,
+                "completadas": self.completadas,
+                "fallidas": self.fallidas,
+                "reintentos": self.reintentos,
+                "errores_reintentables": self.errores_reintentables,
+                "rechazos": dict(self.rechazos),
+                "espera_promedio_ms": self.segundos_espera / esperas * 1000 if esperas else 0.0,
+                "espera_maxima_ms": self.espera_maxima_observada * 1000,
+                "circuito": circuito,
+                "aperturas_circuito": self.aperturas_circuito,
+            }
+
+
+def tokens_reales(salida, tokens_entrada: int) -> Optional[int]:
+    """Tokens totales reportados por el modelo (solo si la salida es un mensaje con uso)"""
+    uso = getattr(salida, "usage_metadata", None)
+    if not uso:
+        return None
+    return uso.get("total_tokens") or uso.get("input_tokens", tokens_entrada) + uso.get("output_tokens", 0)
+
+
+class RunnableConPasarela(Runnable):
+    """Envuelve un modelo (o modelo con salida estructurada) para que sus llamadas pasen por la pasarela"""
+
+    def __init__(self, pasarela: PasarelaLLM, runnable: Runnable):
+        self.pasarela = pasarela
+        self.runnable = runnable
+
+    def invoke(self, entrada, config=None, **kwargs):
+        # El sistema solo llama a los modelos desde su event loop; la vía síncrona no se limita
+        return self.runnable.invoke(entrada, config, **kwargs)
+
+    async def ainvoke(self, entrada, config=None, **kwargs):
+        return await self.pasarela.aejecutar(
+            lambda: self.runnable.ainvoke(entrada, config, **kwargs), estimar_tokens_entrada(entrada)
+        )
+
+    async def astream(self, entrada, config=None, **kwargs):
+        async for fragmento in self.pasarela.aejecutar_stream(
+            lambda: self.runnable.astream(entrada, config, **kwargs), estimar_tokens_entrada(entrada)
+        ):
+            yield fragmento
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Compactación de historiales con resúmenes incrementales
+
+Los mensajes más antiguos que el umbral se resumen (fuera del camino de la
+petición) en un resumen por usuario guardado en `resumen_store:usuario_<nombre>`.
+El resumen se inyecta en el prompt del chat, de modo que el tamaño del prompt
+se mantiene acotado sin perder los datos que el usuario pidió recordar.
+"""
+
+import asyncio
+import uuid
+from typing import Tuple
+
+from langchain_core.messages import AIMessage
+from langchain_core.prompts import ChatPromptTemplate
+
+from formato_historial import decodificar
+from historial_redis import HistorialRedis, clave_archivados, clave_historial, clave_resumen
+
+# Libera el lock solo si sigue siendo nuestro
+_LIBERAR_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Borra el resumen solo si sigue cubriendo más mensajes que el historial actual
+_DESCARTAR_RESUMEN = """
+if tonumber(redis.call('hget', KEYS[1], 'cubiertos') or '0') > tonumber(ARGV[1]) then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Escritura condicional del resumen: solo si nadie avanzó `cubiertos` mientras
+# se esperaba al LLM; aplica el TTL en el mismo paso (ARGV[4] = 0, sin TTL)
+_GUARDAR_RESUMEN = """
+if tonumber(redis.call('hget', KEYS[1], 'cubiertos') or '0') ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('hset', KEYS[1], 'texto', ARGV[2], 'cubiertos', ARGV[3])
+if tonumber(ARGV[4]) > 0 then
+    redis.call('expire', KEYS[1], ARGV[4])
+end
+return 1
+"""
+
+
+class CompactadorHistorial:
+    """Resume de forma incremental los mensajes que exceden el umbral"""
+
+    def __init__(
+        self,
+        historiales: HistorialRedis,
+        llm_resumen,
+        umbral: int = 20,
+        lote_minimo: int = 10,
+        ttl_lock: int = 60,
+    ):
+        """
+        `umbral` es el número de mensajes recientes que se envían literalmente;
+        la compactación solo corre cuando hay al menos `lote_minimo` mensajes
+        nuevos por resumir, para no llamar al LLM en cada turno.
+        """
+        self.historiales = historiales
+        self.umbral = umbral
+        self.lote_minimo = lote_minimo
+        self.ttl_lock = ttl_lock
+        # Instrucciones fijas primero (prefijo reutilizable por la caché de prompts)
+        self.prompt_resumen = ChatPromptTemplate.from_messages([
+            ("system", """
+            Actualiza el resumen de la conversación entre un asistente y un usuario.
+            Conserva los datos personales, preferencias y hechos que el usuario compartió
+            o pidió recordar. Sé breve y usa viñetas.
+            """),
+            ("human", """
+            Usuario: {usuario}
+
+            Resumen actual:
+            {resumen}
+
+            Mensajes nuevos:
+            {mensajes}
+
+            Resumen actualizado:
+            """),
+        ])
+        self.cadena_resumen = self.prompt_resumen | llm_resumen
+        self._en_curso = set()
+        self._tareas = set()
+        self.compactaciones = 0
+        self.mensajes_resumidos = 0
+
+    async def aestado(self, nombre_usuario: str) -> Tuple[str, int, int]:
+        """
+        Devuelve (resumen, mensajes cubiertos, mensajes totales) en un round
+        trip. El total incluye los mensajes archivados.
+
+        Con TTL de historial, cada escritura del historial renueva también el
+        del resumen. Si aun así el resumen cubre más mensajes que el historial
+        (este expiró y se empezó de nuevo), se descarta.
+        """
+        clave = clave_resumen(nombre_usuario)
+        async with self.historiales.cliente().pipeline(transaction=False) as pipe:
+            pipe.hmget(clave, "texto", "cubiertos")
+            pipe.llen(clave_historial(nombre_usuario))
+            pipe.get(clave_archivados(nombre_usuario))
+            (texto, cubiertos), longitud, archivados = await pipe.execute()
+        cubiertos, total = int(cubiertos or 0), longitud + int(archivados or 0)
+        if cubiertos > total:
+            await self.historiales.cliente().eval(_DESCARTAR_RESUMEN, 1, clave, total)
+            print(f"⚠️ Resumen de {nombre_usuario} descartado: cubría {cubiertos} mensajes y quedan {total}")
+            return "", 0, total
+        texto = texto.decode("utf-8") if isinstance(texto, bytes) else (texto or "")
+        return texto, cubiertos, total
+
+    def necesita_compactar(self, cubiertos: int, total: int) -> bool:
+        """True si hay al menos `lote_minimo` mensajes fuera del umbral sin resumir"""
+        return total - self.umbral - cubiertos >= self.lote_minimo
+
+    def programar(self, nombre_usuario: str):
+        """Lanza la compactación en segundo plano (no bloquea el turno)"""
+        usuario = nombre_usuario.lower()
+        if usuario in self._en_curso:
+            return
+        self._en_curso.add(usuario)
+        tarea = asyncio.ensure_future(self.acompactar(usuario))
+        self._tareas.add(tarea)
+        tarea.add_done_callback(self._tareas.discard)
+        tarea.add_done_callback(lambda _: self._en_curso.discard(usuario))
+
+    async def acompactar(self, nombre_usuario: str) -> int:
+        """
+        Resume los mensajes que quedaron fuera del umbral desde la última vez.
+
+        Usa un lock en Redis con expiración para que solo una réplica compacte
+        a un usuario a la vez, y relee el estado bajo el lock, de modo que
+        turnos concurrentes no resuman dos veces el mismo tramo. Devuelve el
+        número de mensajes incorporados al resumen.
+        """
+        cliente = self.historiales.cliente()
+        clave_lock = f"{clave_resumen(nombre_usuario)}:lock"
+        token = uuid.uuid4().hex
+        if not await cliente.set(clave_lock, token, nx=True, ex=self.ttl_lock):
+            return 0
+
+        try:
+            resumen, cubiertos, total = await self.aestado(nombre_usuario)
+            # Posiciones contadas desde el mensaje más antiguo (la cola de la lista).
+            # Solo se archivan mensajes ya resumidos, así que el tramo pendiente
+            # sigue en la lista y los índices desde el más nuevo no cambian
+            if not self.necesita_compactar(cubiertos, total):
+                return 0
+            hasta = total - self.umbral
+
+            items = await cliente.lrange(
+                clave_historial(nombre_usuario), total - hasta, total - 1 - cubiertos
+            )
+            nuevos = decodificar(items)
+            texto_mensajes = "\n".join(
+                f"{'Asistente' if isinstance(m, AIMessage) else nombre_usuario}: {m.content}"
+                for m in nuevos
+            )
+            resultado = await self.cadena_resumen.ainvoke({
+                "usuario": nombre_usuario,
+                "resumen": resumen or "(sin resumen previo)",
+                "mensajes": texto_mensajes,
+            })
+            nuevo_resumen = getattr(resultado, "content", resultado)
+
+            # Escritura condicional: si otro proceso avanzó el resumen mientras
+            # esperábamos al LLM (lock expirado), no se pisa su resultado. Es un
+            # script y no WATCH, porque cada escritura del historial renueva el
+            # TTL del resumen y eso invalidaría el WATCH sin que nada cambiara
+            guardado = await cliente.eval(
+                _GUARDAR_RESUMEN, 1, clave_resumen(nombre_usuario),
+                cubiertos, str(nuevo_resumen).strip(), hasta, self.historiales.ttl_segundos or 0,
+            )
+            if not guardado:
+                return 0
+            self.compactaciones += 1
+            self.mensajes_resumidos += len(nuevos)
+            print(f"🗜️ Historial de {nombre_usuario} compactado: {len(nuevos)} mensajes resumidos")
+            return len(nuevos)
+        except Exception as e:
+            print(f"❌ Error al compactar historial de {nombre_usuario}: {e}")
+            return 0
+        finally:
+            await cliente.eval(_LIBERAR_LOCK, 1, clave_lock, token)
+
+    async def aesperar(self):
+        """Espera a que terminen las compactaciones en curso"""
+        if self._tareas:
+            await asyncio.gather(*list(self._tareas), return_exceptions=True)
+
+    def estadisticas(self) -> dict:
+        return {
+            "compactaciones": self.compactaciones,
+            "mensajes_resumidos": self.mensajes_resumidos,
+            "en_curso": len(self._en_curso),
+        }
@@ -3,7 +3,6 @@
 Script para ejecutar la aplicación Streamlit
 """
 
-import os
 import subprocess
 import sys
 
@@ -19,7 +18,7 @@ def main():
     try:
         subprocess.run([
             sys.executable, "-m", "streamlit", "run", 
-            "app_streamlit.py", 
+            "streamlit_app.py", 
             "--server.headless", "false",
             "--server.runOnSave", "true",
             "--theme.base", "light"
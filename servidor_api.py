@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+Servidor HTTP/WebSocket asíncrono (sin interfaz) para ChatMultiUsuario
+
+La app Streamlit re-ejecuta el script en cada interacción y
+`chat_interactivo` bloquea en `input()`; ninguno sirve para dispositivos de
+voz u otros servicios que llaman con volumen. Este servidor (aiohttp) corre
+en el event loop propio del chat, así que cada handler espera directamente
+la API async (`aprocesar_mensaje`, `aprocesar_mensaje_stream`...) sin
+saltar de hilo.
+
+Endpoints (JSON):
+- POST /v1/chat                    {"mensaje", "sesion"?, "usuario"?} → RespuestaChat + "sesion"
+- POST /v1/chat/stream             lo mismo en Server-Sent Events (`fragmento`, `respuesta`, `error`)
+- GET  /v1/ws                      WebSocket, una sesión por conexión: cada {"mensaje", "usuario"?}
+                                   recibe {"tipo": "fragmento"}... y {"tipo": "respuesta"}
+- GET  /v1/usuarios                ?offset=&limite=&orden=reciente|antiguo
+- GET  /v1/usuarios/{nombre}/historial   ?cursor=&tamano=  o  ?buscar=texto
+- DELETE /v1/sesiones/{sesion}
+- GET  /salud, GET /metricas (Prometheus)
+
+Por HTTP el cliente reenvía el id de `sesion` de la primera respuesta (si no
+lo manda se crea uno); por WebSocket la sesión dura lo que la conexión.
+`usuario` fija el usuario de la sesión antes del turno (p. ej. un
+dispositivo que ya reconoce la voz), lo que permite clientes sin estado.
+Los nombres de usuario (cuerpo, WebSocket y ruta) solo admiten letras,
+dígitos, espacio, ".", "-" y "_" (hasta 64 caracteres); ":" se rechaza con
+400 porque separa las claves Redis derivadas del nombre.
+
+Cada turno tiene un plazo (`plazo_turno`, 504 al vencer). Si la pasarela
+del LLM está saturada, responde 503 con Retry-After. Con SIGINT/SIGTERM
+deja de aceptar conexiones y cierra los WebSocket inactivos (los ocupados,
+al terminar su turno). Luego espera los turnos en curso hasta
+`plazo_cierre` y las tareas en segundo plano del chat, y cierra Redis.
+
+Uso:
+    python servidor_api.py [--host 0.0.0.0] [--puerto 8080] [--llm-falso]
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import signal
+import sys
+import threading
+import time
+import uuid
+from typing import Optional
+
+from aiohttp import WSCloseCode, WSMsgType, web
+from dotenv import load_dotenv
+
+from bloqueo_usuarios import BloqueoSaturado
+from chat_multi_usuario import ChatMultiUsuario, RespuestaChat, SesionChat
+from historial_redis import MAX_LARGO_NOMBRE, BloqueoPerdido, nombre_usuario_valido
+from pasarela_llm import LLMSaturado
+
+ORDENES_USUARIOS = ("reciente", "antiguo")
+
+
+class SolicitudInvalida(ValueError):
+    """Cuerpo o parámetros inválidos (400)"""
+
+
+def validar_usuario(nombre, campo: str = "usuario") -> str:
+    """Nombre de usuario sin espacios sobrantes; SolicitudInvalida si no es apto para las claves"""
+    if not isinstance(nombre, str) or not nombre_usuario_valido(nombre.strip()):
+        raise SolicitudInvalida(
+            f"'{campo}' debe tener hasta {MAX_LARGO_NOMBRE} caracteres: letras, dígitos, espacio, '.', '-' o '_'"
+        )
+    return nombre.strip()
+
+
+def describir_error(error: BaseException) -> tuple:
+    """(estado HTTP, cuerpo JSON, cabeceras) para un error de una solicitud"""
+    if isinstance(error, SolicitudInvalida):
+        return 400, {"error": str(error)}, {}
+    if isinstance(error, LLMSaturado):
+        cabeceras = {"Retry-After": str(max(1, math.ceil(error.reintentar_en or 1)))}
+        cuerpo = {"error": str(error), "motivo": error.motivo, "reintentar_en": error.reintentar_en}
+        return 503, cuerpo, cabeceras
+    if isinstance(error, BloqueoSaturado):
+        return 503, {"error": str(error), "motivo": "bloqueo"}, {"Retry-After": "1"}
+    if isinstance(error, BloqueoPerdido):
+        return 409, {"error": str(error)}, {}
+    if isinstance(error, TimeoutError):
+        return 504, {"error": "El turno superó el plazo"}, {}
+    return 500, {"error": "Error interno"}, {}
+
+
+def mensaje_a_dict(mensaje) -> dict:
+    return {"tipo": mensaje.type, "contenido": mensaje.content}
+
+
+class ServidorChat:
+    """Aplicación aiohttp sobre un `ChatMultiUsuario`, servida en el event loop del chat"""
+
+    def __init__(
+        self,
+        chat: ChatMultiUsuario,
+        plazo_turno: float = 60.0,
+        plazo_cierre: float = 30.0,
+        max_caracteres: int = 4000,
+    ):
+        self.chat = chat
+        self.plazo_turno = plazo_turno
+        self.plazo_cierre = plazo_cierre
+        self.max_caracteres = max_caracteres
+        self.cerrando = False
+        self.en_curso = 0
+        self.respuestas = {}  # estado HTTP -> conteo
+        self._websockets = {}  # WebSocketResponse -> hay un turno en curso
+        self._runner: Optional[web.AppRunner] = None
+
+    def crear_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.add_routes([
+            web.post("/v1/chat", self._chat),
+            web.post("/v1/chat/stream", self._chat_stream),
+            web.get("/v1/ws", self._websocket),
+            web.get("/v1/usuarios", self._usuarios),
+            web.get("/v1/usuarios/{nombre}/historial", self._historial),
+            web.delete("/v1/sesiones/{sesion}", self._cerrar_sesion),
+            web.get("/salud", self._salud),
+            web.get("/metricas", self._metricas),
+        ])
+        app.on_shutdown.append(self._cerrar_websockets)
+        app.on_cleanup.append(self._cerrar_chat)
+        return app
+
+    # ----------------------------------------
+    # Arranque y cierre
+    # ----------------------------------------
+
+    async def aarrancar(self, host: str = "0.0.0.0", puerto: int = 8080) -> int:
+        """Empieza a aceptar conexiones; devuelve el puerto (útil con `puerto=0`)"""
+        self._runner = web.AppRunner(self.crear_app(), shutdown_timeout=self.plazo_cierre, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, puerto).start()
+        return self._runner.addresses[0][1]
+
+    async def adetener(self):
+        """Cierre ordenado: sin conexiones nuevas, espera los turnos en curso y cierra el chat"""
+        self.cerrando = True
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def arrancar(self, host: str = "0.0.0.0", puerto: int = 8080) -> int:
+        return self.chat._ejecutar(self.aarrancar(host, puerto))
+
+    def detener(self):
+        self.chat._ejecutar(self.adetener())
+
+    def servir(self, host: str = "0.0.0.0", puerto: int = 8080):
+        """Atiende hasta recibir SIGINT/SIGTERM y entonces cierra ordenadamente"""
+        senal_recibida = threading.Event()
+        for senal in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(senal, lambda *_: senal_recibida.set())
+        puerto = self.arrancar(host, puerto)
+        print(f"🚀 Servidor de chat en http://{host}:{puerto} (WebSocket en /v1/ws)")
+        senal_recibida.wait()
+        print(f"🛑 Cerrando: sin conexiones nuevas, {self.en_curso} solicitudes en curso")
+        self.detener()
+        self.chat.cerrar()
+        print("👋 Servidor detenido")
+
+    async def _cerrar_websockets(self, app: web.Application):
+        for ws, ocupado in list(self._websockets.items()):
+            if not ocupado:
+                await ws.close(code=WSCloseCode.GOING_AWAY, message=b"Servidor cerrando")
+
+    async def _cerrar_chat(self, app: web.Application):
+        await self.chat.acerrar()
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        """Rechaza solicitudes nuevas al cerrar y traduce errores a JSON"""
+        if self.cerrando and request.path != "/salud":
+            return self._contar(web.json_response(
+                {"error": "El servidor se está cerrando"}, status=503,
+                headers={"Retry-After": "1", "Connection": "close"},
+            ))
+        self.en_curso += 1
+        try:
+            return self._contar(await handler(request))
+        except web.HTTPException as e:
+            self._contar(e)
+            raise
+        except Exception as e:
+            estado, cuerpo, cabeceras = describir_error(e)
+            if estado == 500:
+                print(f"❌ Error en {request.method} {request.path}: {e}")
+            return self._contar(web.json_response(cuerpo, status=estado, headers=cabeceras))
+        finally:
+            self.en_curso -= 1
+
+    def _contar(self, respuesta):
+        self.respuestas[respuesta.status] = self.respuestas.get(respuesta.status, 0) + 1
+        return respuesta
+
+    # ----------------------------------------
+    # Turnos de chat
+    # ----------------------------------------
+
+    async def _leer_json(self, request: web.Request) -> dict:
+        try:
+            datos = await request.json()
+        except ValueError:
+            raise SolicitudInvalida("El cuerpo debe ser JSON")
+        if not isinstance(datos, dict):
+            raise SolicitudInvalida("El cuerpo debe ser un objeto JSON")
+        return datos
+
+    def _turno(self, datos: dict, sesion: Optional[SesionChat] = None) -> tuple:
+        """Valida un turno y devuelve (mensaje, sesión), creando la sesión si hace falta"""
+        mensaje = datos.get("mensaje")
+        if not isinstance(mensaje, str) or not mensaje.strip():
+            raise SolicitudInvalida("'mensaje' debe ser un texto no vacío")
+        if len(mensaje) > self.max_caracteres:
+            raise SolicitudInvalida(f"'mensaje' supera los {self.max_caracteres} caracteres")
+        if sesion is None:
+            sesion = self.chat.obtener_sesion(str(datos.get("sesion") or uuid.uuid4().hex))
+        usuario = datos.get("usuario")
+        if usuario:
+            sesion.usuario_actual = validar_usuario(usuario)
+        return mensaje.strip(), sesion
+
+    async def _con_plazo(self, generador):
+        """Partes de un generador async con un plazo total de `plazo_turno`"""
+        limite = time.monotonic() + self.plazo_turno
+        try:
+            while True:
+                try:
+                    parte = await asyncio.wait_for(generador.__anext__(), max(limite - time.monotonic(), 0))
+                except StopAsyncIteration:
+                    return
+                yield parte
+        finally:
+            await generador.aclose()
+
+    def _respuesta_a_dict(self, respuesta: RespuestaChat, sesion: SesionChat) -> dict:
+        return {**respuesta.model_dump(), "sesion": sesion.id_sesion}
+
+    async def _chat(self, request: web.Request) -> web.Response:
+        mensaje, sesion = self._turno(await self._leer_json(request))
+        respuesta = await asyncio.wait_for(self.chat.aprocesar_mensaje(mensaje, sesion), self.plazo_turno)
+        return web.json_response(self._respuesta_a_dict(respuesta, sesion))
+
+    async def _chat_stream(self, request: web.Request) -> web.StreamResponse:
+        mensaje, sesion = self._turno(await self._leer_json(request))
+        partes = self._con_plazo(self.chat.aprocesar_mensaje_stream(mensaje, sesion))
+        try:
+            # La primera parte llega tras la detección: sus errores (503, 504...)
+            # todavía se responden con el estado HTTP correspondiente
+            primera = await partes.__anext__()
+        except StopAsyncIteration:
+            raise RuntimeError("El turno terminó sin respuesta")
+
+        respuesta = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        })
+        await respuesta.prepare(request)
+        try:
+            parte = primera
+            while True:
+                if isinstance(parte, RespuestaChat):
+                    await self._evento(respuesta, "respuesta", self._respuesta_a_dict(parte, sesion))
+                else:
+                    await self._evento(respuesta, "fragmento", {"texto": parte})
+                try:
+                    parte = await partes.__anext__()
+                except StopAsyncIteration:
+                    break
+        except (ConnectionResetError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            estado, cuerpo, _ = describir_error(e)
+            await self._evento(respuesta, "error", {"estado": estado, **cuerpo})
+        finally:
+            await partes.aclose()
+        await respuesta.write_eof()
+        return respuesta
+
+    @staticmethod
+    async def _evento(respuesta: web.StreamResponse, evento: str, datos: dict):
+        await respuesta.write(f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+    async def _websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        sesion = self.chat.obtener_sesion(f"ws-{uuid.uuid4().hex}")
+        self._websockets[ws] = False
+        try:
+            await self._atender_websocket(ws, sesion)
+        except ConnectionResetError:
+            pass
+        finally:
+            self._websockets.pop(ws, None)
+            self.chat.cerrar_sesion(sesion.id_sesion)
+        return ws
+
+    async def _atender_websocket(self, ws: web.WebSocketResponse, sesion: SesionChat):
+        """Turnos de una conexión, uno tras otro, con la sesión de la conexión"""
+        async for mensaje_ws in ws:
+            if mensaje_ws.type != WSMsgType.TEXT:
+                continue
+            self._websockets[ws] = True
+            try:
+                try:
+                    datos = json.loads(mensaje_ws.data)
+                except ValueError:
+                    raise SolicitudInvalida("Cada mensaje debe ser un objeto JSON")
+                if not isinstance(datos, dict):
+                    raise SolicitudInvalida("Cada mensaje debe ser un objeto JSON")
+                mensaje, _ = self._turno(datos, sesion)
+                async for parte in self._con_plazo(self.chat.aprocesar_mensaje_stream(mensaje, sesion)):
+                    if isinstance(parte, RespuestaChat):
+                        await ws.send_json({"tipo": "respuesta", **self._respuesta_a_dict(parte, sesion)})
+                    else:
+                        await ws.send_json({"tipo": "fragmento", "texto": parte})
+            except (ConnectionResetError, asyncio.CancelledError):
+                raise
+            except Exception as e:
+                if ws.closed:
+                    return
+                estado, cuerpo, _ = describir_error(e)
+                if estado == 500:
+                    print(f"❌ Error en turno por WebSocket: {e}")
+                await ws.send_json({"tipo": "error", "estado": estado, **cuerpo})
+            finally:
+                self._websockets[ws] = False
+            if self.cerrando:
+                await ws.close(code=WSCloseCode.GOING_AWAY, message=b"Servidor cerrando")
+
+    # ----------------------------------------
+    # Usuarios, historial y sesiones
+    # ----------------------------------------
+
+    @staticmethod
+    def _entero(request: web.Request, nombre: str, defecto: Optional[int], minimo: int = 0, maximo: int = 1000):
+        valor = request.query.get(nombre)
+        if valor in (None, ""):
+            return defecto
+        try:
+            numero = int(valor)
+        except ValueError:
+            raise SolicitudInvalida(f"'{nombre}' debe ser un entero")
+        if not minimo <= numero <= maximo:
+            raise SolicitudInvalida(f"'{nombre}' debe estar entre {minimo} y {maximo}")
+        return numero
+
+    async def _usuarios(self, request: web.Request) -> web.Response:
+        orden = request.query.get("orden", "reciente")
+        if orden not in ORDENES_USUARIOS:
+            raise SolicitudInvalida(f"'orden' debe ser uno de {', '.join(ORDENES_USUARIOS)}")
+        offset = self._entero(request, "offset", 0, maximo=10**9)
+        limite = self._entero(request, "limite", 50, minimo=1)
+        usuarios = await self.chat.alistar_usuarios_detalle(offset, limite, orden)
+        return web.json_response({"usuarios": usuarios, "offset": offset, "limite": limite})
+
+    async def _historial(self, request: web.Request) -> web.Response:
+        nombre = validar_usuario(request.match_info["nombre"], "nombre")
+        cursor = self._entero(request, "cursor", None, maximo=10**9)
+        tamano = self._entero(request, "tamano", 20, minimo=1, maximo=200)
+        buscar = request.query.get("buscar")
+        if buscar:
+            encontrados = await self.chat.abuscar_en_historial(nombre, buscar, tamano, cursor)
+            resultados = [
+                {"posicion": r["posicion"], **mensaje_a_dict(r["mensaje"])} for r in encontrados["resultados"]
+            ]
+            return web.json_response({**encontrados, "resultados": resultados})
+        pagina = await self.chat.aobtener_historial_pagina(nombre, cursor, tamano)
+        return web.json_response({**pagina, "mensajes": [mensaje_a_dict(m) for m in pagina["mensajes"]]})
+
+    async def _cerrar_sesion(self, request: web.Request) -> web.Response:
+        self.chat.cerrar_sesion(request.match_info["sesion"])
+        return web.Response(status=204)
+
+    # ----------------------------------------
+    # Salud y métricas
+    # ----------------------------------------
+
+    async def _salud(self, request: web.Request) -> web.Response:
+        """503 al cerrar, para que el balanceador deje de enviar tráfico"""
+        return web.json_response(
+            {
+                "estado": "cerrando" if self.cerrando else "ok",
+                "en_curso": self.en_curso,
+                "websockets": len(self._websockets),
+                "circuito_llm": self.chat.estadisticas_pasarela()["circuito"],
+            },
+            status=503 if self.cerrando else 200,
+        )
+
+    async def _metricas(self, request: web.Request) -> web.Response:
+        lineas = [
+            "# HELP chat_servidor_respuestas_total Respuestas HTTP por estado",
+            "# TYPE chat_servidor_respuestas_total counter",
+            *(f'chat_servidor_respuestas_total{{estado="{e}"}} {n}' for e, n in sorted(self.respuestas.items())),
+            "# HELP chat_servidor_en_curso Solicitudes en curso",
+            "# TYPE chat_servidor_en_curso gauge",
+            f"chat_servidor_en_curso {self.en_curso}",
+            "# HELP chat_servidor_websockets Conexiones WebSocket abiertas",
+            "# TYPE chat_servidor_websockets gauge",
+            f"chat_servidor_websockets {len(self._websockets)}",
+        ]
+        texto = self.chat.trazador.exportar_prometheus() + "\n".join(lineas) + "\n"
+        return web.Response(text=texto, content_type="text/plain", charset="utf-8")
+
+    def estadisticas(self) -> dict:
+        return {
+            "en_curso": self.en_curso,
+            "websockets": len(self._websockets),
+            "respuestas": dict(self.respuestas),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--puerto", type=int, default=int(os.getenv("PUERTO", "8080")))
+    parser.add_argument("--plazo-turno", type=float, default=60.0, help="segundos máximos por turno")
+    parser.add_argument("--plazo-cierre", type=float, default=30.0, help="espera máxima de turnos al cerrar")
+    parser.add_argument("--llm-falso", action="store_true", help="usa LLMFalso (sin OpenAI) para demos y pruebas")
+    args = parser.parse_args()
+
+    load_dotenv()
+    redis_url = os.getenv("REDIS_URL")
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    if not redis_url:
+        print("❌ Error: REDIS_URL no encontrada en el archivo .env")
+        sys.exit(1)
+    if not openai_api_key and not args.llm_falso:
+        print("❌ Error: OPENAI_API_KEY no encontrada en el archivo .env (o usa --llm-falso)")
+        sys.exit(1)
+
+    fabrica_modelos = None
+    if args.llm_falso:
+        from modelos import fabrica_falsa
+
+        fabrica_modelos = fabrica_falsa()
+    bloqueo = os.getenv("BLOQUEO_POR_USUARIO", "").lower() in ("1", "true", "si", "sí")
+    chat = ChatMultiUsuario(
+        redis_url,
+        openai_api_key,
+        fabrica_modelos=fabrica_modelos,
+        inicializacion_perezosa=True,
+        bloqueo_por_usuario=bloqueo,
+    )
+    chat.precalentar()
+    ServidorChat(chat, plazo_turno=args.plazo_turno, plazo_cierre=args.plazo_cierre).servir(args.host, args.puerto)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,87 +2,95 @@
 """
 Archivo principal para Streamlit Cloud
 Este archivo debe llamarse 'streamlit_app.py' para que Streamlit Cloud lo reconozca automáticamente
+
+Streamlit vuelve a ejecutar este script en cada interacción, así que aquí
+solo se hace lo imprescindible. El diagnóstico del entorno (versión de
+Python, dependencias, archivos, tiempo de cada ejecución) se muestra solo en
+modo depuración: secreto o variable de entorno `DEBUG=1`, o `?debug=1` en la URL.
 """
 
-import streamlit as st
-import sys
 import os
+import sys
+import time
 import traceback
+from importlib.util import find_spec
 
-# Mostrar información de debug inicial
-st.write("🔄 **Iniciando Chat Multi-Usuario...**")
+import streamlit as st
 
-try:
-    # Mostrar información del entorno
-    st.write("📍 **Información del sistema:**")
-    st.write(f"- Directorio actual: `{os.getcwd()}`")
-    st.write(f"- Archivos en directorio: `{os.listdir('.')}`")
-    st.write(f"- Python version: `{sys.version}`")
-    
-    # Verificar dependencias críticas
-    st.write("📦 **Verificando dependencias...**")
-    
-    dependencies = ['streamlit', 'redis', 'langchain', 'openai', 'dotenv']
-    for dep in dependencies:
-        try:
-            __import__(dep.replace('-', '_'))
-            st.write(f"✅ {dep}")
-        except ImportError:
-            st.write(f"❌ {dep} - NO ENCONTRADO")
-    
-    # Verificar variables de entorno/secretos
-    st.write("🔐 **Verificando configuración...**")
-    
-    redis_url = None
-    openai_key = None
-    
-    # Intentar cargar desde Streamlit secrets
+DEPENDENCIAS = ['streamlit', 'redis', 'langchain', 'openai', 'dotenv']
+
+
+def leer_configuracion(nombre: str):
+    """Secreto de Streamlit Cloud o, si no está, variable de entorno"""
     try:
-        redis_url = st.secrets.get("REDIS_URL")
-        openai_key = st.secrets.get("OPENAI_API_KEY")
-        if redis_url and openai_key:
-            st.write("✅ Secretos de Streamlit Cloud configurados")
-        else:
-            st.write("⚠️ Secretos de Streamlit Cloud incompletos")
-    except Exception as e:
-        st.write(f"❌ Error cargando secretos: {e}")
-    
-    # Fallback a variables de entorno
-    if not redis_url:
-        redis_url = os.getenv("REDIS_URL")
-    if not openai_key:
-        openai_key = os.getenv("OPENAI_API_KEY")
-    
-    if not redis_url or not openai_key:
-        st.error("🚨 **ERROR: Configuración faltante**")
-        st.markdown("""
-        **Para Streamlit Cloud:**
-        1. Ve a tu app dashboard
-        2. Click en "Settings" → "Secrets"
-        3. Agrega:
-        ```toml
-        REDIS_URL = "tu_redis_url_aqui"
-        OPENAI_API_KEY = "tu_openai_api_key_aqui"
-        ```
-        
-        **Servicios gratuitos recomendados:**
-        - Redis: [Redis Cloud](https://redis.com/try-free/) o [Upstash](https://upstash.com/)
-        - OpenAI: [Platform OpenAI](https://platform.openai.com/api-keys)
-        """)
+        valor = st.secrets.get(nombre)
+    except Exception:
+        valor = None
+    return valor or os.getenv(nombre)
+
+
+def modo_debug() -> bool:
+    if st.query_params.get("debug") == "1":
+        return True
+    return str(leer_configuracion("DEBUG") or "").lower() in ("1", "true", "si", "sí")
+
+
+def mostrar_configuracion_faltante():
+    st.error("🚨 **ERROR: Configuración faltante**")
+    st.markdown("""
+    **Para Streamlit Cloud:**
+    1. Ve a tu app dashboard
+    2. Click en "Settings" → "Secrets"
+    3. Agrega:
+    ```toml
+    REDIS_URL = "tu_redis_url_aqui"
+    OPENAI_API_KEY = "tu_openai_api_key_aqui"
+    ```
+
+    **Servicios gratuitos recomendados:**
+    - Redis: [Redis Cloud](https://redis.com/try-free/) o [Upstash](https://upstash.com/)
+    - OpenAI: [Platform OpenAI](https://platform.openai.com/api-keys)
+    """)
+
+
+def mostrar_diagnostico(segundos_ejecucion: float):
+    """Información del entorno y tiempos de arranque (solo en modo depuración)"""
+    with st.expander("🐞 Diagnóstico del entorno", expanded=False):
+        st.write("📍 **Información del sistema:**")
+        st.write(f"- Directorio actual: `{os.getcwd()}`")
+        st.write(f"- Archivos en directorio: `{os.listdir('.')}`")
+        st.write(f"- Python version: `{sys.version}`")
+
+        # find_spec comprueba que el paquete existe sin importarlo
+        st.write("📦 **Dependencias:**")
+        for dep in DEPENDENCIAS:
+            st.write(f"{'✅' if find_spec(dep) else '❌'} {dep}")
+
+        st.write("⏱️ **Tiempos:**")
+        st.write(f"- Esta ejecución del script: `{segundos_ejecucion * 1000:.0f} ms`")
+        chat_system = st.session_state.get("chat_system")
+        if chat_system is not None:
+            segundos = getattr(chat_system, "segundos_construccion_modelos", None)
+            estado = f"`{segundos:.2f} s`" if segundos is not None else "pendiente"
+            st.write(f"- Construcción de modelos y cadenas: {estado}")
+
+
+inicio = time.perf_counter()
+debug = modo_debug()
+
+try:
+    if not leer_configuracion("REDIS_URL") or not leer_configuracion("OPENAI_API_KEY"):
+        mostrar_configuracion_faltante()
         st.stop()
-    
-    st.write("✅ Configuración completa")
-    st.write("🚀 **Cargando aplicación principal...**")
-    
-    # Importar y ejecutar la aplicación principal
+
+    # Importar y ejecutar la aplicación principal (el import solo cuesta la primera vez)
     from app_streamlit import main
-    
-    # Limpiar mensajes de debug antes de mostrar la app
-    st.empty()
-    
-    # Ejecutar la aplicación principal
+
     main()
-    
+
+    if debug:
+        mostrar_diagnostico(time.perf_counter() - inicio)
+
 except ImportError as e:
     st.error(f"❌ **Error de importación**: {e}")
     st.markdown("""
@@ -92,14 +100,12 @@ except ImportError as e:
     3. Verificar que todos los archivos están en el repositorio
     """)
     st.code(f"Traceback:\n{traceback.format_exc()}")
-    
+    mostrar_diagnostico(time.perf_counter() - inicio)
+
 except Exception as e:
     st.error(f"❌ **Error de aplicación**: {e}")
     st.markdown("**Información detallada:**")
     st.code(f"Traceback:\n{traceback.format_exc()}")
-    
-    st.markdown("**Debug adicional:**")
     st.write(f"- Tipo de error: `{type(e).__name__}`")
     st.write(f"- Mensaje: `{str(e)}`")
-    st.write(f"- Directorio: `{os.getcwd()}`")
-    st.write(f"- Archivos: `{os.listdir('.')}`") 
\ No newline at end of file
+    mostrar_diagnostico(time.perf_counter() - inicio)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Trazas por turno y métricas estilo Prometheus
+
+Cada turno de `ChatMultiUsuario` produce una `TrazaTurno` con el tiempo de
+cada etapa (detectar, bloqueo, historial, prompt, generar, persistir), los tokens
+reportados por el modelo (incluidos los de entrada servidos desde la caché de
+prompts del proveedor, por llamada), el largo del historial enviado y los aciertos de
+caché. La traza activa viaja en una `ContextVar`, de modo que cualquier
+módulo puede medir una etapa con `etapa("...")` o anotar un dato con
+`anotar(...)` sin recibirla como argumento; fuera de un turno no hacen nada.
+
+Las trazas terminadas se entregan a los hooks registrados, se guardan las
+últimas en memoria (panel de depuración) y se agregan en histogramas que
+`Trazador.exportar_prometheus()` devuelve en formato de texto de Prometheus.
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackHandler
+
+ETAPAS = ("detectar", "bloqueo", "historial", "prompt", "generar", "persistir")
+
+# Límites (segundos) de los buckets de los histogramas de latencia
+BUCKETS_SEGUNDOS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_traza_actual: ContextVar[Optional["TrazaTurno"]] = ContextVar("traza_actual", default=None)
+
+
+class TrazaTurno:
+    """Tiempos por etapa, tokens y aciertos de caché de un turno"""
+
+    def __init__(self, id_sesion: Optional[str] = None):
+        self.id_sesion = id_sesion
+        self.usuario: Optional[str] = None
+        self.inicio = time.time()
+        self.inicio_perf = time.perf_counter()
+        self.segundos_total = 0.0
+        # Etapas que se repiten (o se solapan, como en el modo especulativo) se acumulan
+        self.etapas = {}
+        self.tokens_entrada = 0
+        self.tokens_salida = 0
+        self.tokens_entrada_cache = 0
+        # Uso de cada llamada al LLM: {"entrada", "en_cache", "sin_cache", "salida"}
+        self.uso_llamadas: List[dict] = []
+        self.llamadas_llm = 0
+        self.mensajes_historial = 0
+        self.tokens_prompt = 0
+        self.cache = {}
+        self.error: Optional[str] = None
+
+    def sumar_etapa(self, nombre: str, segundos: float):
+        self.etapas[nombre] = self.etapas.get(nombre, 0.0) + segundos
+
+    def como_dict(self) -> dict:
+        return {
+            "id_sesion": self.id_sesion,
+            "usuario": self.usuario,
+            "inicio": self.inicio,
+            "ms_total": round(self.segundos_total * 1000, 3),
+            "ms_por_etapa": {e: round(s * 1000, 3) for e, s in self.etapas.items()},
+            "tokens_entrada": self.tokens_entrada,
+            "tokens_salida": self.tokens_salida,
+            "tokens_entrada_cache": self.tokens_entrada_cache,
+            "uso_llamadas": [dict(u) for u in self.uso_llamadas],
+            "llamadas_llm": self.llamadas_llm,
+            "mensajes_historial": self.mensajes_historial,
+            "tokens_prompt": self.tokens_prompt,
+            "cache": dict(self.cache),
+            "error": self.error,
+        }
+
+
+def traza_actual() -> Optional[TrazaTurno]:
+    return _traza_actual.get()
+
+
+def activar(traza: Optional[TrazaTurno]):
+    """Vuelve a fijar la traza en el contexto actual (p. ej. al reanudar un generador)"""
+    _traza_actual.set(traza)
+
+
+@contextmanager
+def etapa(nombre: str):
+    """Mide una etapa del turno en curso (no hace nada fuera de un turno)"""
+    traza = _traza_actual.get()
+    if traza is None:
+        yield
+        return
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        traza.sumar_etapa(nombre, time.perf_counter() - inicio)
+
+
+def anotar(campo: str, valor):
+    """Registra un dato del turno en curso: atributo de la traza o resultado de caché"""
+    traza = _traza_actual.get()
+    if traza is None:
+        return
+    if campo.startswith("cache_"):
+        traza.cache[campo[len("cache_"):]] = valor
+    else:
+        setattr(traza, campo, valor)
+
+
+class ManejadorTokens(AsyncCallbackHandler):
+    """Callback de LangChain que suma el uso de tokens de cada llamada al turno en curso"""
+
+    async def on_llm_end(self, response, **kwargs):
+        traza = _traza_actual.get()
+        if traza is None:
+            return
+        traza.llamadas_llm += 1
+        for generaciones in response.generations:
+            for generacion in generaciones:
+                uso = getattr(getattr(generacion, "message", None), "usage_metadata", None)
+                if uso:
+                    entrada = uso.get("input_tokens", 0)
+                    en_cache = (uso.get("input_token_details") or {}).get("cache_read", 0) or 0
+                    traza.tokens_entrada += entrada
+                    traza.tokens_salida += uso.get("output_tokens", 0)
+                    traza.tokens_entrada_cache += en_cache
+                    traza.uso_llamadas.append({
+                        "entrada": entrada,
+                        "en_cache": en_cache,
+                        "sin_cache": entrada - en_cache,
+                        "salida": uso.get("output_tokens", 0),
+                    })
+
+
+class Trazador:
+    """Registra trazas de turnos, notifica hooks y agrega métricas"""
+
+    def __init__(self, max_trazas: int = 200):
+        self.manejador_tokens = ManejadorTokens()
+        self._recientes = deque(maxlen=max_trazas)
+        self._hooks: List[Callable[[TrazaTurno], None]] = []
+        self._lock = threading.Lock()
+        # Agregados para Prometheus
+        self._turnos = 0
+        self._errores = 0
+        self._histogramas = {}  # etapa -> [conteos por bucket, suma, total]
+        self._tokens = {"entrada": 0, "salida": 0, "entrada_cache": 0}
+        self._cache = {}  # (cache, resultado) -> conteo
+        self._servidor = None
+
+    def agregar_hook(self, hook: Callable[[TrazaTurno], None]):
+        """Registra una función que recibe cada `TrazaTurno` al terminar el turno"""
+        self._hooks.append(hook)
+
+    def iniciar(self, id_sesion: Optional[str] = None) -> TrazaTurno:
+        """Crea la traza de un turno y la activa en el contexto actual"""
+        traza = TrazaTurno(id_sesion)
+        _traza_actual.set(traza)
+        return traza
+
+    def terminar(self, traza: TrazaTurno):
+        """Cierra la traza (duración total) y la registra"""
+        traza.segundos_total = time.perf_counter() - traza.inicio_perf
+        self.registrar(traza)
+
+    @contextmanager
+    def turno(self, id_sesion: Optional[str] = None):
+        """Abre la traza de un turno y la registra al salir"""
+        anterior = _traza_actual.get()
+        traza = self.iniciar(id_sesion)
+        try:
+            yield traza
+        except BaseException as e:
+            traza.error = type(e).__name__
+            raise
+        finally:
+            _traza_actual.set(anterior)
+            self.terminar(traza)
+
+    def registrar(self, traza: TrazaTurno):
+        with self._lock:
+            self._recientes.append(traza)
+            self._turnos += 1
+            self._errores += 1 if traza.error else 0
+            for nombre, segundos in list(traza.etapas.items()) + [("total", traza.segundos_total)]:
+                conteos, suma, total = self._histogramas.get(nombre, ([0] * len(BUCKETS_SEGUNDOS), 0.0, 0))
+                conteos = [c + (segundos <= b) for c, b in zip(conteos, BUCKETS_SEGUNDOS)]
+                self._histogramas[nombre] = (conteos, suma + segundos, total + 1)
+            self._tokens["entrada"] += traza.tokens_entrada
+            self._tokens["salida"] += traza.tokens_salida
+            self._tokens["entrada_cache"] += traza.tokens_entrada_cache
+            for cache, resultado in traza.cache.items():
+                clave = (cache, resultado)
+                self._cache[clave] = self._cache.get(clave, 0) + 1
+
+        for hook in self._hooks:
+            try:
+                hook(traza)
+            except Exception as e:
+                print(f"❌ Error en hook de trazas: {e}")
+
+    def tokens(self) -> dict:
+        """Tokens acumulados de todos los turnos: entrada, salida y entrada en caché"""
+        with self._lock:
+            return dict(self._tokens)
+
+    def ultimas(self, cantidad: int = 20, id_sesion: Optional[str] = None) -> List[dict]:
+        """Últimas trazas (más nuevas primero), opcionalmente de una sola sesión"""
+        with self._lock:
+            trazas = list(self._recientes)
+        if id_sesion is not None:
+            trazas = [t for t in trazas if t.id_sesion == id_sesion]
+        return [t.como_dict() for t in reversed(trazas[-cantidad:])]
+
+    # ----------------------------------------
+    # Exportación Prometheus
+    # ----------------------------------------
+
+    def exportar_prometheus(self) -> str:
+        """Métricas agregadas en el formato de texto de Prometheus"""
+        with self._lock:
+            lineas = [
+                "# HELP chat_turnos_total Turnos procesados",
+                "# TYPE chat_turnos_total counter",
+                f"chat_turnos_total {self._turnos}",
+                "# HELP chat_turnos_error_total Turnos terminados con error",
+                "# TYPE chat_turnos_error_total counter",
+                f"chat_turnos_error_total {self._errores}",
+                "# HELP chat_etapa_segundos Duración de cada etapa del turno",
+                "# TYPE chat_etapa_segundos histogram",
+            ]
+            for nombre, (conteos, suma, total) in sorted(self._histogramas.items()):
+                for limite, conteo in zip(BUCKETS_SEGUNDOS, conteos):
+                    lineas.append(f'chat_etapa_segundos_bucket{{etapa="{nombre}",le="{limite}"}} {conteo}')
+                lineas.append(f'chat_etapa_segundos_bucket{{etapa="{nombre}",le="+Inf"}} {total}')
+                lineas.append(f'chat_etapa_segundos_sum{{etapa="{nombre}"}} {suma}')
+                lineas.append(f'chat_etapa_segundos_count{{etapa="{nombre}"}} {total}')
+            lineas += [
+                "# HELP chat_tokens_total Tokens reportados por los modelos (entrada_cache: parte de la entrada leída de la caché de prompts)",
+                "# TYPE chat_tokens_total counter",
+            ]
+            for tipo, valor in self._tokens.items():
+                lineas.append(f'chat_tokens_total{{tipo="{tipo}"}} {valor}')
+            lineas += [
+                "# HELP chat_cache_total Consultas a cachés por resultado",
+                "# TYPE chat_cache_total counter",
+            ]
+            for (cache, resultado), valor in sorted(self._cache.items()):
+                lineas.append(f'chat_cache_total{{cache="{cache}",resultado="{resultado}"}} {valor}')
+        return "\n".join(lineas) + "\n"
+
+    def servir_metricas(self, puerto: int = 9464, host: str = "0.0.0.0"):
+        """Expone `/metrics` por HTTP en un hilo en segundo plano"""
+        if self._servidor is not None:
+            return self._servidor
+        trazador = self
+
+        class ManejadorMetricas(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                cuerpo = trazador.exportar_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def log_message(self, *args):
+                pass
+
+        self._servidor = ThreadingHTTPServer((host, puerto), ManejadorMetricas)
+        threading.Thread(target=self._servidor.serve_forever, name="chat-metricas", daemon=True).start()
+        print(f"📈 Métricas Prometheus en http://{host}:{puerto}/metrics")
+        return self._servidor